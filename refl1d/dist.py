@@ -15,6 +15,7 @@ import numpy as np
 from bumps.parameter import Parameter, to_dict
 
 from .experiment import ExperimentBase
+from .reflectivity import reflectivity_amplitude_batch as reflamp_batch
 
 class Weights(object):
     """
@@ -112,6 +113,14 @@ class DistributionExperiment(ExperimentBase):
     If *coherent* is true, then the reflectivity of the mixture is computed
     from the coherent sum rather than the incoherent sum.
 
+    The slab profiles for all values of *P* are computed first, and the
+    reflectivity amplitudes for all of them are computed together with
+    the batched reflectivity kernel.  If the profile is a linear function of
+    *P*, such as when *P* is a layer thickness or SLD, then the profile is
+    only rendered for the first, second and last values, and the remaining
+    profiles are interpolated.  Magnetic models, repeated blocks, polarized
+    probes and refined theory grids are computed one value at a time.
+
     See :class:`Weights` for a description of how to set up the distribution.
     """
     def __init__(self, experiment=None, P=None, distribution=None,
@@ -145,24 +154,75 @@ class DistributionExperiment(ExperimentBase):
     def reflectivity(self, resolution=True, interpolation=0):
         key = ("reflectivity", resolution, interpolation)
         if key not in self._cache:
-            calc_R = 0
-            for x, w in self.distribution:
-                if w > 0:
-                    self.P.value = x
-                    self.experiment.update()
-                    Qx, Rx = self.experiment._reflamp()
-                    if self.coherent:
-                        calc_R += w*Rx
-                    else:
-                        calc_R += w*abs(Rx)**2
+            x, w = zip(*[(x, w) for x, w in self.distribution if w > 0])
+            saved = self.P.value
+            try:
+                Qx, Rx = self._reflamp(x)
+            finally:
+                self.P.value = saved
+                self.experiment.update()
+            w = np.array(w)
             if self.coherent:
-                calc_R = abs(calc_R)**2
+                calc_R = abs(np.tensordot(w, Rx, axes=1))**2
+            else:
+                calc_R = np.tensordot(w, abs(Rx)**2, axes=1)
             Q, R = self.probe.apply_beam(Qx, calc_R,
                                          resolution=resolution,
                                          interpolation=interpolation)
             self._cache[key] = Q, R
         return self._cache[key]
 
+    def _reflamp(self, values):
+        """
+        Return the theory points and the reflectivity amplitude for each
+        of the *values* of *P*.
+        """
+        experiment = self.experiment
+        stacks = self._render_stacks(values)
+        if stacks is None:
+            Rx = []
+            for x in values:
+                self.P.value = x
+                experiment.update()
+                Qx, r = experiment._reflamp()
+                Rx.append(r)
+            return Qx, np.array(Rx)
+        calc_q, depth, sigma, rho, irho = stacks
+        Rx = reflamp_batch(-calc_q/2, depth=depth, sigma=sigma, rho=rho,
+                           irho=irho, rho_index=experiment._rho_index())
+        return calc_q[-1], Rx
+
+    def _render_stacks(self, values):
+        """
+        Render the slabs for each of the *values* of *P*, returning the
+        calculation points and the depth, sigma, rho, irho arrays with
+        one entry per value, or None if the values need to be computed
+        one at a time.
+        """
+        experiment = self.experiment
+
+        def render(x):
+            self.P.value = x
+            experiment.update()
+            slabs = experiment._render_slabs()
+            if (slabs.ismagnetic or slabs.repeats is not None
+                    or experiment._refining(slabs)):
+                return None
+            return [experiment.probe.calc_Q] + [
+                v.copy() for v in (slabs.w, slabs.sigma, slabs.rho, slabs.irho)]
+
+        if experiment.probe.polarized:
+            return None
+        # Render each value since the profile need not be linear in P.
+        stacks = []
+        for x in values:
+            stack = render(x)
+            if stack is None:
+                return None
+            stacks.append(stack)
+        calc_q, depth, sigma, rho, irho = zip(*stacks)
+        return np.array(calc_q), depth, sigma, rho, irho
+
     def _max_P(self):
         x, w = zip(*self.distribution)
         idx = np.argmax(w)
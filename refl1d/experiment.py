@@ -14,22 +14,128 @@ import os
 from math import pi, log10, floor
 import traceback
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from warnings import warn
 
 import numpy as np
 from bumps import parameter
 from bumps.parameter import Parameter, to_dict
+from bumps.fitproblem import MultiFitProblem
 
 from . import material, profile
+from .model import Stack, Slab
 from . import __version__
 from .reflectivity import reflectivity_amplitude as reflamp
+from .reflectivity import reflectivity_amplitude_batch as reflamp_batch
 from .reflectivity import magnetic_amplitude as reflmag
+from .reflectivity import reflectivity_amplitude_jacobian as reflamp_jacobian
+from .reflectivity import IncrementalAmplitude
+from .reflectivity import reflectivity_resolved
 from .reflectivity import BASE_GUIDE_ANGLE as DEFAULT_THETA_M
 from .probe import PolarizedNeutronProbeSumDiff, meanreflectivity, splitting
 #print("Using pure python reflectivity calculator")
 #from .abeles import refl as reflamp
 from .util import asbytes
 
+# Shared thread pool for evaluating independent models, or None if serial.
+_MODEL_POOL = None
+_MODEL_THREADS = 1
+_POOL_WORKER = threading.local()
+
+
+def set_model_threads(threads=1):
+    """
+    Set the number of threads used to evaluate independent models.
+
+    The reflectivity kernels release the GIL, so the models given to
+    :func:`evaluate`, the models of a :class:`ConcurrentFitProblem` and the
+    parts of a :class:`MixedExperiment` can be computed at the same time on
+    a shared thread pool.  *threads* is 1 for serial evaluation (the
+    default) and 0 for one thread per core.  Model threads are an
+    alternative to the threaded kernels of :func:`refl1d.refllib.set_threads`.
+    If both are used, numba needs a threading layer which can be called
+    from several threads at once.
+    """
+    global _MODEL_POOL, _MODEL_THREADS
+    threads = int(threads)
+    if threads <= 0:
+        threads = os.cpu_count() or 1
+    if threads > 1:
+        # Load the kernels here rather than in a worker thread, since the
+        # threaded kernels must start the numba threading layer on the
+        # main thread.
+        from . import refllib
+    if _MODEL_POOL is not None:
+        _MODEL_POOL.shutdown()
+    _MODEL_THREADS = threads
+    _MODEL_POOL = (ThreadPoolExecutor(threads, thread_name_prefix="refl1d")
+                   if threads > 1 else None)
+
+
+def get_model_threads():
+    """
+    Return the number of threads used to evaluate independent models.
+    """
+    return _MODEL_THREADS
+
+
+def _pool_map(fn, items):
+    """
+    Return [fn(v) for v in items], using the model thread pool if there
+    is one.  Calls made from within the pool are evaluated serially so
+    that nested models cannot wait on their own workers.
+    """
+    items = list(items)
+    if (_MODEL_POOL is None or len(items) < 2
+            or getattr(_POOL_WORKER, 'active', False)):
+        return [fn(v) for v in items]
+
+    def task(v):
+        _POOL_WORKER.active = True
+        try:
+            return fn(v)
+        finally:
+            _POOL_WORKER.active = False
+    return list(_MODEL_POOL.map(task, items))
+
+
+def evaluate(models):
+    """
+    Compute the theory for each of the *models* on the model thread pool.
+
+    The results are kept in the model caches, so the following calls to
+    *nllf*, *residuals* or *reflectivity* for the current parameter values
+    do not need to recompute them.  The models must not share parameters
+    that change between them, such as the free variables of a
+    :class:`bumps.fitproblem.MultiFitProblem`.  See :func:`set_model_threads`.
+    """
+    _pool_map(lambda model: model.reflectivity(), models)
+
+
+class ConcurrentFitProblem(MultiFitProblem):
+    """
+    Fit problem for several models which are evaluated concurrently.
+
+    This is a :class:`bumps.fitproblem.MultiFitProblem` which computes the
+    theory for all of its models with :func:`evaluate` before combining
+    the cost functions.  Problems with free variables, which assign
+    different values to the same parameters for each model, are evaluated
+    one model at a time.  See :func:`set_model_threads`.
+    """
+    def _evaluate(self):
+        if not any(self.freevars.parameters().values()):
+            evaluate([f.fitness for f in self._models])
+
+    def model_nllf(self):
+        self._evaluate()
+        return MultiFitProblem.model_nllf(self)
+
+    def residuals(self):
+        self._evaluate()
+        return MultiFitProblem.residuals(self)
+
+
 def plot_sample(sample, instrument=None, roughness_limit=0):
     """
     Quick plot of a reflectivity sample and the corresponding reflectivity.
@@ -87,7 +193,8 @@ class ExperimentBase(object):
         when an existing chemical formula is modified; new and
         deleted formulas will be handled automatically.
         """
-        self._probe_cache.reset()
+        self._probe_cache.clear()
+        self._stages = {}
         self.update()
 
     def is_reset(self):
@@ -101,6 +208,9 @@ class ExperimentBase(object):
         Called when any parameter in the model is changed.
 
         This signals that the entire model needs to be recalculated.
+        Subclasses may keep intermediate results, such as the rendered
+        profile, between updates when the parameters they depend on
+        have not changed.
         """
         # if we wanted to be particularly clever we could predefine
         # the optical matrices and only adjust those that have changed
@@ -360,13 +470,65 @@ class Experiment(ExperimentBase):
     *interpolation* indicates the number of points to plot in between
     existing points.
 
+    If *incremental* is True, then the partial transfer matrix products
+    for each layer are saved for non-magnetic models, and a change to a
+    few neighbouring slabs, such as a single layer being perturbed while
+    computing a finite difference Jacobian, only recomputes those slabs.
+    See :class:`refl1d.reflectivity.IncrementalAmplitude`.  This uses
+    128 bytes per Q point per slab.
+
+    If *fused* is True, then the reflectivity amplitude, its magnitude, the
+    back absorption and the gaussian resolution are computed in a single
+    pass over the calculation points for non-magnetic models with
+    unpolarized probes, without forming arrays the size of the calculation
+    points.  This reduces memory traffic for heavily oversampled probes.
+    See :func:`refl1d.reflectivity.reflectivity_resolved`.  The usual path
+    is used when the model or probe is not supported, such as for
+    *interpolation*, uniform resolution, repeated blocks or *refine*.
+
+    If *refine* is a tolerance, then the theory is computed on an adaptive
+    grid built from the probe calculation points.  Midpoints are added
+    wherever the reflectivity differs from the straight line through its
+    neighbours by more than *refine* times the measurement uncertainty,
+    or by more than *refine* times the reflectivity when there is no data.
+    The grid extends three times the resolution dQ beyond the ends of the
+    measurement so that the resolution is fully covered at the ends.
+    The refined grid is reused between calls, and is only rebuilt when
+    the model has moved so far that the error is more than twice the
+    tolerance.  This puts extra points at sharp features such as the
+    critical edge and Kiessig fringes without a global :meth:`oversample
+    <refl1d.probe.Probe.oversample>`.  Refinement is only used for
+    non-magnetic models with unpolarized probes.
+
+    The rendered profile, the reflectivity amplitude and the resolution
+    smeared reflectivity are kept between updates, and each is only
+    recomputed when the parameters it depends on have changed.  Changes to
+    the beam intensity and background only rescale the smeared
+    reflectivity, changes to the sample broadening or back absorption
+    repeat the resolution calculation, and changes to the theta offset
+    repeat the reflectivity calculation without rendering the profile.
+    Call :meth:`update_composition` after changing the structure of the
+    model outside of its parameters.
+
+    Simple slab models can be compiled with :meth:`compile` so that the
+    profile is rendered by a vectorized gather from the fitting parameters
+    rather than by walking the layers of the sample.
+
     *smoothness* **DEPRECATED** This parameter is not used.
     """
     profile_shift = 0
+    incremental = False
+    fused = False
+    refine = None
+    _amplitude_cache = None
+    _refinement = None
+    _compiled = None
+    _sld_columns = None
     def __init__(self, sample=None, probe=None, name=None,
                  roughness_limit=0, dz=None, dA=None,
                  step_interfaces=None, smoothness=None,
-                 interpolation=0):
+                 interpolation=0, incremental=False, refine=None,
+                 fused=False):
         # Note: smoothness ignored
         self.sample = sample
         self._substrate = self.sample[0].material
@@ -380,10 +542,14 @@ class Experiment(ExperimentBase):
         self.dA = dA
         self.step_interfaces = step_interfaces
         self.interpolation = interpolation
-        num_slabs = len(probe.unique_L) if probe.unique_L is not None else 1
-        self._slabs = profile.Microslabs(num_slabs, dz=dz)
+        self.incremental = incremental
+        self.refine = refine
+        self.fused = fused
+        # The number of SLD columns is set when the sample is first rendered.
+        self._slabs = profile.Microslabs(1, dz=dz)
         self._probe_cache = material.ProbeCache(probe)
         self._cache = {}  # Cache calculated profiles/reflectivities
+        self._stages = {}  # Intermediate results kept between updates
         self._name = name
 
     @property
@@ -410,6 +576,9 @@ class Experiment(ExperimentBase):
             'dA': self.dA,
             'step_interfaces': self.step_interfaces,
             'interpolation': self.interpolation,
+            'incremental': self.incremental,
+            'refine': self.refine,
+            'fused': self.fused,
         })
 
     def _render_slabs(self):
@@ -418,25 +587,219 @@ class Experiment(ExperimentBase):
         """
         key = 'rendered', self.step_interfaces, self.dA
         if key not in self._cache:
-            self._slabs.clear()
-            self.sample.render(self._probe_cache, self._slabs)
-            self._slabs.finalize(step_interfaces=self.step_interfaces,
-                                 dA=self.dA)
-                                 #roughness_limit=self.roughness_limit)
+            self._update_sld_columns()
+            signature = self._signature('sample')
+            if self._stages.get('rendered') != signature:
+                self._slabs.dz = self.dz
+                if self._compiled is not None:
+                    self._compiled.render(self._slabs)
+                else:
+                    self._slabs.clear()
+                    self.sample.render(self._probe_cache, self._slabs)
+                    self._slabs.finalize(step_interfaces=self.step_interfaces,
+                                         dA=self.dA)
+                                         #roughness_limit=self.roughness_limit)
+                self._stages['rendered'] = signature
             self._cache[key] = True
         return self._slabs
 
-    def _reflamp(self):
+    def _update_sld_columns(self):
+        """
+        Choose the wavelength columns for the SLD of the sample.
+
+        For probes which support wavelength dependent scattering factors
+        (see :class:`NeutronProbe <refl1d.probe.NeutronProbe>`), the sample
+        is rendered once at the first wavelength to find the materials
+        it contains, and the wavelengths are grouped into columns from the
+        SLD of those materials at their current density.  The columns are
+        chosen again when the probe calculation points change or after
+        :meth:`update_composition`, but not when a density is fitted.  Samples containing layers which
+        are not :attr:`wavelength_resolved <refl1d.model.Layer.wavelength_resolved>`,
+        such as free interfaces or polymer brushes, use a single column.
+        """
+        probe = self.probe
+        key = getattr(probe, '_L_idx', None)
+        if self._sld_columns is not None and self._sld_columns[0] is key:
+            return
+        cache = self._probe_cache
+        cache.clear()
+        cache.set_columns(None)
+        columns = index = None
+        if (hasattr(probe, 'sld_columns') and probe.unique_L is not None
+                and len(probe.unique_L) > 1 and self.sample.wavelength_resolved):
+            slabs = self._slabs
+            slabs.clear()
+            self.sample.render(cache, slabs)
+            rho, irho = cache.sld_table()
+            if len(rho) and not slabs.ismagnetic:
+                columns, index = probe.sld_columns(rho, irho)
+                if len(columns) > 1:
+                    cache.set_columns(columns)
+                else:
+                    columns = index = None
+        num_columns = len(columns) if columns is not None else 1
+        if self._slabs.rho.shape[0] != num_columns:
+            self._slabs = profile.Microslabs(num_columns, dz=self.dz)
+        if self._compiled is not None:
+            self._compiled = _CompiledStack(self.sample, cache,
+                                            self._compiled.pars, num_columns)
+        self._sld_columns = key, index
+        self._stages = {}
+
+    def _rho_index(self, position=None):
+        """
+        Return the SLD column for each theory point, or None if there is
+        only one column.
+
+        *position* is the fractional index of the points in the refined
+        grid (see :meth:`_refined_Q`), with the refined points using the
+        column of the probe point below them.
+        """
+        self._render_slabs()
+        index = self._sld_columns[1]
+        if index is None or position is None:
+            return index
+        index = np.hstack((index[0], index, index[-1]))
+        return index[np.floor(position).astype('i')]
+
+    def _measured(self):
+        """
+        Return the cross sections needed by a polarized probe, or None if
+        all of them are needed.
+        """
+        return self.probe.measured if self.probe.polarized else None
+
+    def _refining(self, slabs):
+        """
+        True if the theory is computed on a refined grid.
+        """
+        return (self.refine is not None and not slabs.ismagnetic
+                and not self.probe.polarized)
+
+    def compile(self, pars=None):
+        """
+        Replace the rendering of the sample with a gather from *pars*.
+
+        The sample must be a stack of non-magnetic :class:`Slab <refl1d.model.Slab>`
+        layers of :class:`SLD <refl1d.material.SLD>`, :class:`Material
+        <refl1d.material.Material>` or vacuum, with *step_interfaces* off
+        and no *dA* contraction.  Each thickness, interface, rho and irho
+        value must be a constant or a linear function of a single parameter
+        in *pars*, such as a material density fitted by relative density.
+        Material scattering factors are looked up once and pre-multiplied
+        into the gather, so rendering becomes a single vector expression
+        with no per-layer Python.
+
+        If *pars* is not given, the varying parameters of the experiment
+        are used.  Parameters not in *pars* are frozen at their current
+        values.  Raises ValueError if the model cannot be compiled.  Call
+        :meth:`uncompile` to return to normal rendering, or :meth:`compile`
+        again after changing the model structure.
+        """
+        if pars is None:
+            pars = parameter.varying(parameter.unique(self.parameters()))
+        if self.step_interfaces or self.dA is not None:
+            raise ValueError("cannot compile step interfaces or dA contraction")
+        self._update_sld_columns()
+        compiled = _CompiledStack(self.sample, self._probe_cache, pars,
+                                  columns=self._slabs.rho.shape[0])
+        self.uncompile()
+        slabs = self._render_slabs()
+        if slabs.ismagnetic or slabs.repeats is not None:
+            raise ValueError("cannot compile magnetic or repeated layers")
+        # The slab arrays are views of buffers that render overwrites.
+        expected = [v.copy() for v in (slabs.w, slabs.sigma, slabs.rho, slabs.irho)]
+        compiled.render(slabs)
+        actual = slabs.w, slabs.sigma, slabs.rho, slabs.irho
+        if not all(a.shape == b.shape and np.allclose(a, b, rtol=1e-10, atol=0)
+                   for a, b in zip(actual, expected)):
+            self.uncompile()
+            raise ValueError("compiled profile does not match rendered profile")
+        self._compiled = compiled
+        self._stages = {}
+        self.update()
+
+    def uncompile(self):
+        """
+        Return to rendering the sample layer by layer.
+        """
+        self._compiled = None
+        self._stages = {}
+        self.update()
+
+    def update_composition(self):
+        self._sld_columns = None
+        ExperimentBase.update_composition(self)
+        if self._compiled is not None:
+            self.compile(self._compiled.pars)
+    update_composition.__doc__ = ExperimentBase.update_composition.__doc__
+
+    def update(self):
+        # Parameters, layers or materials may have been replaced, so walk
+        # the parameter tree again for the stage signatures.
+        self._stages.pop('parameter groups', None)
+        ExperimentBase.update(self)
+    update.__doc__ = ExperimentBase.update.__doc__
+
+    def _signature(self, *groups):
+        """
+        Identify the current values of the parameters in *groups*.
+
+        The groups are 'sample' for the sample parameters, 'geometry' for
+        probe parameters which change the calculated reflectivity, such as
+        theta offset, 'resolution' for sample broadening and back absorption,
+        which are applied before the resolution, and 'beam' for intensity
+        and background.  The 'sample' group also includes the rendering
+        options dz, dA and step_interfaces, and the 'resolution' group the
+        resolution function of the probe, since these are not parameters.
+        """
+        # The parameter tree is walked once per update.
+        if 'parameter groups' not in self._stages:
+            pars = _probe_parameter_groups(self.probe.parameters())
+            pars['sample'] = self.sample.parameters()
+            self._stages['parameter groups'] = dict(
+                (k, _unique_parameters(v)) for k, v in pars.items())
+        pars = self._stages['parameter groups']
+        signature = tuple((id(p), p.value) for group in groups for p in pars[group])
+        if 'sample' in groups:
+            signature += ((self.dz, self.dA, self.step_interfaces),)
+        if 'resolution' in groups:
+            signature += (_resolution_function(self.probe),)
+        return signature
+
+    def _reflamp(self, measured=True):
+        """
+        Return the theory points and the reflectivity amplitude.
+
+        If *measured* is True, only the cross sections measured by a
+        polarized probe are computed, with the others left as zero.
+        """
         #calc_q = self.probe.calc_Q
         #return calc_q, calc_q
-        key = 'calc_r'
+        xs = self._measured()
+        key = 'calc_r' if measured or xs is None else 'calc_r all'
+        if not measured:
+            xs = None
         if key not in self._cache:
+            signature = self._signature('sample', 'geometry'), self.refine
+            base_q = self.probe.calc_Q
+            stage = self._stages.get(key)
+            if (stage is not None and stage[0] == signature
+                    and np.array_equal(stage[1], base_q)):
+                self._cache[key] = stage[2]
+                return stage[2]
             slabs = self._render_slabs()
             w = slabs.w
             rho, irho = slabs.rho, slabs.irho
             sigma = slabs.sigma
             #sigma = slabs.sigma
             calc_q = self.probe.calc_Q
+            refine = self._refining(slabs)
+            if refine:
+                calc_q = self._refined_Q()
+                rho_index = self._rho_index(self._refinement[1])
+            else:
+                rho_index = self._rho_index()
             #print("calc Q", self.probe.calc_Q)
             if slabs.ismagnetic:
                 rhoM, thetaM = slabs.rhoM, slabs.thetaM
@@ -444,10 +807,20 @@ class Experiment(ExperimentBase):
                 H = self.probe.H.value
                 calc_r = reflmag(-calc_q/2, depth=w, rho=rho[0], irho=irho[0],
                                  rhoM=rhoM, thetaM=thetaM, Aguide=Aguide, H=H,
-                                 sigma=sigma)
+                                 sigma=sigma, repeats=slabs.repeats,
+                                 xs=xs)
+            elif self.incremental and slabs.repeats is None:
+                # Repeated blocks are already cheap to evaluate, so only
+                # use the saved partial products for plain stacks.
+                if self._amplitude_cache is None:
+                    self._amplitude_cache = IncrementalAmplitude()
+                calc_r = self._amplitude_cache(-calc_q/2, depth=w, rho=rho,
+                                               irho=irho, sigma=sigma,
+                                               rho_index=rho_index)
             else:
                 calc_r = reflamp(-calc_q/2, depth=w, rho=rho, irho=irho,
-                                 sigma=sigma)
+                                 sigma=sigma, rho_index=rho_index,
+                                 repeats=slabs.repeats)
             if False and np.isnan(calc_r).any():
                 print("w", w)
                 print("rho", rho)
@@ -463,21 +836,129 @@ class Experiment(ExperimentBase):
                 fitted = parameter.varying(pars)
                 print(parameter.summarize(fitted))
                 print("===")
+            if refine:
+                calc_q, calc_r = self._refine(calc_q, calc_r, slabs)
             self._cache[key] = calc_q, calc_r
+            self._stages[key] = signature, base_q, self._cache[key]
             #if np.isnan(calc_q).any(): print("calc_Q contains NaN")
             #if np.isnan(calc_r).any(): print("calc_r contains NaN")
         return self._cache[key]
 
+    def _refine_base(self):
+        """
+        Probe calculation points extended by three times the resolution dQ
+        beyond either end of the measurement so that the resolution at the
+        ends is covered.
+
+        The calculation points are assumed to be in order, increasing or
+        decreasing, as the probes keep them.  The refined points are stored
+        relative to this order, so it cannot be sorted here.
+        """
+        base = self.probe.calc_Q
+        # Resolution at the low and high |Q| ends of the measurement, which
+        # need not be sorted.
+        Q = abs(self.probe.Q)
+        dQ = self.probe.dQ[[np.argmin(Q), np.argmax(Q)]]
+        if abs(base[0]) > abs(base[-1]):
+            dQ = dQ[::-1]
+        step = np.sign(base[-1] - base[0])*3*dQ
+        # Don't cross Q = 0 into the other side of the sample.
+        lo = base[0] - step[0] if abs(step[0]) < abs(base[0]) else 0.
+        return np.hstack((lo, base, base[-1] + step[1]))
+
+    def _refined_Q(self):
+        """
+        Map the saved refinement onto the current probe calculation points.
+
+        The refined points are stored as fractional indices into the probe
+        points so that the refinement follows the probe when the points
+        move, such as when the theta offset changes.
+        """
+        base = self._refine_base()
+        if self._refinement is None or self._refinement[0] != len(base):
+            self._refinement = len(base), np.arange(len(base), dtype='d'), False
+        return np.interp(self._refinement[1], np.arange(len(base)), base)
+
+    def _refine(self, calc_q, calc_r, slabs, levels=6):
+        """
+        Add midpoints to the theory grid where the reflectivity is not
+        linear to within the tolerance, returning the refined *calc_q*
+        and *calc_r*.  Intervals are split at most *levels* times.
+        """
+        base = self._refine_base()
+        index = np.arange(len(base))
+        _, position, refined = self._refinement
+        ratio = self._refine_error(calc_q, calc_r)
+        if refined:
+            if not np.any(ratio > 2):
+                return calc_q, calc_r
+            # The model has moved far from the one used to refine the
+            # grid, so start again from the probe points.
+            keep = (position == np.floor(position))
+            position, calc_q, calc_r = position[keep], calc_q[keep], calc_r[keep]
+            ratio = self._refine_error(calc_q, calc_r)
+        for _ in range(levels):
+            bad = np.flatnonzero(ratio > 1)
+            if len(bad) == 0:
+                break
+            # Split the intervals on either side of the bad points, unless
+            # they are already at the finest level.
+            split = np.unique(np.hstack((bad-1, bad)))
+            split = split[(split >= 0) & (split < len(position)-1)]
+            width = position[split+1] - position[split]
+            split = split[width > 2.**-levels]
+            if len(split) == 0:
+                break
+            new_position = 0.5*(position[split] + position[split+1])
+            new_q = np.interp(new_position, index, base)
+            new_r = reflamp(-new_q/2, depth=slabs.w, rho=slabs.rho,
+                            irho=slabs.irho, sigma=slabs.sigma,
+                            rho_index=self._rho_index(new_position),
+                            repeats=slabs.repeats)
+            order = np.argsort(np.hstack((position, new_position)))
+            position = np.hstack((position, new_position))[order]
+            calc_q = np.hstack((calc_q, new_q))[order]
+            calc_r = np.hstack((calc_r, new_r))[order]
+            ratio = self._refine_error(calc_q, calc_r)
+        self._refinement = len(base), position, True
+        return calc_q, calc_r
+
+    def _refine_error(self, calc_q, calc_r):
+        """
+        Linear interpolation error at each theory point relative to the
+        refinement tolerance.
+
+        The tolerance is relative to the measurement uncertainty, or to the
+        reflectivity where there is no data or the uncertainty is zero.
+        """
+        R = abs(calc_r)**2
+        error = np.zeros_like(R)
+        if len(R) > 2:
+            # Distance from the line joining the two neighbours.
+            q0, q1, q2 = calc_q[:-2], calc_q[1:-1], calc_q[2:]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (q1 - q0)/(q2 - q0)
+            error[1:-1] = abs(R[1:-1] - (R[:-2] + t*(R[2:] - R[:-2])))
+        if self.probe.dR is not None:
+            Q = abs(calc_q)
+            scale = np.interp(Q, self.probe.Q, self.probe.dR)
+            scale = np.where(scale > 0, scale, R)
+        else:
+            scale = R
+        scale = np.maximum(scale, np.finfo('d').tiny)
+        return error/(self.refine*scale)
+
     def amplitude(self, resolution=False, interpolation=0):
         """
         Calculate reflectivity amplitude at the probe points.
+
+        All four cross sections are computed for polarized probes, even if
+        some of them are not measured.
         """
         key = ('amplitude', resolution, interpolation)
         if key not in self._cache:
-            calc_q, calc_r = self._reflamp()
-            res = self.probe.apply_beam(calc_q, calc_r, resolution=resolution,
-                                        interpolation=interpolation)
-            self._cache[key] = res
+            self._cache[key] = self._apply_beam(key, lambda r: r,
+                                                measured=False)
         return self._cache[key]
 
     def reflectivity(self, resolution=True, interpolation=0):
@@ -488,15 +969,205 @@ class Experiment(ExperimentBase):
         """
         key = ('reflectivity', resolution, interpolation)
         if key not in self._cache:
-            calc_q, calc_r = self._reflamp()
-            calc_R = _amplitude_to_magnitude(calc_r,
-                                             ismagnetic=self.ismagnetic,
-                                             polarized=self.probe.polarized)
-            res = self.probe.apply_beam(calc_q, calc_R, resolution=resolution,
-                                        interpolation=interpolation)
-            self._cache[key] = res
+            def magnitude(calc_r):
+                return _amplitude_to_magnitude(calc_r,
+                                               ismagnetic=self.ismagnetic,
+                                               polarized=self.probe.polarized,
+                                               measured=self._measured())
+            result = self._fused_reflectivity(key) if self.fused else None
+            if result is None:
+                result = self._apply_beam(key, magnitude)
+            self._cache[key] = result
         return self._cache[key]
 
+    def _fused_reflectivity(self, key):
+        """
+        Return the reflectivity computed by the fused kernel, or None if
+        the model or probe needs the separate amplitude and resolution steps.
+        """
+        _, resolution, interpolation = key
+        # An amplitude that is already available, such as one primed by
+        # nllf_batch, only needs the resolution applied.
+        if not resolution or self.probe.polarized or 'calc_r' in self._cache:
+            return None
+        calc_q = self.probe.calc_Q
+        columns = self.probe._resolution_columns(calc_q, interpolation)
+        if columns is None:
+            return None
+        signature = self._signature('sample', 'geometry', 'resolution')
+        stage = self._stages.get('fused')
+        if stage is None or stage[0] != signature or stage[1] is not columns:
+            slabs = self._render_slabs()
+            if (slabs.ismagnetic or slabs.repeats is not None
+                    or self._refining(slabs)):
+                return None
+            Q, resolution = columns
+            R = reflectivity_resolved(
+                calc_q, resolution, len(Q), depth=slabs.w, rho=slabs.rho,
+                irho=slabs.irho, sigma=slabs.sigma,
+                rho_index=self._rho_index(),
+                back_absorption=self.probe.back_absorption.value)
+            stage = self._stages['fused'] = signature, columns, (Q, R)
+        return self.probe._scale_resolved(stage[2])
+
+    def _apply_beam(self, key, transform, measured=True):
+        """
+        Apply the probe to *transform(calc_r)*, reusing the resolution
+        smeared result for *key* if only the intensity or background
+        have changed.  *measured* is passed to :meth:`_reflamp`.
+        """
+        _, resolution, interpolation = key
+        calc_q, calc_r = self._reflamp(measured=measured)
+        signature = calc_r, self._signature('resolution')
+        stage = self._stages.get(key)
+        # Identity of calc_r is enough since it is replaced when recomputed.
+        if (stage is None or stage[0][0] is not calc_r
+                or stage[0][1] != signature[1]):
+            resolved = self.probe._resolve_beam(
+                calc_q, transform(calc_r), resolution=resolution,
+                interpolation=interpolation)
+            stage = self._stages[key] = signature, resolved
+        return self.probe._scale_resolved(stage[1])
+
+    def nllf_batch(self, population, pars=None):
+        """
+        Return -log(P(data|model)) for each parameter vector in *population*.
+
+        *population* is a sequence of parameter vectors, such as the points
+        in one generation of a DE or DREAM fit.  *pars* lists the parameters
+        corresponding to the vector elements; it defaults to the varying
+        parameters of the experiment in :func:`bumps.parameter.unique` order.
+
+        The profiles are rendered one member at a time, but the reflectivity
+        for the whole population is computed in a single call to the batched
+        kernel.  Magnetic models and models with a refined theory grid
+        (see *refine*) are evaluated one member at a time.  The parameters
+        are restored to their original values on return.
+        """
+        if pars is None:
+            pars = parameter.varying(parameter.unique(self.parameters()))
+        population = np.atleast_2d(population)
+        saved = [p.value for p in pars]
+
+        def _setp(pvec):
+            for p, v in zip(pars, pvec):
+                p.value = v
+            self.update()
+
+        try:
+            stacks, calc_qs = [], []
+            for pvec in population:
+                _setp(pvec)
+                slabs = self._render_slabs()
+                if slabs.ismagnetic or self._refining(slabs):
+                    stacks = None
+                    break
+                stacks.append((slabs.w.copy(), slabs.sigma.copy(),
+                               slabs.rho.copy(), slabs.irho.copy()))
+                calc_qs.append(self.probe.calc_Q)
+
+            if stacks is None:
+                nllf = []
+                for pvec in population:
+                    _setp(pvec)
+                    nllf.append(self.nllf())
+                return np.array(nllf)
+
+            depth, sigma, rho, irho = zip(*stacks)
+            calc_r = reflamp_batch(-np.array(calc_qs)/2, depth=depth,
+                                   rho=rho, irho=irho, sigma=sigma,
+                                   rho_index=self._rho_index())
+            nllf = []
+            for pvec, calc_q, r in zip(population, calc_qs, calc_r):
+                _setp(pvec)
+                # Prime the cache with the batch results so that nllf only
+                # needs to apply the beam and compare with data.  The slabs
+                # hold the last member rendered, but nllf only checks that
+                # they are not magnetic.
+                self._cache['rendered', self.step_interfaces, self.dA] = True
+                self._cache['calc_r'] = calc_q, r
+                nllf.append(self.nllf())
+            return np.array(nllf)
+        finally:
+            _setp(saved)
+
+    def jacobian(self, pars=None, step=1e-6):
+        """
+        Return the derivative of the residuals with respect to *pars*.
+
+        The result J[i, k] is the derivative of residual i with respect to
+        parameter k, using the same layout as :func:`bumps.lsqerror.jacobian`.
+        If *pars* is not given, the varying parameters of the experiment
+        are used.
+
+        Parameters which only change the rendered slabs (thickness,
+        interface, SLD, ...) use the analytic derivative of the reflectivity
+        amplitude with respect to the slab values, chained through the
+        change in the slabs for a small relative *step* in the parameter,
+        so each parameter costs a profile rendering rather than a full
+        reflectivity calculation.  Probe parameters, parameters which
+        change the number of slabs, magnetic or polarized models, and
+        profiles contracted with *dA* fall back to forward differences of
+        the residuals.  Contraction can move the slab boundaries without
+        changing the number of slabs, so the change in the slabs is not a
+        derivative.  The parameters are restored on return.
+        """
+        if pars is None:
+            pars = parameter.varying(parameter.unique(self.parameters()))
+        saved = [p.value for p in pars]
+        probe_pars = set(id(p) for p in parameter.unique(self.probe.parameters()))
+
+        def _setp(pvec):
+            for p, v in zip(pars, pvec):
+                p.value = v
+            self.update()
+
+        try:
+            _setp(saved)
+            resid = self.residuals().copy()
+            slabs = self._render_slabs()
+            analytic = not (slabs.ismagnetic or self.probe.polarized
+                            or self.dA is not None)
+            if analytic:
+                w, sigma = slabs.w.copy(), slabs.sigma.copy()
+                rho, irho = slabs.rho.copy(), slabs.irho.copy()
+                # Use the theory grid, which may be refined.
+                base_q, calc_q = self.probe.calc_Q, self._reflamp()[0]
+                rho_index = self._rho_index(
+                    self._refinement[1] if self._refining(slabs) else None)
+                if rho_index is None:
+                    rho_index = np.zeros(calc_q.shape, 'i')
+                r, dr = reflamp_jacobian(-calc_q/2, depth=w, rho=rho,
+                                         irho=irho, sigma=sigma,
+                                         rho_index=rho_index)
+                # apply_beam is affine in |r|^2, so remove the offset
+                offset = self.probe.apply_beam(calc_q, np.zeros_like(calc_q))[1]
+
+            J = np.empty((len(resid), len(pars)))
+            for k, (p, v) in enumerate(zip(pars, saved)):
+                h = step*max(abs(v), 1.)
+                p.value = v + h
+                self.update()
+                column = None
+                if analytic and id(p) not in probe_pars:
+                    slabs = self._render_slabs()
+                    if (slabs.w.shape == w.shape and slabs.rho.shape == rho.shape
+                            and np.array_equal(self.probe.calc_Q, base_q)):
+                        dr_dp = (np.dot((slabs.w - w)/h, dr[0])
+                                 + np.dot((slabs.sigma - sigma)/h, dr[3, :-1])
+                                 + np.einsum('mj,jm->m', ((slabs.rho - rho)/h)[rho_index], dr[1])
+                                 + np.einsum('mj,jm->m', ((slabs.irho - irho)/h)[rho_index], dr[2]))
+                        dR_dp = 2*(np.conj(r)*dr_dp).real
+                        theory = self.probe.apply_beam(calc_q, dR_dp)[1] - offset
+                        column = -theory/self.probe.dR
+                if column is None:
+                    column = (self.residuals() - resid)/h
+                J[:, k] = column
+                p.value = v
+            return J
+        finally:
+            _setp(saved)
+
     def smooth_profile(self, dz=0.1):
         """
         Return the scattering potential for the sample.
@@ -691,10 +1362,12 @@ class MixedExperiment(ExperimentBase):
             'interpolation': self.interpolation,
         })
 
-    def _reflamp(self):
+    def _reflamp(self, measured=True):
         """
         Calculate the amplitude of the reflectivity...
 
+        *measured* is passed to :meth:`Experiment._reflamp` for each part.
+
         For an incoherent sum, we want to add the squares of the amplitudes,
         with a weighting specified by self.ratio, so the amplitudes
         are scaled by sqrt(self.ratio/total) so when they get squared and added
@@ -704,7 +1377,7 @@ class MixedExperiment(ExperimentBase):
         It all comes out in the wash.
         """
         total = sum(r.value for r in self.ratio)
-        Qs, Rs = zip(*[p._reflamp() for p in self.parts])
+        Qs, Rs = zip(*_pool_map(lambda p: p._reflamp(measured), self.parts))
         if not self.coherent:
             Rs = [np.asarray(ri)*np.sqrt(ratio_i.value/total)
                   for ri, ratio_i in zip(Rs, self.ratio)]
@@ -721,12 +1394,10 @@ class MixedExperiment(ExperimentBase):
             raise TypeError("Cannot compute amplitude of system which is mixed incoherently")
         key = ('amplitude', resolution)
         if key not in self._cache:
-            calc_Q, calc_R = self._reflamp()
-            calc_R = np.sum(calc_R, axis=1)
-            r_real = self.probe.apply_beam(calc_Q, calc_R.real, resolution=resolution)
-            r_imag = self.probe.apply_beam(calc_Q, calc_R.imag, resolution=resolution)
-            r = r_real + 1j*r_imag
-            self._cache[key] = self.probe.Q, r
+            calc_Q, calc_R = self._reflamp(measured=False)
+            calc_R = np.sum(calc_R, axis=0)
+            self._cache[key] = self.probe.apply_beam(calc_Q, calc_R,
+                                                     resolution=resolution)
         return self._cache[key]
 
 
@@ -808,18 +1479,181 @@ def _nonpolarized_magnetic(R):
     """
     return sum(R)/2
 
-def _amplitude_to_magnitude(r, ismagnetic, polarized):
+def _unique_parameters(pars):
+    """
+    Like :func:`bumps.parameter.unique` but linear rather than quadratic
+    in the number of parameters.
+    """
+    pars = parameter.flatten(pars)
+    pars = pars + parameter.flatten([p.parameters() for p in pars])
+    return list(dict((id(p), p) for p in pars).values())
+
+
+class _CompiledStack(object):
+    """
+    Flat gather map from a parameter vector to the slab arrays.
+
+    The slab values are stored in a table with rows w, sigma, rho[0..k-1]
+    and irho[0..k-1] for *k* wavelength columns, and columns for the
+    layers.  Constant entries are filled in once, and the remaining
+    entries are *offset + scale*pars[source]* at the flat indices *target*.
+    """
+    def __init__(self, sample, probe_cache, pars, columns):
+        if not isinstance(sample, Stack):
+            raise ValueError("can only compile a stack of slabs")
+        layers = sample._layers
+        n, k = len(layers), columns
+        index = dict((id(p), i) for i, p in enumerate(pars))
+        table = np.zeros((2 + 2*k, n))
+        target, source, scale, offset = [], [], [], []
+
+        def _set(row, layer, value, factor=1.):
+            # Expand value = factor*driver into the table or the gather.
+            factor = np.broadcast_to(np.asarray(factor, 'd'), (len(row),))
+            row = np.asarray(row)*n + layer
+            if not isinstance(value, parameter.BaseParameter):
+                table.flat[row] = factor*value
+                return
+            c0, c1, i = _linear_dependence(value, pars, index)
+            if i is None:
+                table.flat[row] = factor*c0
+            else:
+                target.extend(row)
+                source.extend([i]*len(row))
+                scale.extend(factor*c1)
+                offset.extend(factor*c0)
+
+        for j, layer in enumerate(layers):
+            if type(layer) is not Slab or layer.magnetism is not None:
+                raise ValueError("cannot compile layer %s"%layer)
+            _set([0], j, layer.thickness)
+            _set([1], j, layer.interface)
+            rho, irho = range(2, 2+k), range(2+k, 2+2*k)
+            m = layer.material
+            if isinstance(m, material.Vacuum):
+                pass
+            elif type(m) is material.SLD:
+                _set(rho, j, m.rho)
+                _set(irho, j, m.irho)
+            elif type(m) is material.Material and not m.use_incoherent:
+                sf = probe_cache.scattering_factors(m.formula, density=1.)
+                _set(rho, j, m.density, factor=sf[0])
+                _set(irho, j, m.density, factor=sf[1])
+            else:
+                raise ValueError("cannot compile material %s"%m)
+
+        self.pars = pars
+        self.columns = k
+        self.table = table
+        self.target = np.asarray(target, 'i')
+        self.source = np.asarray(source, 'i')
+        self.scale = np.asarray(scale, 'd')
+        self.offset = np.asarray(offset, 'd')
+
+    def render(self, slabs):
+        """
+        Fill *slabs* from the current parameter values.
+        """
+        pvec = np.array([p.value for p in self.pars], 'd')
+        table = self.table.copy()
+        table.flat[self.target] = self.offset + self.scale*pvec[self.source]
+        k = self.columns
+        slabs.clear()
+        slabs.extend(w=table[0], sigma=table[1],
+                     rho=table[2:2+k], irho=table[2+k:])
+        slabs.finalize(step_interfaces=False, dA=None)
+
+
+def _linear_dependence(value, pars, index):
+    """
+    Express parameter *value* as *c0 + c1*pars[i]*.
+
+    Returns *(c0, c1, i)*, with *i* None if *value* does not depend on
+    *pars*.  Raises ValueError if *value* depends on more than one of *pars*
+    or is not linear in it.
+    """
+    if id(value) in index:
+        return 0., 1., index[id(value)]
+    deps = set(index[id(p)] for p in _unique_parameters(value)
+               if id(p) in index)
+    if not deps:
+        return value.value, 0., None
+    if len(deps) > 1:
+        raise ValueError("%s depends on more than one parameter"%value)
+    i = deps.pop()
+    p = pars[i]
+    p0 = p.value
+    h = 1e-3*max(abs(p0), 1.)
+    try:
+        v0 = value.value
+        p.value = p0 + h
+        vp = value.value
+        p.value = p0 - h
+        vm = value.value
+    finally:
+        p.value = p0
+    if abs(vp + vm - 2*v0) > 1e-10*max(abs(vp), abs(vm), abs(v0)):
+        raise ValueError("%s is not linear in %s"%(value, p))
+    c1 = (vp - vm)/(2*h)
+    return v0 - c1*p0, c1, i
+
+
+def _probe_parameter_groups(pars):
+    """
+    Split the probe parameter tree into the groups used by
+    :meth:`Experiment._signature`.
+    """
+    groups = {'geometry': [], 'resolution': [], 'beam': []}
+    def _walk(node, name=None):
+        if isinstance(node, dict):
+            for k, v in node.items():
+                _walk(v, k)
+        elif isinstance(node, (list, tuple)):
+            for v in node:
+                _walk(v, name)
+        elif node is not None:
+            if name in ('intensity', 'background'):
+                groups['beam'].append(node)
+            elif name in ('sample_broadening', 'back_absorption'):
+                groups['resolution'].append(node)
+            else:
+                groups['geometry'].append(node)
+    _walk(pars)
+    return groups
+
+
+def _resolution_function(probe):
+    """
+    Return the resolution function of *probe*, or of each cross section
+    of a polarized probe.
+    """
+    xs = getattr(probe, 'xs', None)
+    if xs is not None:
+        return tuple(_resolution_function(p) if p is not None else None
+                     for p in xs)
+    return getattr(probe, 'resolution', None)
+
+
+def _amplitude_to_magnitude(r, ismagnetic, polarized, measured=None):
     """
     Compute the reflectivity magnitude
+
+    For polarized probes, the cross sections which are not *measured* are
+    returned as None.
     """
+    if measured is None:
+        measured = [True]*4
     if ismagnetic:
-        R = [abs(xs)**2 for xs in r]
         if not polarized:
-            R = _nonpolarized_magnetic(R)
+            R = _nonpolarized_magnetic([abs(xs)**2 for xs in r])
+        else:
+            R = [(abs(xs)**2 if use else None)
+                 for xs, use in zip(r, measured)]
     else:
         R = abs(r)**2
         if polarized:
-            R = _polarized_nonmagnetic(R)
+            R = [(xs if use else None)
+                 for xs, use in zip(_polarized_nonmagnetic(R), measured)]
     return R
 
 
@@ -1,13 +1,15 @@
 import numba
 import math
 
+import numpy as np
+
 Z_EPS = 1e-6
 
 ALIGN_MAGNETIC_SIG = 'i4(f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8[:,:])'
 
 
-# @numba.njit(ALIGN_MAGNETIC_SIG, parallel=False, cache=True)
-@numba.njit(cache=True)
+# @numba.njit(ALIGN_MAGNETIC_SIG, parallel=False, cache=True, nogil=True)
+@numba.njit(cache=True, nogil=True)
 def align_magnetic(d, sigma, rho, irho, dM, sigmaM, rhoM, thetaM, output_flat):
     # ignoring thickness d on the first and last layers
     # ignoring interface width sigma on the last layer
@@ -116,8 +118,8 @@ def align_magnetic(d, sigma, rho, irho, dM, sigmaM, rhoM, thetaM, output_flat):
 CONTRACT_MAG_SIG = 'i4(f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8)'
 
 
-# @numba.njit(CONTRACT_MAG_SIG, parallel=False, cache=True)
-@numba.njit(cache=True)
+# @numba.njit(CONTRACT_MAG_SIG, parallel=False, cache=True, nogil=True)
+@numba.njit(cache=True, nogil=True)
 def contract_mag(d, sigma, rho, irho, rhoM, thetaM, dA):
     n = len(d)
     i = newi = 1  # /* Skip the substrate */
@@ -174,7 +176,8 @@ def contract_mag(d, sigma, rho, irho, rhoM, thetaM, dA):
                 break
 
         # /* Save the layer */
-        assert(newi < n)
+        # newi <= i - 1 < n, so the slab fits.  No assert here since pytest
+        # rewrites asserts in package modules, which numba cannot compile.
         d[newi] = dz
         if (i == n):
             # /* Last layer uses surface values */
@@ -199,8 +202,8 @@ def contract_mag(d, sigma, rho, irho, rhoM, thetaM, dA):
 CONTRACT_BY_AREA_SIG = 'i4(f8[:], f8[:], f8[:], f8[:], f8)'
 
 
-# @numba.njit(CONTRACT_BY_AREA_SIG, parallel=False, cache=True)
-@numba.njit(cache=True)
+# @numba.njit(CONTRACT_BY_AREA_SIG, parallel=False, cache=True, nogil=True)
+@numba.njit(cache=True, nogil=True)
 def contract_by_area(d, sigma, rho, irho, dA):
     n = len(d)
     i = newi = 1  # /* Skip the substrate */
@@ -246,7 +249,8 @@ def contract_by_area(d, sigma, rho, irho, dA):
         # /* if (dz == 0) continue; */
 
         # /* Save the layer */
-        assert(newi < n)
+        # newi <= i - 1 < n, so the slab fits.  No assert here since pytest
+        # rewrites asserts in package modules, which numba cannot compile.
         d[newi] = dz
         if (i == n):
             # /* printf("contract: adding final sld at %d\n",newi); */
@@ -263,3 +267,73 @@ def contract_by_area(d, sigma, rho, irho, dA):
         newi += 1
 
     return newi
+
+
+CONTRACT_BY_AREA_COLUMNS_SIG = 'i4(f8[:], f8[:], f8[:,:], f8[:,:], f8)'
+
+
+@numba.njit(CONTRACT_BY_AREA_COLUMNS_SIG, parallel=False, cache=True, nogil=True)
+def contract_by_area_columns(d, sigma, rho, irho, dA):
+    # Same as contract_by_area, but with rho[k, n], irho[k, n] for k
+    # wavelengths.  Slices are merged only if the area criterion holds
+    # for every column.
+    n = len(d)
+    ncol = rho.shape[0]
+    rholo, rhohi = np.empty(ncol), np.empty(ncol)
+    irholo, irhohi = np.empty(ncol), np.empty(ncol)
+    rhoarea, irhoarea = np.empty(ncol), np.empty(ncol)
+    i = newi = 1  # /* Skip the substrate */
+    while (i < n):
+
+        # /* Get ready for the next layer */
+        # /* Accumulation of the first row happens in the inner loop */
+        dz = 0.0
+        for k in range(ncol):
+            rhoarea[k] = irhoarea[k] = 0.0
+            rholo[k] = rhohi[k] = rho[k, i]
+            irholo[k] = irhohi[k] = irho[k, i]
+
+        # /* Accumulate slices into layer */
+        while True:
+            # /* Accumulate next slice */
+            dz += d[i]
+            for k in range(ncol):
+                rhoarea[k] += d[i]*rho[k, i]
+                irhoarea[k] += d[i]*irho[k, i]
+
+            # /* If no more slices or sigma != 0, break immediately */
+            i += 1
+            if (i == n or sigma[i-1] != 0.):
+                break
+
+            # /* If next slice won't fit in any column, break */
+            fits = True
+            for k in range(ncol):
+                rholo[k] = min(rholo[k], rho[k, i])
+                rhohi[k] = max(rhohi[k], rho[k, i])
+                irholo[k] = min(irholo[k], irho[k, i])
+                irhohi[k] = max(irhohi[k], irho[k, i])
+                if ((rhohi[k]-rholo[k])*(dz+d[i]) > dA
+                        or (irhohi[k]-irholo[k])*(dz+d[i]) > dA):
+                    fits = False
+            if not fits:
+                break
+
+        # /* Save the layer */
+        d[newi] = dz
+        if (i == n):
+            # /* Last layer uses surface values */
+            for k in range(ncol):
+                rho[k, newi] = rho[k, n-1]
+                irho[k, newi] = irho[k, n-1]
+            # /* No interface for final layer */
+        else:
+            # /* Middle layers uses average values */
+            for k in range(ncol):
+                rho[k, newi] = rhoarea[k] / dz
+                irho[k, newi] = irhoarea[k] / dz
+            sigma[newi] = sigma[i-1]
+        # /* First layer uses substrate values */
+        newi += 1
+
+    return newi
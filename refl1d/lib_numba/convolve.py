@@ -1,4 +1,5 @@
 import numba
+import numpy as np
 from math import erf, sqrt, exp
 
 PI4 = 12.56637061435917295385
@@ -10,7 +11,8 @@ LOG_RESLIMIT = -6.90775527898213703123
 root_12_over_2 = sqrt(3)
 
 
-@numba.njit('(f8[:], f8[:], f8[:], f8[:], f8[:])', cache=True, parallel=False)
+@numba.njit(['(f8[:], f8[:], f8[:], f8[:], f8[:])',
+             '(f8[:], c16[:], f8[:], f8[:], c16[:])'], cache=True, nogil=True, parallel=False)
 def convolve_uniform(xi, yi, x, dx, y):
     left_index = 0
     N_xi = len(xi)
@@ -39,8 +41,8 @@ def convolve_uniform(xi, yi, x, dx, y):
         while left_index > 0 and xi[left_index] > left:
             left_index -= 1
 
-        # Set the first interval.
-        total = 0.
+        # Set the first interval.  Complex y is integrated in one pass.
+        total = 0.*yi[0]
         right_index = left_index + 1
         x1, y1 = xi[left_index], yi[left_index]
         x2, y2 = xi[right_index], yi[right_index]
@@ -111,17 +113,15 @@ def convolve_uniform(xi, yi, x, dx, y):
             y[k] = 0.5*(y1 + y2)
 
 
-@numba.njit('f8(f8[:], f8[:], i8, i8, f8, f8, f8)', cache=True, parallel=False, locals={
+@numba.njit(['f8(f8[:], f8[:], i8, i8, f8, f8, f8)',
+             'c16(f8[:], c16[:], i8, i8, f8, f8, f8)'], cache=True, nogil=True, parallel=False, locals={
     "z": numba.float64,
     "Glo": numba.float64,
     "erflo": numba.float64,
     "erfmin": numba.float64,
-    "y": numba.float64,
     "zhi": numba.float64,
     "Ghi": numba.float64,
     "erfhi": numba.float64,
-    "m": numba.float64,
-    "b": numba.float64,
 })
 def convolve_gaussian_point(xin, yin, k, n,
                             xo, limit, sigma):
@@ -132,7 +132,8 @@ def convolve_gaussian_point(xin, yin, k, n,
     z = xo - xin[k]
     Glo = exp(-z*z/two_sigma_sq)
     erfmin = erflo = erf(-z/(SQRT2*sigma))
-    y = 0.
+    # /* y, m and b take the type of yin, which may be complex. */
+    y = 0.*yin[k]
     # /* printf("%5.3f: (%5.3f,%11.5g)",xo,xin[k],yin[k]); */
     while (k < n-1):
         k += 1
@@ -174,7 +175,8 @@ def convolve_gaussian_point(xin, yin, k, n,
 # has same performance when using guvectorize instead of njit:
 # @numba.guvectorize("(i8, f8[:], f8[:], i8, f8[:], f8[:], f8[:])", '(),(m),(m),(),(n),(n)->(n)')
 
-@numba.njit("(f8[:], f8[:], f8[:], f8[:], f8[:])", cache=True, parallel=False, locals={
+@numba.njit(["(f8[:], f8[:], f8[:], f8[:], f8[:])",
+             "(f8[:], c16[:], f8[:], f8[:], c16[:])"], cache=True, nogil=True, parallel=False, locals={
     "sigma": numba.float64,
     "xo": numba.float64,
     "limit": numba.float64,
@@ -242,3 +244,168 @@ def convolve_gaussian(xin, yin, x, dx, y):
             # /* Can't happen because there is more than one point in xin. */
             # assert(Nin>1)
             pass
+
+
+@numba.njit('i8(f8[:], i8, i8, f8, f8, f8, i8[:], f8[:])', cache=True, nogil=True, parallel=False, locals={
+    "z": numba.float64,
+    "Glo": numba.float64,
+    "erflo": numba.float64,
+    "erfmin": numba.float64,
+    "zhi": numba.float64,
+    "Ghi": numba.float64,
+    "erfhi": numba.float64,
+    "c": numba.float64,
+    "g": numba.float64,
+    "dxin": numba.float64,
+})
+def convolve_gaussian_point_weights(xin, k, n, xo, limit, sigma, indices, data):
+    # Weights w such that convolve_gaussian_point(xin, yin, ...) is
+    # sum(w*yin[indices]) for any yin.  Each trapezoid in the point
+    # calculation is linear in its end points, so substituting
+    #     m*xo + b = yin[k] + m*(xo - xin[k]),  m = (yin[k]-yin[k-1])/dxin
+    # splits it into a weight on yin[k-1] and a weight on yin[k].
+    # Returns the number of weights, which start at column k.
+    two_sigma_sq = 2. * sigma * sigma
+
+    z = xo - xin[k]
+    Glo = exp(-z*z/two_sigma_sq)
+    erfmin = erflo = erf(-z/(SQRT2*sigma))
+    nnz = 1
+    indices[0] = k
+    data[0] = 0.
+    while (k < n-1):
+        k += 1
+        indices[nnz] = k
+        data[nnz] = 0.
+        if (xin[k] != xin[k-1]):
+            zhi = xo - xin[k]
+            Ghi = exp(-zhi*zhi/two_sigma_sq)
+            erfhi = erf(-zhi/(SQRT2*sigma))
+            dxin = xin[k] - xin[k-1]
+            c = 0.5*(erfhi-erflo)
+            g = (c*zhi - sigma/SQRT2PI*(Ghi-Glo))/dxin
+            data[nnz] += c + g
+            data[nnz-1] -= g
+            Glo = Ghi
+            erflo = erfhi
+        nnz += 1
+        if (xin[k] >= xo+limit):
+            break
+
+    scale = 2. / (erflo - erfmin)
+    for i in range(nnz):
+        data[i] *= scale
+    return nnz
+
+
+@numba.njit('Tuple((i8[:], i8[:], f8[:]))(f8[:], f8[:], f8[:])', cache=True, nogil=True, parallel=False, locals={
+    "sigma": numba.float64,
+    "xo": numba.float64,
+    "limit": numba.float64,
+    "k_in": numba.int64,
+    "k_out": numba.int64,
+})
+def convolve_gaussian_matrix(xin, x, dx):
+    # Compressed sparse row form (indptr, indices, data) of the linear
+    # operator applied by convolve_gaussian(xin, yin, x, dx, y), so that
+    # y = A yin.  The windows are found the same way as convolve_gaussian,
+    # first to size the arrays then to fill them.
+    Nin = len(xin)
+    Nout = len(x)
+
+    # First pass: the number of weights for each output point.
+    indptr = np.zeros(Nout+1, np.int64)
+    k_in = 0
+    for k_out in range(Nout):
+        sigma = dx[k_out]
+        xo = x[k_out]
+        limit = sqrt(-2.*sigma*sigma * LOG_RESLIMIT)
+        while (k_in < Nin-1 and xin[k_in] < xo-limit):
+            k_in += 1
+        while (k_in > 0 and xin[k_in] > xo-limit):
+            k_in -= 1
+        if (sigma > 0.):
+            k = k_in
+            while (k < Nin-1):
+                k += 1
+                if (xin[k] >= xo+limit):
+                    break
+            indptr[k_out+1] = indptr[k_out] + k - k_in + 1
+        elif (Nin > 1):
+            indptr[k_out+1] = indptr[k_out] + 2
+        else:
+            indptr[k_out+1] = indptr[k_out]
+
+    # Second pass: the weights.
+    indices = np.empty(indptr[Nout], np.int64)
+    data = np.empty(indptr[Nout], np.float64)
+    k_in = 0
+    for k_out in range(Nout):
+        sigma = dx[k_out]
+        xo = x[k_out]
+        limit = sqrt(-2.*sigma*sigma * LOG_RESLIMIT)
+        while (k_in < Nin-1 and xin[k_in] < xo-limit):
+            k_in += 1
+        while (k_in > 0 and xin[k_in] > xo-limit):
+            k_in -= 1
+        start = indptr[k_out]
+        if (sigma > 0.):
+            convolve_gaussian_point_weights(
+                xin, k_in, Nin, xo, limit, sigma,
+                indices[start:], data[start:])
+        elif (Nin > 1):
+            # Linear interpolation or extrapolation from the pair of
+            # points used by convolve_gaussian.
+            k = k_in if k_in < Nin-1 else k_in-1
+            t = (xo - xin[k])/(xin[k+1] - xin[k])
+            indices[start], indices[start+1] = k, k+1
+            data[start], data[start+1] = 1. - t, t
+    return indptr, indices, data
+
+
+@numba.njit(["(f8[:], f8[:,:], f8[:], f8[:], f8[:,:])",
+             "(f8[:], c16[:,:], f8[:], f8[:], c16[:,:])"], cache=True, nogil=True, parallel=False, locals={
+    "sigma": numba.float64,
+    "xo": numba.float64,
+    "limit": numba.float64,
+    "k_in": numba.int64,
+    "k_out": numba.int64,
+})
+def convolve_gaussian_columns(xin, yin, x, dx, y):
+    # Same as convolve_gaussian applied to each column of yin[Nin, k],
+    # but with the window and weights for each output point computed once
+    # and shared by all columns.
+    Nin = len(xin)
+    Nout = len(x)
+    ncol = yin.shape[1]
+    indices = np.empty(Nin, np.int64)
+    data = np.empty(Nin, np.float64)
+
+    k_in = 0
+    for k_out in range(Nout):
+        sigma = dx[k_out]
+        xo = x[k_out]
+        limit = sqrt(-2.*sigma*sigma * LOG_RESLIMIT)
+        while (k_in < Nin-1 and xin[k_in] < xo-limit):
+            k_in += 1
+        while (k_in > 0 and xin[k_in] > xo-limit):
+            k_in -= 1
+
+        if (sigma > 0.):
+            nnz = convolve_gaussian_point_weights(
+                xin, k_in, Nin, xo, limit, sigma, indices, data)
+        elif (Nin > 1):
+            # Linear interpolation or extrapolation
+            k = k_in if k_in < Nin-1 else k_in-1
+            t = (xo - xin[k])/(xin[k+1] - xin[k])
+            indices[0], indices[1] = k, k+1
+            data[0], data[1] = 1. - t, t
+            nnz = 2
+        else:
+            nnz = 0
+
+        for j in range(ncol):
+            y[k_out, j] = 0.
+        for i in range(nnz):
+            for j in range(ncol):
+                y[k_out, j] += data[i]*yin[indices[i], j]
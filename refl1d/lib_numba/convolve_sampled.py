@@ -1,7 +1,7 @@
 import numba
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, nogil=True)
 def convolve_point_sampled(Nin, xin, yin, Np, xp, yp, xo, dx, _in):
     # Walk the theory spline and the resolution spline together, computing
     # the integral of the pairs of line segments.  Since the spline knots
@@ -92,7 +92,7 @@ def convolve_point_sampled(Nin, xin, yin, Np, xp, yp, xo, dx, _in):
     return sum/norm
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, nogil=True)
 def convolve_sampled(xin, yin, xp, yp, x, dx, y):
     Nin = len(xin)
     Np = len(xp)
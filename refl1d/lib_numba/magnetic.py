@@ -1,5 +1,6 @@
 import numba
 import sys
+import numpy as np
 from numpy import pi, sin, cos, conj, radians, sqrt, exp, fabs
 
 EPS = sys.float_info.epsilon
@@ -9,7 +10,7 @@ B2SLD = 2.31604654  # Scattering factor for B field 1e-6
 MINIMAL_RHO_M = 1e-2  # in units of 1e-6/A^2
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, nogil=True)
 def calculate_U1_U3_single(H, rhoM, thetaM, Aguide, U1, U3, index):
     # thetaM should be in radians,
     # Aguide in degrees.
@@ -55,7 +56,7 @@ def calculate_U1_U3_single(H, rhoM, thetaM, Aguide, U1, U3, index):
     rhoM[index] = sld_b
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, nogil=True)
 def calculate_u1_u3(H, rhoM, thetaM, Aguide, u1, u3):
     """
     array version - rhoM, thetaM, u1 and u3 are arrays 
@@ -89,7 +90,7 @@ CR4XA_LOCALS.update(("C{i}".format(i=i), numba.complex128)
                     for i in range(1, 5))
 
 
-@numba.njit(CR4XA_SIG, parallel=False, cache=True, locals=CR4XA_LOCALS)
+@numba.njit(CR4XA_SIG, parallel=False, cache=True, nogil=True, locals=CR4XA_LOCALS)
 def Cr4xa(N, D, SIGMA, IP, RHO, IRHO, RHOM, U1, U3, KZ, Y):
     EPS = 1e-10
 
@@ -327,32 +328,317 @@ def Cr4xa(N, D, SIGMA, IP, RHO, IRHO, RHOM, U1, U3, KZ, Y):
     Y[3] = (B23*B42 - B43*B22)/DETW  # --
 
 
-MAGAMP_SIG = 'void(f8[:], f8[:], f8[:], f8[:], f8[:], c16[:], c16[:], f8[:], c16[:,:])'
+MAGAMP_SIG = 'void(f8[:], f8[:], f8[:], f8[:], f8[:], c16[:], c16[:], f8[:], b1[:], c16[:,:])'
 
 
-@numba.njit(MAGAMP_SIG, parallel=False, cache=True)
-def magnetic_amplitude(d, sigma, rho, irho, rhoM, u1, u3, KZ, R):
+@numba.njit(cache=True, nogil=True)
+def _passes(rhoM, XS):
+    """
+    Return the (plus, minus) incident polarization passes needed to compute
+    the cross sections selected by XS.
+    """
+    layers = len(rhoM)
+    if (fabs(rhoM[0]) <= MINIMAL_RHO_M and fabs(rhoM[layers-1]) <= MINIMAL_RHO_M):
+        # calculations for I+ and I- are the same in the fronting and backing,
+        # so the plus pass fills in all the cross sections.
+        return XS[0] or XS[1] or XS[2] or XS[3], False
+    # plus polarization fills in R++, R+-, and minus polarization
+    # fills in R-+, R--.
+    return XS[0] or XS[1], XS[2] or XS[3]
+
+
+@numba.njit(MAGAMP_SIG, parallel=False, cache=True, nogil=True)
+def magnetic_amplitude(d, sigma, rho, irho, rhoM, u1, u3, KZ, XS, R):
     """
     python version of calculation
     implicit returns: Ra, Rb, Rc, Rd
+
+    Only the cross sections selected by XS[4] are computed.
     """
     #assert rho_index is None
     layers = len(d)
     points = len(KZ)
-    if (fabs(rhoM[0]) <= MINIMAL_RHO_M and fabs(rhoM[layers-1]) <= MINIMAL_RHO_M):
-        # calculations for I+ and I- are the same in the fronting and backing.
-        for i in numba.prange(points):
+    plus, minus = _passes(rhoM, XS)
+    # plus polarization must be before minus polarization because it
+    # fills in all R++, R+-, R-+, R--, but minus polarization only fills
+    # in R-+, R--.
+    if plus:
+        for i in range(points):
             Cr4xa(layers, d, sigma, 1.0, rho, irho, rhoM, u1, u3, KZ[i], R[i])
+    if minus:
+        for i in range(points):
+            Cr4xa(layers, d, sigma, -1.0, rho, irho, rhoM, u1, u3, KZ[i], R[i])
+
+
+@numba.njit(cache=True, nogil=True)
+def _cr4xa_layer(L, E0, RHO, IRHO, RHOM, U1, U3):
+    # Wave vectors S1, S3 and spinor coefficients B, G for layer L, with
+    # S1 and S3 swapped if Bz < 0 in the layer.
+    EPS = 1e-10
+    S1 = -sqrt(complex(PI4*(RHO[L]+RHOM[L])-E0, -PI4*(fabs(IRHO[L])+EPS)))
+    S3 = -sqrt(complex(PI4*(RHO[L]-RHOM[L])-E0, -PI4*(fabs(IRHO[L])+EPS)))
+    if (abs(U1[L]) <= 1.0):
+        BL = U1[L]
+        GL = 1.0/U3[L]
     else:
-        # plus polarization must be before minus polarization because it
-        # fills in all R++, R+-, R-+, R--, but minus polarization only fills
-        # in R-+, R--.
-        for i in numba.prange(points):
-            Cr4xa(layers, d, sigma, 1.0, rho, irho, rhoM, u1, u3, KZ[i], R[i])
+        BL = U3[L]
+        GL = 1.0/U1[L]
+        S1, S3 = S3, S1
+    return S1, S3, BL, GL
+
+
+@numba.njit(cache=True, nogil=True)
+def _cr4xa_interface(S1L, S3L, BL, GL, S1LP, S3LP, BLP, GLP, SIGMAL, Z, A):
+    # Interior interface matrix A at depth Z, as computed inline in Cr4xa.
+    DELTA = 0.5 / (1.0 - (BLP*GLP))
+    DBB = (BL - BLP) * DELTA
+    DBG = (1.0 - BL*GLP) * DELTA
+    DGB = (1.0 - GL*BLP) * DELTA
+    DGG = (GL - GLP) * DELTA
+
+    ES1L = exp(S1L*Z)
+    ENS1L = 1.0 / ES1L
+    ES1LP = exp(S1LP*Z)
+    ENS1LP = 1.0 / ES1LP
+    ES3L = exp(S3L*Z)
+    ENS3L = 1.0 / ES3L
+    ES3LP = exp(S3LP*Z)
+    ENS3LP = 1.0 / ES3LP
+
+    FS1S1 = S1L/S1LP
+    FS1S3 = S1L/S3LP
+    FS3S1 = S3L/S1LP
+    FS3S3 = S3L/S3LP
+
+    X = DBG * (1.0 + FS1S1)
+    A[0, 0] = X * ES1L * ENS1LP
+    A[1, 1] = X * ENS1L * ES1LP
+    X = DBG * (1.0 - FS1S1) * exp(2.*S1L*S1LP*SIGMAL*SIGMAL)
+    A[0, 1] = X * ENS1L * ENS1LP
+    A[1, 0] = X * ES1L * ES1LP
+    X = DGG * (1.0 + FS3S1)
+    A[0, 2] = X * ES3L * ENS1LP
+    A[1, 3] = X * ENS3L * ES1LP
+    X = DGG * (1.0 - FS3S1) * exp(2.*S3L*S1LP*SIGMAL*SIGMAL)
+    A[0, 3] = X * ENS3L * ENS1LP
+    A[1, 2] = X * ES3L * ES1LP
+
+    X = DBB * (1.0 + FS1S3)
+    A[2, 0] = X * ES1L * ENS3LP
+    A[3, 1] = X * ENS1L * ES3LP
+    X = DBB * (1.0 - FS1S3) * exp(2.*S1L*S3LP*SIGMAL*SIGMAL)
+    A[2, 1] = X * ENS1L * ENS3LP
+    A[3, 0] = X * ES1L * ES3LP
+    X = DGB * (1.0 + FS3S3)
+    A[2, 2] = X * ES3L * ENS3LP
+    A[3, 3] = X * ENS3L * ES3LP
+    X = DGB * (1.0 - FS3S3) * exp(2.*S3L*S3LP*SIGMAL*SIGMAL)
+    A[2, 3] = X * ENS3L * ENS3LP
+    A[3, 2] = X * ES3L * ES3LP
+
+
+@numba.njit(cache=True, nogil=True)
+def _matmul4(A, B, C, work):
+    # C = A*B for 4x4 matrices; C may alias A or B.
+    for i in range(4):
+        for j in range(4):
+            work[i, j] = (A[i, 0]*B[0, j] + A[i, 1]*B[1, j]
+                          + A[i, 2]*B[2, j] + A[i, 3]*B[3, j])
+    C[:, :] = work
+
+
+CR4XA_REPEAT_SIG = 'void(i8, f8[:], f8[:], f8, f8[:], f8[:], f8[:], c16[:], c16[:], f8, i8[:,:], c16[:,:,::1], c16[:])'
+
+
+@numba.njit(CR4XA_REPEAT_SIG, parallel=False, cache=True, nogil=True)
+def Cr4xa_repeat(N, D, SIGMA, IP, RHO, IRHO, RHOM, U1, U3, KZ, REPEATS, WORK, Y):
+    """
+    Cr4xa with repeated blocks evaluated by matrix power.
 
-        # minus polarization
-        for i in numba.prange(points):
-            Cr4xa(layers, d, sigma, -1.0, rho, irho, rhoM, u1, u3, KZ[i], R[i])
+    Each row of *REPEATS* is (start, length, count) for *count* copies of
+    the *length* layers beginning at *start*, where all but the last copy
+    are identical.  The interface matrices in Cr4xa depend on the absolute
+    depth Z, but shifting a period by its thickness p only conjugates its
+    product U by the diagonal phase matrix E(p) of the first layer in the
+    period, so the first count-1 periods reduce to E^-(n-1) (E U)^(n-1).
+
+    *WORK* is scratch space for five 4x4 matrices, allocated by the caller
+    so that it can be reused for every kz point.
+    """
+    EPS = 1e-10
+
+    if (KZ <= -1.e-10):
+        L = N-1
+        STEP = -1
+        SIGMA_OFFSET = -1
+    elif (KZ >= 1.e-10):
+        L = 0
+        STEP = 1
+        SIGMA_OFFSET = 0
+    else:
+        Y[0] = -1.
+        Y[1] = 0.
+        Y[2] = 0.
+        Y[3] = -1.
+        return
+
+    E0 = KZ*KZ + PI4*(RHO[L]+IP*RHOM[L])
+
+    B, A, U, P, work = WORK[0], WORK[1], WORK[2], WORK[3], WORK[4]
+    for i in range(4):
+        for j in range(4):
+            B[i, j] = 1.0 if i == j else 0.0
+
+    Z = 0.0
+    S1LP = S3LP = BLP = GLP = 0j
+    if (N > 1):
+        LP = L + STEP
+        S1L = -sqrt(complex(PI4*(RHO[L]+RHOM[L]) -
+                    E0, -PI4*(fabs(IRHO[L])+EPS)))
+        S3L = -sqrt(complex(PI4*(RHO[L]-RHOM[L]) -
+                    E0, -PI4*(fabs(IRHO[L])+EPS)))
+        if (abs(U1[L]) > 1.0):
+            S1L, S3L = S3L, S1L
+        S1LP, S3LP, BLP, GLP = _cr4xa_layer(LP, E0, RHO, IRHO, RHOM, U1, U3)
+        SIGMAL = SIGMA[L+SIGMA_OFFSET]
+
+        DELTA = 0.5 / (1.0 - (BLP*GLP))
+
+        FS1S1 = S1L/S1LP
+        FS1S3 = S1L/S3LP
+        FS3S1 = S3L/S1LP
+        FS3S3 = S3L/S3LP
+
+        B[0, 0] = DELTA * 1.0 * (1.0 + FS1S1)
+        B[0, 1] = DELTA * 1.0 * (1.0 - FS1S1) * exp(2.*S1L*S1LP*SIGMAL*SIGMAL)
+        B[0, 2] = DELTA * -GLP * (1.0 + FS3S1)
+        B[0, 3] = DELTA * -GLP * (1.0 - FS3S1) * exp(2.*S3L*S1LP*SIGMAL*SIGMAL)
+
+        B[1, 0] = DELTA * 1.0 * (1.0 - FS1S1) * exp(2.*S1L*S1LP*SIGMAL*SIGMAL)
+        B[1, 1] = DELTA * 1.0 * (1.0 + FS1S1)
+        B[1, 2] = DELTA * -GLP * (1.0 - FS3S1) * exp(2.*S3L*S1LP*SIGMAL*SIGMAL)
+        B[1, 3] = DELTA * -GLP * (1.0 + FS3S1)
+
+        B[2, 0] = DELTA * -BLP * (1.0 + FS1S3)
+        B[2, 1] = DELTA * -BLP * (1.0 - FS1S3) * exp(2.*S1L*S3LP*SIGMAL*SIGMAL)
+        B[2, 2] = DELTA * 1.0 * (1.0 + FS3S3)
+        B[2, 3] = DELTA * 1.0 * (1.0 - FS3S3) * exp(2.*S3L*S3LP*SIGMAL*SIGMAL)
+
+        B[3, 0] = DELTA * -BLP * (1.0 - FS1S3) * exp(2.*S1L*S3LP*SIGMAL*SIGMAL)
+        B[3, 1] = DELTA * -BLP * (1.0 + FS1S3)
+        B[3, 2] = DELTA * 1.0 * (1.0 - FS3S3) * exp(2.*S3L*S3LP*SIGMAL*SIGMAL)
+        B[3, 3] = DELTA * 1.0 * (1.0 + FS3S3)
+
+        Z += D[LP]
+        L = LP
+
+    I = 1
+    while I < N-1:
+        # Check if we are entering a repeated block, from the bottom when
+        # going forward or from the top when going backward.
+        skip = -1
+        for r in range(REPEATS.shape[0]):
+            if REPEATS[r, 2] < 2:
+                continue
+            if STEP > 0:
+                first = REPEATS[r, 0]
+            else:
+                first = REPEATS[r, 0] + REPEATS[r, 1]*REPEATS[r, 2] - 1
+            if first == L:
+                skip = r
+                break
+
+        if skip >= 0:
+            length = REPEATS[skip, 1]
+            power = REPEATS[skip, 2] - 1
+            S1P, S3P = S1LP, S3LP  # wave vectors at the start of the period
+            Zstart = Z
+
+            # Product U of the interface matrices for one period
+            for i in range(4):
+                for j in range(4):
+                    U[i, j] = 1.0 if i == j else 0.0
+            for _ in range(length):
+                LP = L + STEP
+                S1L, S3L, BL, GL = S1LP, S3LP, BLP, GLP
+                S1LP, S3LP, BLP, GLP = _cr4xa_layer(LP, E0, RHO, IRHO, RHOM, U1, U3)
+                _cr4xa_interface(S1L, S3L, BL, GL, S1LP, S3LP, BLP, GLP,
+                                 SIGMA[L+SIGMA_OFFSET], Z, A)
+                _matmul4(A, U, U, work)
+                Z += D[LP]
+                L = LP
+            period = Z - Zstart
+
+            # U <- E U, then P = (E U)^power by repeated squaring
+            for j in range(4):
+                U[0, j] *= exp(S1P*period)
+                U[1, j] *= exp(-S1P*period)
+                U[2, j] *= exp(S3P*period)
+                U[3, j] *= exp(-S3P*period)
+            for i in range(4):
+                for j in range(4):
+                    P[i, j] = 1.0 if i == j else 0.0
+            n = power
+            while n > 0:
+                if n & 1:
+                    _matmul4(U, P, P, work)
+                n >>= 1
+                if n > 0:
+                    _matmul4(U, U, U, work)
+
+            # B <- E^-power P B
+            _matmul4(P, B, B, work)
+            for j in range(4):
+                B[0, j] *= exp(-S1P*period*power)
+                B[1, j] *= exp(S1P*period*power)
+                B[2, j] *= exp(-S3P*period*power)
+                B[3, j] *= exp(S3P*period*power)
+
+            # Jump to the start of the last copy, which starts with the
+            # same layer as the first so the wave vectors are unchanged.
+            Z = Zstart + period*power
+            L += STEP*length*(power - 1)
+            I += length*power
+            continue
+
+        LP = L + STEP
+        S1L, S3L, BL, GL = S1LP, S3LP, BLP, GLP
+        S1LP, S3LP, BLP, GLP = _cr4xa_layer(LP, E0, RHO, IRHO, RHOM, U1, U3)
+        _cr4xa_interface(S1L, S3L, BL, GL, S1LP, S3LP, BLP, GLP,
+                         SIGMA[L+SIGMA_OFFSET], Z, A)
+        _matmul4(A, B, B, work)
+        Z += D[LP]
+        L = LP
+        I += 1
+
+    DETW = B[3, 3]*B[1, 1] - B[1, 3]*B[3, 1]
+
+    if IP > 0:
+        Y[0] = (B[1, 3]*B[3, 0] - B[1, 0]*B[3, 3])/DETW  # ++
+        Y[1] = (B[1, 0]*B[3, 1] - B[3, 0]*B[1, 1])/DETW  # +-
+    Y[2] = (B[1, 3]*B[3, 2] - B[1, 2]*B[3, 3])/DETW  # -+
+    Y[3] = (B[1, 2]*B[3, 1] - B[3, 2]*B[1, 1])/DETW  # --
+
+
+MAGAMP_REPEAT_SIG = 'void(f8[:], f8[:], f8[:], f8[:], f8[:], c16[:], c16[:], f8[:], i8[:,:], b1[:], c16[:,:,:,::1], c16[:,:])'
+
+
+@numba.njit(MAGAMP_REPEAT_SIG, parallel=False, cache=True, nogil=True)
+def magnetic_amplitude_repeat(d, sigma, rho, irho, rhoM, u1, u3, KZ, repeats, XS, WORK, R):
+    """
+    magnetic_amplitude with repeated blocks, using scratch space WORK[0]
+    implicit returns: Ra, Rb, Rc, Rd
+    """
+    layers = len(d)
+    points = len(KZ)
+    plus, minus = _passes(rhoM, XS)
+    work = WORK[0]
+    if plus:
+        for i in range(points):
+            Cr4xa_repeat(layers, d, sigma, 1.0, rho, irho, rhoM, u1, u3, KZ[i], repeats, work, R[i])
+    if minus:
+        for i in range(points):
+            Cr4xa_repeat(layers, d, sigma, -1.0, rho, irho, rhoM, u1, u3, KZ[i], repeats, work, R[i])
 
 
 BASE_GUIDE_ANGLE = 270.0
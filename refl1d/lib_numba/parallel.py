@@ -0,0 +1,110 @@
+"""
+Threaded versions of the reflectivity and magnetic amplitude kernels.
+
+Loading a kernel compiled with parallel=True starts the numba threading
+layer, which must happen on the main thread, or the tbb layer can hang
+the interpreter at exit.  This module is therefore only imported by
+:func:`refl1d.refllib.set_threads` when more than one thread is requested.
+"""
+import numba
+
+from .reflectivity import refl, refl_single, refl_repeat
+from .reflectivity import (REFLAMP_SIG, REFLAMP_SINGLE_SIG, REFLAMP_BATCH_SIG,
+                           REFLAMP_BATCH_SINGLE_SIG, REFLAMP_REPEAT_SIG)
+from .magnetic import Cr4xa, Cr4xa_repeat, _passes
+from .magnetic import MAGAMP_SIG, MAGAMP_REPEAT_SIG
+
+
+@numba.njit(REFLAMP_SIG, parallel=True, cache=True, nogil=True, locals={"offset": numba.int64})
+def reflectivity_amplitude_parallel(depth, sigma, rho, irho, kz, rho_index, r):
+    # // Same as reflectivity_amplitude, but with the kz loop spread across
+    # // the numba thread pool.
+    layers = len(depth)
+    points = len(kz)
+    for i in numba.prange(points):
+        offset = rho_index[i]
+        r[i] = refl(layers, kz[i], depth, sigma, rho[offset], irho[offset])
+
+
+@numba.njit(REFLAMP_SINGLE_SIG, parallel=True, cache=True, nogil=True, locals={"offset": numba.int64})
+def reflectivity_amplitude_single_parallel(depth, sigma, rho, irho, kz, rho_index, r):
+    layers = len(depth)
+    points = len(kz)
+    for i in numba.prange(points):
+        offset = rho_index[i]
+        r[i] = refl_single(layers, kz[i], depth, sigma, rho[offset], irho[offset])
+
+
+@numba.njit(REFLAMP_BATCH_SIG, parallel=True, cache=True, nogil=True,
+            locals={"offset": numba.int64, "member": numba.int64, "point": numba.int64})
+def reflectivity_amplitude_batch_parallel(layers, depth, sigma, rho, irho, kz, rho_index, r):
+    population, points = r.shape
+    for j in numba.prange(population*points):
+        member = j // points
+        point = j - member*points
+        offset = rho_index[point]
+        r[member, point] = refl(layers[member], kz[member, point],
+                                depth[member], sigma[member],
+                                rho[member, offset], irho[member, offset])
+
+
+@numba.njit(REFLAMP_BATCH_SINGLE_SIG, parallel=True, cache=True, nogil=True,
+            locals={"offset": numba.int64, "member": numba.int64, "point": numba.int64})
+def reflectivity_amplitude_batch_single_parallel(layers, depth, sigma, rho, irho, kz, rho_index, r):
+    population, points = r.shape
+    for j in numba.prange(population*points):
+        member = j // points
+        point = j - member*points
+        offset = rho_index[point]
+        r[member, point] = refl_single(layers[member], kz[member, point],
+                                       depth[member], sigma[member],
+                                       rho[member, offset], irho[member, offset])
+
+
+@numba.njit(REFLAMP_REPEAT_SIG, parallel=True, cache=True, nogil=True, locals={"offset": numba.int64})
+def reflectivity_amplitude_repeat_parallel(depth, sigma, rho, irho, kz, rho_index, repeats, r):
+    layers = len(depth)
+    points = len(kz)
+    for i in numba.prange(points):
+        offset = rho_index[i]
+        r[i] = refl_repeat(layers, kz[i], depth, sigma, rho[offset], irho[offset], repeats)
+
+
+@numba.njit(MAGAMP_SIG, parallel=True, cache=True, nogil=True)
+def magnetic_amplitude_parallel(d, sigma, rho, irho, rhoM, u1, u3, KZ, XS, R):
+    """
+    threaded version of magnetic_amplitude
+    implicit returns: Ra, Rb, Rc, Rd
+    """
+    layers = len(d)
+    points = len(KZ)
+    plus, minus = _passes(rhoM, XS)
+    # The minus pass must follow the plus pass for each point; the
+    # passes are fused so that a single parallel loop keeps the order.
+    for i in numba.prange(points):
+        if plus:
+            Cr4xa(layers, d, sigma, 1.0, rho, irho, rhoM, u1, u3, KZ[i], R[i])
+        if minus:
+            Cr4xa(layers, d, sigma, -1.0, rho, irho, rhoM, u1, u3, KZ[i], R[i])
+
+
+@numba.njit(MAGAMP_REPEAT_SIG, parallel=True, cache=True, nogil=True)
+def magnetic_amplitude_repeat_parallel(d, sigma, rho, irho, rhoM, u1, u3, KZ, repeats, XS, WORK, R):
+    """
+    threaded version of magnetic_amplitude_repeat
+    implicit returns: Ra, Rb, Rc, Rd
+
+    Each of the len(WORK) tasks uses its own scratch space WORK[t] for
+    every len(WORK)-th point.
+    """
+    layers = len(d)
+    points = len(KZ)
+    plus, minus = _passes(rhoM, XS)
+    threads = len(WORK)
+    for t in numba.prange(threads):
+        work = WORK[t]
+        for i in range(t, points, threads):
+            if plus:
+                Cr4xa_repeat(layers, d, sigma, 1.0, rho, irho, rhoM, u1, u3, KZ[i], repeats, work, R[i])
+            if minus:
+                Cr4xa_repeat(layers, d, sigma, -1.0, rho, irho, rhoM, u1, u3, KZ[i], repeats, work, R[i])
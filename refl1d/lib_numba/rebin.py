@@ -49,7 +49,7 @@ class BinIter:
         return self
 
 
-@numba.njit(parallel=False, cache=True)
+@numba.njit(parallel=False, cache=True, nogil=True)
 def rebin_counts_portion(Nold, vold, Iold, Nnew, vnew, Inew, ND_portion):
 
     # Note: inspired by rebin from OpenGenie, but using counts per bin
@@ -80,7 +80,7 @@ def rebin_counts_portion(Nold, vold, Iold, Nnew, vnew, Inew, ND_portion):
                 _to.increment()
 
 
-@numba.njit(parallel=False, cache=True)
+@numba.njit(parallel=False, cache=True, nogil=True)
 def rebin_counts_old(Nold, xold, Iold, Nnew, xnew, Inew):
 
     # Note: inspired by rebin from OpenGenie, but using counts per bin
@@ -93,7 +93,7 @@ def rebin_counts_old(Nold, xold, Iold, Nnew, xnew, Inew):
     rebin_counts_portion(Nold, xold, Iold, Nnew, xnew, Inew, 1.)
 
 
-@numba.njit(parallel=False, cache=True)
+@numba.njit(parallel=False, cache=True, nogil=True)
 def rebin_counts(xold, Iold, xnew, Inew):
 
     # Note: inspired by rebin from OpenGenie, but using counts per bin
@@ -107,7 +107,7 @@ def rebin_counts(xold, Iold, xnew, Inew):
     rebin_counts_portion(Nold, xold, Iold, Nnew, xnew, Inew, 1.)
 
 
-@numba.njit(parallel=False, cache=True)
+@numba.njit(parallel=False, cache=True, nogil=True)
 def rebin_intensity(Nold, xold, Iold, dIold, Nnew, xnew, Inew, dInew):
 
     # Note: inspired by rebin from OpenGenie, but using counts per bin rather than rates.
@@ -144,7 +144,7 @@ def rebin_intensity(Nold, xold, Iold, dIold, Nnew, xnew, Inew, dInew):
         dInew[i] = math.sqrt(dInew[i])
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, nogil=True)
 def rebin_counts_2D(xold, yold, Iold, xnew, ynew, Inew):
     Nxold = len(xold) - 1
     Nyold = len(yold) - 1
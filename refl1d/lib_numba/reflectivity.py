@@ -1,4 +1,7 @@
+import math
+
 import numba
+import numpy as np
 from numpy import fabs, sqrt, exp
 
 _REFL_SIG = 'c16(i8, f8, f8[:], f8[:], f8[:], f8[:])'
@@ -22,7 +25,7 @@ _REFL_LOCALS.update(("C{i}".format(i=i), numba.complex128)
                     for i in range(1, 3))
 
 
-@numba.njit(_REFL_SIG, parallel=False, cache=True, locals=_REFL_LOCALS)
+@numba.njit(_REFL_SIG, parallel=False, cache=True, nogil=True, locals=_REFL_LOCALS)
 def refl(layers, kz, depth, sigma, rho, irho):
 
     J = 1j
@@ -81,10 +84,574 @@ def refl(layers, kz, depth, sigma, rho, irho):
 REFLAMP_SIG = 'void(f8[:], f8[:], f8[:,:], f8[:,:], f8[:], i4[:], c16[:])'
 
 
-@numba.njit(REFLAMP_SIG, parallel=False, cache=True, locals={"offset": numba.int64})
+@numba.njit(REFLAMP_SIG, parallel=False, cache=True, nogil=True, locals={"offset": numba.int64})
 def reflectivity_amplitude(depth, sigma, rho, irho, kz, rho_index, r):
     layers = len(depth)
     points = len(kz)
     for i in range(points):
         offset = rho_index[i]
         r[i] = refl(layers, kz[i], depth, sigma, rho[offset], irho[offset])
+
+
+_REFL_SINGLE_SIG = 'c8(i8, f4, f4[:], f4[:], f4[:], f4[:])'
+_REFL_SINGLE_LOCALS = {
+    "cutoff": numba.float32,
+    "next": numba.int64,
+    "sigma_offset": numba.int64,
+    "step": numba.int8,
+    "pi4": numba.float32,
+    "kz_sq": numba.float32,
+    "k": numba.complex64,
+    "k_next": numba.complex64,
+    "k_sum": numba.complex64,
+    "v": numba.complex64,
+    "v_next": numba.complex64,
+    "F": numba.complex64,
+    "J": numba.complex64,
+    "one": numba.complex64,
+}
+_REFL_SINGLE_LOCALS.update(("B{i}{j}".format(i=i, j=j), numba.complex64)
+                           for i in range(1, 3) for j in range(1, 3))
+_REFL_SINGLE_LOCALS.update(("M{i}{j}".format(i=i, j=j), numba.complex64)
+                           for i in range(1, 3) for j in range(1, 3))
+_REFL_SINGLE_LOCALS.update(("C{i}".format(i=i), numba.complex64)
+                           for i in range(1, 3))
+
+
+@numba.njit('c8(c8)', cache=True, nogil=True, locals={"a": numba.float32, "b": numba.float32,
+                                         "t": numba.float32})
+def _sqrt_single(z):
+    # // Principal square root using single precision real arithmetic; numba
+    # // evaluates complex64 sqrt in double precision.
+    a, b = z.real, z.imag
+    t = math.sqrt(np.float32(0.5)*(math.hypot(a, b) + math.fabs(a)))
+    if t == 0:
+        return complex(0, 0)
+    if a >= 0:
+        return complex(t, b/(np.float32(2)*t))
+    return complex(math.fabs(b)/(np.float32(2)*t), math.copysign(t, b))
+
+
+@numba.njit('c8(c8)', cache=True, nogil=True, locals={"e": numba.float32})
+def _exp_single(z):
+    e = math.exp(z.real)
+    return complex(e*math.cos(z.imag), e*math.sin(z.imag))
+
+
+@numba.njit(_REFL_SINGLE_SIG, parallel=False, cache=True, nogil=True, locals=_REFL_SINGLE_LOCALS)
+def refl_single(layers, kz, depth, sigma, rho, irho):
+    # // Single precision version of refl.  The Fresnel coefficient is
+    # // computed as (k^2 - k_next^2)/(k + k_next)^2 using the potential
+    # // step directly rather than (k - k_next)/(k + k_next), which would
+    # // lose most of the digits to cancellation at large kz.
+
+    J = 1j
+
+    cutoff = 1e-10
+    sigma_offset = 0
+    if (kz >= cutoff):
+        next = 0
+        step = 1
+    elif (kz <= -cutoff):
+        next = layers-1
+        step = -1
+        sigma_offset = -1
+    else:
+        return complex(-1, 0)
+
+    one = np.complex64(1)
+    pi4 = 12.566370614359172e-6  # // 1e-6 * 4 pi
+    kz_sq = kz*kz + pi4*rho[next]  # // kz^2 + 4 pi Vrho
+    k = fabs(kz)
+    v = pi4*rho[next]  # // absorption in the incident medium is ignored
+
+    B11 = B22 = 1
+    B12 = B21 = 0
+
+    for i in range(layers-1):
+        v_next = pi4*complex(rho[next+step], irho[next+step])
+        k_next = _sqrt_single(kz_sq - v_next)
+        k_sum = k + k_next
+        F = (v_next - v)/(k_sum*k_sum)*_exp_single(
+            np.float32(-2)*k*k_next*sigma[sigma_offset + next]**2)
+        M11 = _exp_single(J*k*depth[next]) if i > 0 else one
+        M22 = one/M11
+        M21 = F*M11
+        M12 = F*M22
+
+        C1 = B11*M11 + B21*M12
+        C2 = B11*M21 + B21*M22
+        B11 = C1
+        B21 = C2
+        C1 = B12*M11 + B22*M12
+        C2 = B12*M21 + B22*M22
+        B12 = C1
+        B22 = C2
+        next += step
+        k = k_next
+        v = v_next
+
+    return B12/B11
+
+
+REFLAMP_SINGLE_SIG = 'void(f4[:], f4[:], f4[:,:], f4[:,:], f4[:], i4[:], c8[:])'
+
+
+@numba.njit(REFLAMP_SINGLE_SIG, parallel=False, cache=True, nogil=True, locals={"offset": numba.int64})
+def reflectivity_amplitude_single(depth, sigma, rho, irho, kz, rho_index, r):
+    layers = len(depth)
+    points = len(kz)
+    for i in range(points):
+        offset = rho_index[i]
+        r[i] = refl_single(layers, kz[i], depth, sigma, rho[offset], irho[offset])
+
+
+REFLAMP_BATCH_SIG = 'void(i8[:], f8[:,:], f8[:,:], f8[:,:,:], f8[:,:,:], f8[:,:], i4[:], c16[:,:])'
+
+
+@numba.njit(REFLAMP_BATCH_SIG, parallel=False, cache=True, nogil=True,
+            locals={"offset": numba.int64})
+def reflectivity_amplitude_batch(layers, depth, sigma, rho, irho, kz, rho_index, r):
+    # // Population members are stored row-wise, padded to the longest stack;
+    # // layers[p] says how many of the slabs in row p are in use.
+    population, points = r.shape
+    for member in range(population):
+        for point in range(points):
+            offset = rho_index[point]
+            r[member, point] = refl(layers[member], kz[member, point],
+                                    depth[member], sigma[member],
+                                    rho[member, offset], irho[member, offset])
+
+
+REFLAMP_BATCH_SINGLE_SIG = 'void(i8[:], f4[:,:], f4[:,:], f4[:,:,:], f4[:,:,:], f4[:,:], i4[:], c8[:,:])'
+
+
+@numba.njit(REFLAMP_BATCH_SINGLE_SIG, parallel=False, cache=True, nogil=True,
+            locals={"offset": numba.int64})
+def reflectivity_amplitude_batch_single(layers, depth, sigma, rho, irho, kz, rho_index, r):
+    population, points = r.shape
+    for member in range(population):
+        for point in range(points):
+            offset = rho_index[point]
+            r[member, point] = refl_single(layers[member], kz[member, point],
+                                           depth[member], sigma[member],
+                                           rho[member, offset], irho[member, offset])
+
+
+@numba.njit('UniTuple(c16, 4)(c16, c16, c16, c16, c16, c16, c16, c16)', cache=True, nogil=True)
+def _mul2(A11, A12, A21, A22, B11, B12, B21, B22):
+    # // 2x2 matrix product A*B
+    return (A11*B11 + A12*B21, A11*B12 + A12*B22,
+            A21*B11 + A22*B21, A21*B12 + A22*B22)
+
+
+_REFL_REPEAT_SIG = 'c16(i8, f8, f8[:], f8[:], f8[:], f8[:], i8[:,:])'
+_REFL_REPEAT_LOCALS = dict(_REFL_LOCALS)
+_REFL_REPEAT_LOCALS.update({
+    "i": numba.int64,
+    "n": numba.int64,
+    "skip": numba.int64,
+    "power": numba.int64,
+    "k_n": numba.complex128,
+})
+_REFL_REPEAT_LOCALS.update(("{m}{i}{j}".format(m=m, i=i, j=j), numba.complex128)
+                           for m in "UP" for i in range(1, 3) for j in range(1, 3))
+
+
+@numba.njit(_REFL_REPEAT_SIG, parallel=False, cache=True, nogil=True, locals=_REFL_REPEAT_LOCALS)
+def refl_repeat(layers, kz, depth, sigma, rho, irho, repeats):
+    # // Same as refl, but with repeated blocks of slabs evaluated by raising
+    # // the transfer matrix of one period to a power.  Each row of repeats
+    # // is (start, length, count) for count copies of the length slabs
+    # // beginning at start, where all but the last copy are identical,
+    # // including the interface to the following copy.  The last copy is
+    # // evaluated explicitly since it joins to the layer above the block.
+
+    J = 1j
+
+    cutoff = 1e-10
+    sigma_offset = 0
+    if (kz >= cutoff):
+        next = 0
+        step = 1
+    elif (kz <= -cutoff):
+        next = layers-1
+        step = -1
+        sigma_offset = -1
+    else:
+        return complex(-1, 0)
+
+    pi4 = 12.566370614359172e-6  # // 1e-6 * 4 pi
+    kz_sq = kz*kz + pi4*rho[next]  # // kz^2 + 4 pi Vrho
+    k = fabs(kz)
+
+    B11 = B22 = 1
+    B12 = B21 = 0
+
+    i = 0
+    while i < layers-1:
+        # // Check if we are entering a repeated block.  Blocks are entered
+        # // from the bottom when going forward and from the top when going
+        # // backward.
+        skip = 0
+        if i > 0:
+            for r in range(repeats.shape[0]):
+                if repeats[r, 2] < 2:
+                    continue
+                if step > 0:
+                    n = repeats[r, 0]
+                else:
+                    n = repeats[r, 0] + repeats[r, 1]*repeats[r, 2] - 1
+                if n == next:
+                    skip = r+1
+                    break
+        if skip > 0:
+            # // Transfer matrix for one period.
+            U11 = U22 = 1
+            U12 = U21 = 0
+            n = next
+            k_n = k
+            for _ in range(repeats[skip-1, 1]):
+                k_next = sqrt(kz_sq - pi4*complex(rho[n+step], irho[n+step]))
+                F = (k_n-k_next)/(k_n+k_next)*exp(-2.*k_n*k_next * sigma[sigma_offset + n]**2)
+                M11 = exp(J*k_n*depth[n])
+                M22 = exp(-J*k_n*depth[n])
+                M21 = F*M11
+                M12 = F*M22
+                U11, U12, U21, U22 = _mul2(M11, M12, M21, M22, U11, U12, U21, U22)
+                n += step
+                k_n = k_next
+
+            # // B = U^(count-1) B by repeated squaring.
+            power = repeats[skip-1, 2] - 1
+            P11 = P22 = 1
+            P12 = P21 = 0
+            while power > 0:
+                if power & 1:
+                    P11, P12, P21, P22 = _mul2(U11, U12, U21, U22, P11, P12, P21, P22)
+                power >>= 1
+                if power > 0:
+                    U11, U12, U21, U22 = _mul2(U11, U12, U21, U22, U11, U12, U21, U22)
+            B11, B12, B21, B22 = _mul2(P11, P12, P21, P22, B11, B12, B21, B22)
+
+            # // The last copy starts with the same layer as the first, so k
+            # // is unchanged.
+            n = repeats[skip-1, 1]*(repeats[skip-1, 2] - 1)
+            next += step*n
+            i += n
+            continue
+
+        k_next = sqrt(kz_sq - pi4*complex(rho[next+step], irho[next+step]))
+        F = (k-k_next)/(k+k_next)*exp(-2.*k*k_next * sigma[sigma_offset + next]**2)
+        M11 = exp(J*k*depth[next]) if i > 0 else 1.0
+        M22 = exp(-J*k*depth[next]) if i > 0 else 1.0
+        M21 = F*M11
+        M12 = F*M22
+        B11, B12, B21, B22 = _mul2(M11, M12, M21, M22, B11, B12, B21, B22)
+        next += step
+        k = k_next
+        i += 1
+
+    return B12/B11
+
+
+REFLAMP_REPEAT_SIG = 'void(f8[:], f8[:], f8[:,:], f8[:,:], f8[:], i4[:], i8[:,:], c16[:])'
+
+
+@numba.njit(REFLAMP_REPEAT_SIG, parallel=False, cache=True, nogil=True, locals={"offset": numba.int64})
+def reflectivity_amplitude_repeat(depth, sigma, rho, irho, kz, rho_index, repeats, r):
+    layers = len(depth)
+    points = len(kz)
+    for i in range(points):
+        offset = rho_index[i]
+        r[i] = refl_repeat(layers, kz[i], depth, sigma, rho[offset], irho[offset], repeats)
+
+
+_REFL_PREFIX_SIG = 'c16(i8, f8, f8[:], f8[:], f8[:], f8[:], c16[:,:], c16[:,:])'
+
+
+@numba.njit(_REFL_PREFIX_SIG, parallel=False, cache=True, nogil=True, locals=_REFL_LOCALS)
+def refl_prefix(layers, kz, depth, sigma, rho, irho, prefix, suffix):
+    # // Same as refl, but saving the partial products of the transfer
+    # // matrices so that a change to a few layers can be spliced in later
+    # // by refl_splice.  Steps t = 0 .. layers-2 are numbered in the order
+    # // they are applied, so for negative kz step t is at layer layers-1-t.
+    # // On return prefix[t] holds M[t]...M[0] and suffix[t] holds
+    # // M[layers-2]...M[t], each stored as (B11, B12, B21, B22).
+
+    J = 1j
+
+    cutoff = 1e-10
+    sigma_offset = 0
+    if (kz >= cutoff):
+        next = 0
+        step = 1
+    elif (kz <= -cutoff):
+        next = layers-1
+        step = -1
+        sigma_offset = -1
+    else:
+        return complex(-1, 0)
+
+    pi4 = 12.566370614359172e-6  # // 1e-6 * 4 pi
+    kz_sq = kz*kz + pi4*rho[next]  # // kz^2 + 4 pi Vrho
+    k = fabs(kz)
+
+    B11 = B22 = 1
+    B12 = B21 = 0
+
+    for i in range(layers-1):
+        k_next = sqrt(kz_sq - pi4*complex(rho[next+step], irho[next+step]))
+        F = (k-k_next)/(k+k_next)*exp(-2.*k*k_next * sigma[sigma_offset + next]**2)
+        M11 = exp(J*k*depth[next]) if i > 0 else 1.0
+        M22 = exp(-J*k*depth[next]) if i > 0 else 1.0
+        M21 = F*M11
+        M12 = F*M22
+        B11, B12, B21, B22 = _mul2(M11, M12, M21, M22, B11, B12, B21, B22)
+        prefix[i, 0], prefix[i, 1], prefix[i, 2], prefix[i, 3] = B11, B12, B21, B22
+        # // Hold on to the step matrix until the suffix pass.
+        suffix[i, 0], suffix[i, 1], suffix[i, 2], suffix[i, 3] = M11, M12, M21, M22
+        next += step
+        k = k_next
+
+    # // Accumulate the suffix products from the top down, in place.
+    for i in range(layers-3, -1, -1):
+        M11, M12, M21, M22 = suffix[i, 0], suffix[i, 1], suffix[i, 2], suffix[i, 3]
+        suffix[i, 0], suffix[i, 1], suffix[i, 2], suffix[i, 3] = _mul2(
+            suffix[i+1, 0], suffix[i+1, 1], suffix[i+1, 2], suffix[i+1, 3],
+            M11, M12, M21, M22)
+
+    return B12/B11
+
+
+_REFL_SPLICE_SIG = 'c16(i8, f8, f8[:], f8[:], f8[:], f8[:], c16[:,:], c16[:,:], i8, i8)'
+_REFL_SPLICE_LOCALS = dict(_REFL_LOCALS)
+_REFL_SPLICE_LOCALS.update({"first": numba.int64, "last": numba.int64})
+
+
+@numba.njit(_REFL_SPLICE_SIG, parallel=False, cache=True, nogil=True, locals=_REFL_SPLICE_LOCALS)
+def refl_splice(layers, kz, depth, sigma, rho, irho, prefix, suffix, lo, hi):
+    # // Reflectivity after layers lo .. hi have changed, using the partial
+    # // products saved by refl_prefix for the old layers.  Only the steps
+    # // which touch the changed layers are recomputed.  The incident medium
+    # // must be unchanged since its SLD enters every step.
+
+    J = 1j
+    pi4 = 12.566370614359172e-6  # // 1e-6 * 4 pi
+
+    cutoff = 1e-10
+    sigma_offset = 0
+    if (kz >= cutoff):
+        step = 1
+        first = lo - 1
+        last = hi
+        kz_sq = kz*kz + pi4*rho[0]
+    elif (kz <= -cutoff):
+        step = -1
+        sigma_offset = -1
+        first = layers - 2 - hi
+        last = layers - 1 - lo
+        kz_sq = kz*kz + pi4*rho[layers-1]
+    else:
+        return complex(-1, 0)
+    if first < 0:
+        first = 0
+    if last > layers-2:
+        last = layers-2
+
+    next = first if step > 0 else layers-1-first
+    if first > 0:
+        k = sqrt(kz_sq - pi4*complex(rho[next], irho[next]))
+        B11, B12 = prefix[first-1, 0], prefix[first-1, 1]
+        B21, B22 = prefix[first-1, 2], prefix[first-1, 3]
+    else:
+        k = fabs(kz)
+        B11 = B22 = 1
+        B12 = B21 = 0
+
+    for i in range(first, last+1):
+        k_next = sqrt(kz_sq - pi4*complex(rho[next+step], irho[next+step]))
+        F = (k-k_next)/(k+k_next)*exp(-2.*k*k_next * sigma[sigma_offset + next]**2)
+        M11 = exp(J*k*depth[next]) if i > 0 else 1.0
+        M22 = exp(-J*k*depth[next]) if i > 0 else 1.0
+        M21 = F*M11
+        M12 = F*M22
+        B11, B12, B21, B22 = _mul2(M11, M12, M21, M22, B11, B12, B21, B22)
+        next += step
+        k = k_next
+
+    if last < layers-2:
+        B11, B12, B21, B22 = _mul2(
+            suffix[last+1, 0], suffix[last+1, 1], suffix[last+1, 2], suffix[last+1, 3],
+            B11, B12, B21, B22)
+
+    return B12/B11
+
+
+REFLAMP_PREFIX_SIG = 'void(f8[:], f8[:], f8[:,:], f8[:,:], f8[:], i4[:], c16[:,:,:], c16[:,:,:], c16[:])'
+
+
+@numba.njit(REFLAMP_PREFIX_SIG, parallel=False, cache=True, nogil=True, locals={"offset": numba.int64})
+def reflectivity_amplitude_prefix(depth, sigma, rho, irho, kz, rho_index, prefix, suffix, r):
+    layers = len(depth)
+    points = len(kz)
+    for i in range(points):
+        offset = rho_index[i]
+        r[i] = refl_prefix(layers, kz[i], depth, sigma, rho[offset], irho[offset],
+                           prefix[i], suffix[i])
+
+
+REFLAMP_SPLICE_SIG = 'void(f8[:], f8[:], f8[:,:], f8[:,:], f8[:], i4[:], c16[:,:,:], c16[:,:,:], i8, i8, c16[:])'
+
+
+@numba.njit(REFLAMP_SPLICE_SIG, parallel=False, cache=True, nogil=True, locals={"offset": numba.int64})
+def reflectivity_amplitude_splice(depth, sigma, rho, irho, kz, rho_index, prefix, suffix, lo, hi, r):
+    layers = len(depth)
+    points = len(kz)
+    for i in range(points):
+        offset = rho_index[i]
+        r[i] = refl_splice(layers, kz[i], depth, sigma, rho[offset], irho[offset],
+                           prefix[i], suffix[i], lo, hi)
+
+
+@numba.njit('c16(c16, c16, c16, c16, c16, c16, c16, c16, c16, c16, c16, c16, c16)', cache=True, nogil=True)
+def _drow(s1, s2, A11, A12, A21, A22, Q11, Q12, Q21, Q22, r, B11, scale):
+    # // Change in r = B12/B11 when B changes by s*A*Q, where s is the first
+    # // row of the suffix product and Q the prefix product for the step.
+    v1 = s1*A11 + s2*A21
+    v2 = s1*A12 + s2*A22
+    c1 = v1*Q11 + v2*Q21
+    c2 = v1*Q12 + v2*Q22
+    return scale*(c2 - r*c1)/B11
+
+
+_REFL_JAC_SIG = 'c16(i8, f8, f8[:], f8[:], f8[:], f8[:], c16[:,:], c16[:], c16[:,:,:], i8)'
+_REFL_JAC_LOCALS = dict(_REFL_LOCALS)
+_REFL_JAC_LOCALS.update((s, numba.complex128) for s in [
+    "r", "s1", "s2", "f", "g", "E11", "E22", "dF_dk", "dF_dkn", "dF_dsigma",
+    "Q11", "Q12", "Q21", "Q22", "dr_dk", "dr_dkn", "dk", "dkn"])
+_REFL_JAC_LOCALS.update({
+    "n": numba.int64, "incident": numba.int64, "point": numba.int64,
+    "d": numba.float64, "s": numba.float64})
+
+
+@numba.njit(_REFL_JAC_SIG, parallel=False, cache=True, nogil=True, locals=_REFL_JAC_LOCALS)
+def refl_jacobian(layers, kz, depth, sigma, rho, irho, prefix, ks, dr, point):
+    # // Same as refl, but also accumulating the derivatives of r with
+    # // respect to depth, rho, irho and sigma of every layer into
+    # // dr[0:4, :, point].  The forward pass saves the partial products
+    # // M[t]...M[0] for each step t in prefix and the wave vector for each
+    # // step in ks.  The backward pass carries the first row of the suffix
+    # // product M[layers-2]...M[t+1], so that the change in B from the
+    # // derivative of step t is suffix*dM[t]*prefix[t-1].  The incident
+    # // medium enters every step through kz_sq.
+
+    J = 1j
+
+    for c in range(4):
+        for j in range(layers):
+            dr[c, j, point] = 0.
+
+    cutoff = 1e-10
+    sigma_offset = 0
+    if (kz >= cutoff):
+        incident = 0
+        step = 1
+    elif (kz <= -cutoff):
+        incident = layers-1
+        step = -1
+        sigma_offset = -1
+    else:
+        return complex(-1, 0)
+
+    pi4 = 12.566370614359172e-6  # // 1e-6 * 4 pi
+    kz_sq = kz*kz + pi4*rho[incident]  # // kz^2 + 4 pi Vrho
+    k = fabs(kz)
+    ks[0] = k
+
+    B11 = B22 = 1
+    B12 = B21 = 0
+
+    next = incident
+    for i in range(layers-1):
+        k_next = sqrt(kz_sq - pi4*complex(rho[next+step], irho[next+step]))
+        F = (k-k_next)/(k+k_next)*exp(-2.*k*k_next * sigma[sigma_offset + next]**2)
+        M11 = exp(J*k*depth[next]) if i > 0 else 1.0
+        M22 = exp(-J*k*depth[next]) if i > 0 else 1.0
+        M21 = F*M11
+        M12 = F*M22
+        B11, B12, B21, B22 = _mul2(M11, M12, M21, M22, B11, B12, B21, B22)
+        prefix[i, 0], prefix[i, 1], prefix[i, 2], prefix[i, 3] = B11, B12, B21, B22
+        next += step
+        k = k_next
+        ks[i+1] = k
+
+    r = B12/B11
+
+    s1 = 1.
+    s2 = 0.
+    for i in range(layers-2, -1, -1):
+        n = incident + step*i
+        k = ks[i]
+        k_next = ks[i+1]
+        d = depth[n]
+        s = sigma[sigma_offset + n]
+        f = (k-k_next)/(k+k_next)
+        g = exp(-2.*k*k_next*s*s)
+        F = f*g
+        if i > 0:
+            E11 = exp(J*k*d)
+            E22 = exp(-J*k*d)
+            Q11, Q12 = prefix[i-1, 0], prefix[i-1, 1]
+            Q21, Q22 = prefix[i-1, 2], prefix[i-1, 3]
+        else:
+            E11 = E22 = 1.
+            Q11 = Q22 = 1.
+            Q12 = Q21 = 0.
+
+        dF_dk = 2.*k_next/(k+k_next)**2*g - 2.*k_next*s*s*F
+        dF_dkn = -2.*k/(k+k_next)**2*g - 2.*k*s*s*F
+        dF_dsigma = -4.*k*k_next*s*F
+
+        # // dM/dk_next and dM/dsigma only involve F
+        dr_dkn = _drow(s1, s2, 0., dF_dkn*E22, dF_dkn*E11, 0.,
+                       Q11, Q12, Q21, Q22, r, B11, 1.)
+        dr[3, sigma_offset + n, point] += _drow(
+            s1, s2, 0., dF_dsigma*E22, dF_dsigma*E11, 0.,
+            Q11, Q12, Q21, Q22, r, B11, 1.)
+        dkn = -pi4/(2.*k_next)  # // dk_next/drho of the next layer
+        dr[1, n+step, point] += dr_dkn*dkn
+        dr[2, n+step, point] += dr_dkn*dkn*J
+        dr[1, incident, point] -= dr_dkn*dkn
+
+        if i > 0:
+            # // The phase of the layer depends on k and on depth
+            dr_dk = _drow(s1, s2, J*d*E11, dF_dk*E22 - J*d*F*E22,
+                          dF_dk*E11 + J*d*F*E11, -J*d*E22,
+                          Q11, Q12, Q21, Q22, r, B11, 1.)
+            dr[0, n, point] += _drow(s1, s2, E11, -F*E22, F*E11, -E22,
+                                     Q11, Q12, Q21, Q22, r, B11, J*k)
+            dk = -pi4/(2.*k)
+            dr[1, n, point] += dr_dk*dk
+            dr[2, n, point] += dr_dk*dk*J
+            dr[1, incident, point] -= dr_dk*dk
+
+        # // Extend the suffix row by this step.
+        s1, s2 = s1*E11 + s2*F*E11, s1*F*E22 + s2*E22
+
+    return r
+
+
+REFLAMP_JAC_SIG = 'void(f8[:], f8[:], f8[:,:], f8[:,:], f8[:], i4[:], c16[:], c16[:,:,:])'
+
+
+@numba.njit(REFLAMP_JAC_SIG, parallel=False, cache=True, nogil=True, locals={"offset": numba.int64})
+def reflectivity_amplitude_jacobian(depth, sigma, rho, irho, kz, rho_index, r, dr):
+    layers = len(depth)
+    points = len(kz)
+    prefix = np.empty((max(layers-1, 1), 4), np.complex128)
+    ks = np.empty(layers, np.complex128)
+    for i in range(points):
+        offset = rho_index[i]
+        r[i] = refl_jacobian(layers, kz[i], depth, sigma, rho[offset], irho[offset],
+                             prefix, ks, dr, i)
@@ -0,0 +1,30 @@
+import numba
+
+from .reflectivity import refl
+
+REFLECTIVITY_RESOLVED_SIG = 'void(f8[:], f8[:], f8[:,:], f8[:,:], f8[:], i4[:], f8, i8[:], i8[:], f8[:], f8[:])'
+
+
+@numba.njit(REFLECTIVITY_RESOLVED_SIG, parallel=False, cache=True, nogil=True,
+            locals={"offset": numba.int64, "start": numba.int64, "end": numba.int64})
+def reflectivity_resolved(depth, sigma, rho, irho, Q, rho_index, back,
+                          colptr, rows, weights, R):
+    # // Stream the calculation points through amplitude, |r|^2, back
+    # // absorption and resolution.  The resolution operator is stored by
+    # // columns, so each point is added to the measurements it contributes
+    # // to as soon as it is computed, and no array the size of Q is formed.
+    layers = len(depth)
+    for k in range(len(R)):
+        R[k] = 0.
+    for j in range(len(Q)):
+        start, end = colptr[j], colptr[j+1]
+        if start == end:
+            # // Point is outside the resolution window of every measurement.
+            continue
+        offset = rho_index[j]
+        r = refl(layers, -0.5*Q[j], depth, sigma, rho[offset], irho[offset])
+        Rj = r.real*r.real + r.imag*r.imag
+        if Q[j] < 0:
+            Rj *= back
+        for p in range(start, end):
+            R[rows[p]] += weights[p]*Rj
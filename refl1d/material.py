@@ -527,9 +527,9 @@ class Mixture(Scatterer):
 
         # Use calculator to convert individual SLDs to overall SLD
         volume_fraction = self._volume(fraction)
-        rho = np.sum(rho*extend(volume_fraction, rho))
+        rho = np.sum(rho*extend(volume_fraction, rho), axis=0)
 
-        irho = np.sum(irho*extend(volume_fraction, irho))
+        irho = np.sum(irho*extend(volume_fraction, irho), axis=0)
         if self.use_incoherent:
             raise NotImplementedError("incoherent scattering not supported")
         #print "Mixture", self.name, coh, absorp
@@ -559,13 +559,45 @@ class ProbeCache(object):
     or the composition changes. This can be done either by deleting
     an individual material from probe (using del probe[material]) or
     by clearing the entire cash.
+
+    If the probe provides scattering factors for each of its wavelengths
+    (see :meth:`NeutronProbe.wavelength_scattering_factors
+    <refl1d.probe.NeutronProbe.wavelength_scattering_factors>`), the
+    factors are averaged over the wavelength columns set with
+    :meth:`set_columns`.  Until the columns are set, only the first
+    wavelength is used, and the factors for all wavelengths are recorded
+    so that they can be used to choose the columns (see :meth:`sld_table`).
     """
     def __init__(self, probe=None):
         self._probe = probe
         self._cache = {}
+        self._full = {}
+        self._columns = None
 
     def clear(self):
         self._cache = {}
+        self._full = {}
+
+    def set_columns(self, columns):
+        """
+        Average the scattering factors over wavelength columns, where
+        *columns* is the index of the first wavelength in each column, or
+        None to use the first wavelength only.
+        """
+        self._columns = columns
+        self._cache = {}
+
+    def sld_table(self):
+        """
+        Return *rho*, *irho* for the materials looked up so far, with
+        one row per material and one column per probe wavelength, scaled
+        by the density at which each material was first requested.  The
+        table is not updated when the density changes; it is rebuilt
+        after :meth:`clear`.
+        """
+        rho = [np.atleast_1d(sf[0]*density) for sf, density in self._full.values()]
+        irho = [np.atleast_1d(sf[1]*density) for sf, density in self._full.values()]
+        return np.array(rho, 'd'), np.array(irho, 'd')
 
     def __delitem__(self, material):
         if material in self._cache:
@@ -579,10 +611,26 @@ class ProbeCache(object):
         h = id(material)
         if h not in self._cache:
             # lookup density of 1, and scale to actual density on retrieval
-            self._cache[h] = self._probe.scattering_factors(material,
-                                                            density=1.0)
+            lookup = getattr(self._probe, 'wavelength_scattering_factors',
+                             self._probe.scattering_factors)
+            sf = lookup(material, density=1.0)
+            self._full.setdefault(h, (sf, density))
+            self._cache[h] = [_wavelength_columns(v, self._columns) for v in sf]
         return [v*density for v in self._cache[h]]
 
+
+def _wavelength_columns(v, columns):
+    """
+    Average wavelength dependent factors *v* over *columns*, returning a
+    scalar if there is only one column.
+    """
+    if np.ndim(v) == 0:
+        return v
+    if columns is None or len(columns) == 1:
+        return v[0]
+    counts = np.diff(np.hstack((columns, len(v))))
+    return np.add.reduceat(v, columns)/counts
+
 def extend(a, b):
     """
     Extend *a* to match the number of dimensions of *b*.
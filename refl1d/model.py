@@ -69,6 +69,15 @@ class Layer(object): # Abstract base class
     def ismagnetic(self):
         return self._magnetism is not None
 
+    @property
+    def wavelength_resolved(self):
+        """
+        True if the layer renders wavelength dependent SLDs as one column
+        per wavelength (see :meth:`refl1d.material.ProbeCache.set_columns`).
+        Layers which combine the SLD values in other ways expect scalars.
+        """
+        return False
+
     def constraints(self):
         """
         Constraints
@@ -219,6 +228,10 @@ class Stack(Layer):
     def ismagnetic(self):
         return any(p.ismagnetic for p in self._layers)
 
+    @property
+    def wavelength_resolved(self):
+        return all(p.wavelength_resolved for p in self._layers)
+
     def find(self, z):
         """
         Find the layer at depth z.
@@ -338,7 +351,9 @@ class Stack(Layer):
                 magnetism = layer.magnetism
                 #import sys; print >>sys.stderr, "magnetism", magnetism
                 anchor = slabs.thickness() + magnetism.dead_below.value
-                s_below = (nan if i == 0
+                # Magnetism on the substrate has no interface below.  Use
+                # the slab count since a repeated stack also starts at i=0.
+                s_below = (nan if len(slabs) == 0
                            else magnetism.interface_below.value
                            if magnetism.interface_below
                            else slabs.surface_sigma)
@@ -591,6 +606,10 @@ class Repeat(Layer):
     def ismagnetic(self):
         return self.magnetism is not None or self.stack.ismagnetic
 
+    @property
+    def wavelength_resolved(self):
+        return self.stack.wavelength_resolved
+
     def find(self, z):
         """
         Find the layer at depth z.
@@ -710,6 +729,10 @@ class Slab(Layer):
                                      name=name+" interface")
         self.magnetism = magnetism
 
+    @property
+    def wavelength_resolved(self):
+        return True
+
     def parameters(self):
         return {'material': self.material.parameters()}
 
@@ -77,7 +77,76 @@ def get_optimal_single_oversampling(model, tolerance=0.05, max_oversampling=201,
     
     return oversampling, optimal_oversampling, Q
 
-def analyze_fitproblem(problem, tolerance=0.05, max_oversampling=201, plot=False):
+def auto_oversample(model, tolerance=0.05, max_oversampling=201, verbose=False):
+    """
+    Oversample each Q point of the model probe just enough to bring the smeared R within tolerance
+
+    Algorithm:
+      - the per-Q oversampling is found using :func:`get_optimal_single_oversampling`
+      - since neighbouring calculation points contribute to the resolution of each
+        point, the oversampling of each point is raised to that of its neighbours
+      - the per-Q oversampling is applied to the probe, and any point which is not
+        within tolerance of the reference R has its oversampling doubled, until
+        all points are within tolerance
+
+    Args:
+        model (refl1d.experiment.Experiment): an Experiment, containing probe and sample
+        tolerance (float, optional): allowed deviation of R from ideal R (multiplied by dR). Defaults to 0.05
+        max_oversampling (int, optional): oversampling used to generate the reference R. Defaults to 201.
+
+    Returns:
+        optimal_oversampling: for each probe, per-Q array of oversampling applied to the model
+    """
+    probes = model.probe.xs if hasattr(model.probe, 'xs') else [model.probe]
+    model.probe.oversample(max_oversampling)
+    model._cache = {}
+    R_ref = model.reflectivity()
+    if not isinstance(R_ref, list):
+        R_ref = [R_ref]
+
+    _, optimal_oversampling, _ = get_optimal_single_oversampling(
+        model, tolerance, max_oversampling, verbose=verbose)
+    for oos in optimal_oversampling:
+        if oos is not None:
+            padded = np.pad(oos, 1, mode='edge')
+            oos[:] = np.max([padded[:-2], padded[1:-1], padded[2:]], axis=0)
+
+    while True:
+        _apply_oversampling(model.probe, optimal_oversampling)
+        model._cache = {}
+        R = model.reflectivity()
+        if not isinstance(R, list):
+            R = [R]
+        changed = False
+        for oos, p, r, r_ref in zip(optimal_oversampling, probes, R, R_ref):
+            if p is None:
+                continue
+            diff = np.abs(r[1] - r_ref[1])/p.dR
+            to_raise = np.logical_and(diff > tolerance, oos < max_oversampling)
+            oos[to_raise] = np.minimum(2*oos[to_raise], max_oversampling)
+            changed = changed or to_raise.any()
+        if not changed:
+            break
+        if verbose:
+            print("raising oversampling for points outside tolerance", end='\r')
+
+    model._cache = {}
+    return optimal_oversampling
+
+def _apply_oversampling(probe, optimal_oversampling):
+    # polarized probes take one vector per cross section
+    if hasattr(probe, 'xs'):
+        probe.oversample(optimal_oversampling)
+    else:
+        probe.oversample(optimal_oversampling[0])
+
+def analyze_fitproblem(problem, tolerance=0.05, max_oversampling=201, plot=False, adaptive=False):
+    """
+    Report the oversampling needed for each part of each model and apply it to the probes
+
+    If *adaptive* is True then each probe is oversampled point by point with the per-Q
+    oversampling, otherwise the largest value is applied uniformly.
+    """
     if plot:
         from matplotlib import pyplot as plt
     models = problem.models if hasattr(problem, 'models') else [problem]
@@ -109,7 +178,12 @@ def analyze_fitproblem(problem, tolerance=0.05, max_oversampling=201, plot=False
                 
         # there is one probe instance shared between parts in MixedExperiment: use
         # largest recommended oversampling.
-        parts[0].probe.oversample(max(oversampling_i))
+        if adaptive:
+            local = [None if oos[0] is None else np.max(oos, axis=0)
+                     for oos in zip(*local_oversampling_i)]
+            _apply_oversampling(parts[0].probe, local)
+        else:
+            parts[0].probe.oversample(max(oversampling_i))
     
     if plot:
         plt.show()
@@ -134,6 +208,7 @@ def main():
     parser.add_argument('--plot', action='store_true', help='plot optimal oversampling for each probe (default = False)')  
     parser.add_argument('-t', '--tolerance', type=float, default=0.05, help='Tolerance for expression: (R - R_ideal)/dR < tolerance (default=0.05)')
     parser.add_argument('-m', '--max_oversampling', type=int, default=201, help='Max oversampling (also used to calculate R_ideal; default=201)')
+    parser.add_argument('-a', '--adaptive', action='store_true', help='apply per-Q oversampling rather than the maximum (default = False)')
     parser.add_argument('-p', '--pars', type=str, default="", help='retrieve starting point from .par file')
 
     parser.add_argument('modelfile', type=str, nargs=1, help='refl1d model file')
@@ -145,7 +220,7 @@ def main():
     if opts.pars:
         load_best(problem, opts.pars)
     
-    analyze_fitproblem(problem, opts.tolerance, opts.max_oversampling, opts.plot)
+    analyze_fitproblem(problem, opts.tolerance, opts.max_oversampling, opts.plot, opts.adaptive)
 
 
 
@@ -40,6 +40,7 @@ from __future__ import with_statement, division, print_function
 
 import os
 import json
+import bisect
 import warnings
 
 import numpy as np
@@ -57,7 +58,7 @@ from .material import Vacuum
 from .resolution import QL2T, QT2L, TL2Q, dQdL2dT, dQdT2dLoL, dTdL2dQ
 from .resolution import sigma2FWHM, FWHM2sigma, dQ_broadening
 from .stitch import stitch
-from .reflectivity import convolve, BASE_GUIDE_ANGLE
+from .reflectivity import convolve, convolve_matrix, BASE_GUIDE_ANGLE
 from .util import asbytes
 
 PROBE_KW = ('T', 'dT', 'L', 'dL', 'data', 'name', 'filename',
@@ -175,6 +176,8 @@ class Probe(object):
     plot_shift = 0
     residuals_shift = 0
     show_resolution = True
+    _resolution_cache = None
+    _resolution_columns_cache = None
 
     def __init__(self, T=None, dT=0, L=None, dL=0, data=None,
                  intensity=1, background=0, back_absorption=1, theta_offset=0,
@@ -384,7 +387,7 @@ class Probe(object):
 
         # Only keep the scattering factors that you need
         self.unique_L = np.unique(self.calc_L)
-        self._L_idx = np.searchsorted(self.unique_L, L)
+        self._L_idx = np.searchsorted(self.unique_L, self.calc_L)
 
     @property
     def Q(self):
@@ -487,15 +490,30 @@ class Probe(object):
             self.dR = self.dR[idx]
         self._set_calc(self.T, self.L)
 
-    def resolution_guard(self):
+    def resolution_guard(self, n=5, width=3):
         r"""
         Make sure each measured $Q$ point has at least 5 calculated $Q$
         points contributing to it in the range $[-3\Delta Q, 3\Delta Q]$.
 
-        *Not Implemented*
+        *n* is the minimum number of calculation points for each measurement
+        and *width* is the half-width of the range in units of $\Delta Q$.
+
+        The existing calculation points are kept, including those from
+        :meth:`oversample` and :meth:`critical_edge`.  New points are only
+        added for measurements which do not have enough, by splitting the
+        range into *n* cells and putting a point at the center of each cell
+        which is empty, using the wavelength of the measurement.  Since
+        points from overlapping measurements fill each other's cells, the
+        new points are shared rather than duplicated.
+        Unlike :meth:`oversample`, the number of points added depends on
+        the local density of the measurement, which keeps the calculation
+        small when $\Delta Q/Q$ varies across the dataset.
         """
-        raise NotImplementedError
-        # TODO: implement resolution guard.
+        index, Q = _guard_points(self.calc_Qo, self.Qo, self.dQo, n, width)
+        L = self.L[index]
+        T = np.hstack((self.calc_T, QL2T(Q=Q, L=L)))
+        L = np.hstack((self.calc_L, L))
+        self._set_calc(T, L)
 
     def Q_c(self, substrate=None, surface=None):
         Srho, Sirho = (0, 0) if substrate is None else substrate.sld(self)[:2]
@@ -550,7 +568,7 @@ class Probe(object):
         #print Q
         self._set_calc(T, L)
 
-    def oversample(self, n=20, seed=1):
+    def oversample(self, n=20, seed=1, method='random'):
         """
         Generate an over-sampling of Q to avoid aliasing effects.
 
@@ -575,15 +593,36 @@ class Probe(object):
         *n* between 20 and 100 should lead to stable values for the convolved
         reflectivity.
 
+        The value *n* can also be a vector giving the number of points for
+        each measurement in sorted $Q$ order, so that only the regions where
+        the reflectivity varies rapidly need to be sampled heavily.  See
+        :func:`refl1d.oversampling.auto_oversample` for a way to choose it.
+
+        The *method* selects how the points are chosen.  The default
+        'random' uses pseudo-random samples as described above.  The
+        deterministic methods 'gauss' (tensor product Gauss-Hermite nodes
+        in angle and wavelength) and 'sobol' (scrambled Sobol quasi-random
+        sequence) place the points according to the gaussian angular
+        divergence and wavelength dispersion of each measurement.  These
+        fill the resolution function more evenly than random samples, so
+        the convolved reflectivity converges with far fewer points; *n*
+        between 16 and 49 is usually sufficient for thick layers.  For
+        'gauss', *n* is rounded to a square when both *dT* and *dL* are
+        nonzero.  The *seed* is used to scramble the 'sobol' sequence.
+
         Note: :meth:`oversample` will remove the extra Q calculation
         points introduced by :meth:`critical_edge`.
         """
-
-        rng = numpy.random.RandomState(seed=seed)
-        T = rng.normal(self.T[:, None], self.dT[:, None], size=(len(self.dT), n-1))
-        L = rng.normal(self.L[:, None], self.dL[:, None], size=(len(self.dL), n-1))
-        T = np.hstack((self.T, T.flatten()))
-        L = np.hstack((self.L, L.flatten()))
+        if method == 'random':
+            rng = numpy.random.RandomState(seed=seed)
+            index = np.repeat(np.arange(len(self.T)), _oversampling(n, self.T)-1)
+            T = rng.normal(self.T[index], self.dT[index])
+            L = rng.normal(self.L[index], self.dL[index])
+            T = np.hstack((self.T, T))
+            L = np.hstack((self.L, L))
+        else:
+            T, L = _resolution_nodes(
+                self.T, self.dT, self.L, self.dL, n, seed, method)
         self._set_calc(T, L)
 
     def _apply_resolution(self, Qin, Rin, interpolation):
@@ -591,14 +630,52 @@ class Probe(object):
         Apply the instrument resolution function
         """
         Q, dQ = _interpolate_Q(self.Q, self.dQ, interpolation)
-        if np.iscomplex(Rin).any():
-            R_real = convolve(Qin, Rin.real, Q, dQ, resolution=self.resolution)
-            R_imag = convolve(Qin, Rin.imag, Q, dQ, resolution=self.resolution)
-            R = R_real + 1j*R_imag
-        else:
-            R = convolve(Qin, Rin, Q, dQ, resolution=self.resolution)
+        if interpolation == 0 and self.resolution == 'normal':
+            return Q, self._resolution_matrix(Qin, Q, dQ).dot(Rin)
+        R = convolve(Qin, Rin, Q, dQ, resolution=self.resolution)
         return Q, R
 
+    def _resolution_matrix(self, Qin, Q, dQ):
+        """
+        Return the sparse gaussian resolution operator from *Qin* to *Q*.
+
+        The operator only depends on the probe geometry, so it is cached
+        until *theta_offset* or *sample_broadening* change, or the
+        calculation points or measurement points are replaced.
+        """
+        key = self.theta_offset.value, self.sample_broadening.value
+        cache = self._resolution_cache
+        if (cache is None or cache[0] != key
+                or not all(np.array_equal(a, b)
+                           for a, b in zip(cache[1], (Qin, Q, dQ)))):
+            A = convolve_matrix(Qin, Q, dQ)
+            cache = self._resolution_cache = key, (Qin.copy(), Q.copy(), dQ.copy()), A
+        return cache[2]
+
+    def _resolution_columns(self, calc_Q, interpolation=0):
+        """
+        Return the measurement points and the resolution operator from
+        *calc_Q* as compressed columns (indptr, indices, data) in the order
+        of *calc_Q*, or None if the resolution is not applied as a matrix.
+
+        This is the operator used by :meth:`apply_beam` after
+        :meth:`_prepare_beam`, without the back absorption.  See
+        :func:`refl1d.reflectivity.reflectivity_resolved`.
+        """
+        if interpolation != 0 or self.resolution != 'normal':
+            return None
+        Qin = -calc_Q if self.back_reflectivity else calc_Q
+        reverse = Qin[-1] < Qin[0]
+        Q, dQ = _interpolate_Q(self.Q, self.dQ, interpolation)
+        A = self._resolution_matrix(Qin[::-1] if reverse else Qin, Q, dQ)
+        cache = self._resolution_columns_cache
+        if cache is None or cache[0] is not A or cache[1] != reverse:
+            C = (A[:, ::-1] if reverse else A).tocsc()
+            columns = (C.indptr.astype('i8'), C.indices.astype('i8'),
+                       np.ascontiguousarray(C.data, 'd'))
+            cache = self._resolution_columns_cache = A, reverse, (Q, columns)
+        return cache[2]
+
     def apply_beam(self, calc_Q, calc_R, resolution=True, interpolation=0):
         r"""
         Apply factors such as beam intensity, background, backabsorption,
@@ -619,19 +696,16 @@ class Probe(object):
         $|G \ast r|^2 \ne G \ast |r|^2$ for convolution operator $\ast$,
         but it should be close.
         """
-        # Note: in-place vector operations are not notably faster.
+        return self._scale_resolved(self._resolve_beam(
+            calc_Q, calc_R, resolution, interpolation))
 
-        # Handle absorption through the substrate, which occurs when Q<0
-        # (condition)*C is C when condition is True or 0 when False,
-        # (condition)*(C-1)+1 is C when condition is True or 1 when False.
-        back = (calc_Q < 0)*(self.back_absorption.value-1)+1
-        calc_R = calc_R * back
-
-        # For back reflectivity, reverse the sign of Q after computing
-        if self.back_reflectivity:
-            calc_Q = -calc_Q
-        if calc_Q[-1] < calc_Q[0]:
-            calc_Q, calc_R = [v[::-1] for v in (calc_Q, calc_R)]
+    def _resolve_beam(self, calc_Q, calc_R, resolution=True, interpolation=0):
+        """
+        The part of :meth:`apply_beam` before intensity and background are
+        applied.  Returns the Q, R pair to pass to :meth:`_scale_resolved`.
+        """
+        # Note: in-place vector operations are not notably faster.
+        calc_Q, calc_R = self._prepare_beam(calc_Q, calc_R)
         if resolution:
             Q, R = self._apply_resolution(calc_Q, calc_R, interpolation)
         else:
@@ -644,7 +718,39 @@ class Probe(object):
             # if it is a problem before optimizing.
             Q, dQ = _interpolate_Q(self.Q, self.dQ, interpolation)
             Q, R = self.Q, np.interp(Q, calc_Q, calc_R)
-        if np.iscomplex(R).any():
+        #return calc_Q, calc_R
+        return Q, R
+
+    def _scale_resolved(self, resolved):
+        """
+        Apply intensity and background to the result of :meth:`_resolve_beam`.
+        """
+        Q, R = resolved
+        return Q, self._scale_beam(R)
+
+    def _prepare_beam(self, calc_Q, calc_R):
+        """
+        Apply back absorption to the theory and put it in increasing Q
+        order, ready for the resolution calculation.
+        """
+        # Handle absorption through the substrate, which occurs when Q<0
+        # (condition)*C is C when condition is True or 0 when False,
+        # (condition)*(C-1)+1 is C when condition is True or 1 when False.
+        back = (calc_Q < 0)*(self.back_absorption.value-1)+1
+        calc_R = calc_R * back
+
+        # For back reflectivity, reverse the sign of Q after computing
+        if self.back_reflectivity:
+            calc_Q = -calc_Q
+        if calc_Q[-1] < calc_Q[0]:
+            calc_Q, calc_R = [v[::-1] for v in (calc_Q, calc_R)]
+        return calc_Q, calc_R
+
+    def _scale_beam(self, R):
+        """
+        Apply intensity and background to the resolution-smeared theory.
+        """
+        if np.iscomplexobj(R):
             # When R is an amplitude you can scale R by sqrt(A) to reproduce
             # the effect of scaling the intensity in the reflectivity. To
             # reproduce the effect of adding a background you can fiddle the
@@ -662,8 +768,7 @@ class Probe(object):
                 R += 1j*np.sqrt(self.background.value)*R/abs(R)
         else:
             R = self.intensity.value*R + self.background.value
-        #return calc_Q, calc_R
-        return Q, R
+        return R
 
     def fresnel(self, substrate=None, surface=None):
         """
@@ -1007,8 +1112,23 @@ class NeutronProbe(Probe):
 
     By providing a scattering factor calculator for X-ray scattering, model
     components can be defined by mass density and chemical composition.
+
+    The scattering factors are computed at the first wavelength in the
+    probe, or at each wavelength with :meth:`wavelength_scattering_factors`.
+    For the reflectivity calculation, wavelengths are grouped into columns
+    in which the scattering length densities of the materials in the sample
+    vary by less than *sld_tolerance* (in units of |1e-6/Ang^2|), so that
+    absorbing materials such as Gd or Cd in a time-of-flight measurement
+    are computed with the SLD for the wavelength without needing one
+    column per wavelength.  Use *sld_tolerance=None* to use the first
+    wavelength for all points.  The columns are chosen from the material
+    densities when the sample is first rendered, so call
+    :meth:`Experiment.update_composition <refl1d.experiment.Experiment.update_composition>`
+    to choose them again after a large change in the density of an
+    absorbing material.
     """
     radiation = "neutron"
+    sld_tolerance = 0.01
 
     # TODO: remove density from interface since it is always 1.0
     # Density is handled as a scale factor applied to the returned sld
@@ -1016,14 +1136,46 @@ class NeutronProbe(Probe):
     # looking up the sld each time.
     def scattering_factors(self, material, density):
         # doc string is inherited from parent (see below)
-        # TODO: support wavelength dependent systems
         rho, irho, rho_incoh = nsf.neutron_sld(material,
                                                wavelength=self.unique_L[0],
                                                density=density)
-        #print(f"{material}@{density} L={self.unique_L[0]} rho={rho}")
         return rho, irho, rho_incoh
     scattering_factors.__doc__ = Probe.scattering_factors.__doc__
 
+    def wavelength_scattering_factors(self, material, density):
+        """
+        Returns the scattering factors associated with the material at
+        each wavelength in *unique_L*, or as scalars if there is only one.
+        """
+        L = self.unique_L if len(self.unique_L) > 1 else self.unique_L[0]
+        rho, irho, rho_incoh = nsf.neutron_sld(material, wavelength=L,
+                                               density=density)
+        return rho, irho, rho_incoh
+
+    def sld_columns(self, rho, irho):
+        """
+        Group the probe wavelengths into SLD columns.
+
+        *rho*, *irho* are the scattering length densities of the sample
+        materials, with one row per material and one column for each
+        wavelength in *unique_L*.  A new column is started whenever the
+        SLD of any material differs by more than *sld_tolerance* from the
+        SLD at the first wavelength in the current column.
+
+        Returns *columns*, the index of the first wavelength in each column,
+        and *rho_index*, the column for each calculation point.
+        """
+        tolerance = self.sld_tolerance
+        sld = np.vstack((rho, irho))
+        columns = [0]
+        if tolerance is not None:
+            for k in range(1, sld.shape[1]):
+                if np.max(abs(sld[:, k] - sld[:, columns[-1]])) > tolerance:
+                    columns.append(k)
+        columns = np.array(columns, 'i')
+        column = np.searchsorted(columns, np.arange(sld.shape[1]), side='right') - 1
+        return columns, column[self._L_idx].astype('i')
+
 
 class ProbeSet(Probe):
     def __init__(self, probes, name=None):
@@ -1097,6 +1249,11 @@ class ProbeSet(Probe):
             p.oversample(**kw)
     oversample.__doc__ = Probe.oversample.__doc__
 
+    def resolution_guard(self, **kw):
+        for p in self.probes:
+            p.resolution_guard(**kw)
+    resolution_guard.__doc__ = Probe.resolution_guard.__doc__
+
     def scattering_factors(self, material, density):
         # TODO: support wavelength dependent systems
         return self.probes[0].scattering_factors(material, density)
@@ -1105,7 +1262,19 @@ class ProbeSet(Probe):
     scattering_factors.__doc__ = Probe.scattering_factors.__doc__
 
     def apply_beam(self, calc_Q, calc_R, interpolation=0, **kw):
-        result = [p.apply_beam(calc_Q, calc_R, **kw) for p in self.probes]
+        return self._scale_resolved(self._resolve_beam(calc_Q, calc_R, **kw))
+
+    def _resolve_beam(self, calc_Q, calc_R, resolution=True, interpolation=0):
+        # Like apply_beam, interpolation is not supported for probe sets.
+        return [p._resolve_beam(calc_Q, calc_R, resolution)
+                for p in self.probes]
+
+    def _resolution_columns(self, calc_Q, interpolation=0):
+        # Each probe in the set is resolved separately.
+        return None
+
+    def _scale_resolved(self, resolved):
+        result = [p._scale_resolved(v) for p, v in zip(self.probes, resolved)]
         Q, R = [np.hstack(v) for v in zip(*result)]
         return Q, R
 
@@ -1561,13 +1730,27 @@ class QProbe(Probe):
             % (self.filename, material))
     scattering_factors.__doc__ = Probe.scattering_factors.__doc__
 
-    def oversample(self, n=20, seed=1):
-        rng = numpy.random.RandomState(seed=seed)
-        extra = rng.normal(self.Q, self.dQ, size=(n-1, len(self.Q)))
-        calc_Q = np.hstack((self.Q, extra.flatten()))
+    def oversample(self, n=20, seed=1, method='random'):
+        if method == 'random':
+            rng = numpy.random.RandomState(seed=seed)
+            # Draw the samples for all points together, one round at a time.
+            n = _oversampling(n, self.Q)
+            index = np.hstack([np.nonzero(n > k)[0] for k in range(1, n.max())]
+                              + [np.zeros(0, dtype=int)])
+            extra = rng.normal(self.Q[index], self.dQ[index])
+            calc_Q = np.hstack((self.Q, extra))
+        else:
+            # Nodes are placed in Q directly using the 1-sigma dQ.
+            calc_Q, _ = _resolution_nodes(
+                self.Q, sigma2FWHM(self.dQ), self.Q, 0, n, seed, method)
         self.calc_Qo = np.sort(calc_Q)
     oversample.__doc__ = Probe.oversample.__doc__
 
+    def resolution_guard(self, n=5, width=3):
+        _, Q = _guard_points(self.calc_Qo, self.Q, self.dQ, n, width)
+        self.calc_Qo = np.sort(np.hstack((self.calc_Qo, Q)))
+    resolution_guard.__doc__ = Probe.resolution_guard.__doc__
+
     def critical_edge(self, substrate=None, surface=None,
                       n=51, delta=0.25):
         Q_c = self.Q_c(substrate, surface)
@@ -1632,6 +1815,7 @@ class PolarizedNeutronProbe(object):
         self._theta_offsets = None
         self.oversampling = oversampling
         self.oversampling_seed = 1
+        self.oversampling_method = 'random'
 
         if name is None and self.xs[0] is not None:
             name = self.xs[0].name
@@ -1665,6 +1849,13 @@ class PolarizedNeutronProbe(object):
     def mm(self):
         return self.xs[0]
 
+    @property
+    def measured(self):
+        """
+        Flags for the cross sections mm, mp, pm, pp which need to be computed.
+        """
+        return [xsi is not None for xsi in self.xs[:4]]
+
     def parameters(self):
         mm, mp, pm, pp = [(xsi.parameters() if xsi else None)
                           for xsi in self.xs]
@@ -1744,19 +1935,44 @@ class PolarizedNeutronProbe(object):
                 x.theta_offset = theta_offset
                 x.sample_broadening = sample_broadening
 
-    def oversample(self, n=6, seed=1):
-        self._oversample(n, seed)
+    def oversample(self, n=6, seed=1, method='random'):
+        # doc string is inherited from parent (see below)
+        # For polarized data, a vector *n* is a list with one oversampling
+        # vector (or None) for each cross section.
+        self._oversample(n, seed, method)
         self.oversampling = n
         self.oversampling_seed = seed
+        self.oversampling_method = method
 
-    def _oversample(self, n=6, seed=1):
+    def _oversample(self, n=6, seed=1, method='random'):
         # doc string is inherited from parent (see below)
-        rng = numpy.random.RandomState(seed=seed)
-        T = rng.normal(self.T[:, None], self.dT[:, None], size=(len(self.dT), n))
-        L = rng.normal(self.L[:, None], self.dL[:, None], size=(len(self.dL), n))
-        T = T.flatten()
-        L = L.flatten()
+        if not np.isscalar(n):
+            n = self._union_oversampling(n)
+        if method == 'random':
+            rng = numpy.random.RandomState(seed=seed)
+            index = np.repeat(np.arange(len(self.T)), _oversampling(n, self.T))
+            T = rng.normal(self.T[index], self.dT[index])
+            L = rng.normal(self.L[index], self.dL[index])
+        else:
+            T, L = _resolution_nodes(
+                self.T, self.dT, self.L, self.dL, n, seed, method)
         self._set_calc(T, L)
+
+    def _union_oversampling(self, n):
+        """
+        Convert oversampling vectors for the individual cross sections
+        into a vector for the measurement union, using the largest value
+        wherever the cross sections share a point.
+        """
+        counts = {}
+        for x, nx in zip(self.xs, n):
+            if x is None or nx is None:
+                continue
+            keys = zip(x.T+x.theta_offset.value, x.dT, x.L, x.dL, x.dQ)
+            for key, v in zip(keys, _oversampling(nx, x.T)):
+                counts[key] = max(counts.get(key, 1), v)
+        keys = zip(self.T, self.dT, self.L, self.dL, self.dQ)
+        return np.array([counts.get(key, 1) for key in keys], dtype=int)
     _oversample.__doc__ = Probe.oversample.__doc__
 
     def _calculate_union(self):
@@ -1775,7 +1991,8 @@ class PolarizedNeutronProbe(object):
             if self.oversampling is None:
                 self._set_calc(self.T, self.L)
             else:
-                self._oversample(self.oversampling, self.oversampling_seed)
+                self._oversample(self.oversampling, self.oversampling_seed,
+                                 self.oversampling_method)
 
             self._theta_offsets = theta_offsets
 
@@ -1796,15 +2013,56 @@ class PolarizedNeutronProbe(object):
 
         # Only keep the scattering factors that you need
         self.unique_L = np.unique(self.calc_L)
-        self._L_idx = np.searchsorted(self.unique_L, L)
+        self._L_idx = np.searchsorted(self.unique_L, self.calc_L)
 
     def apply_beam(self, Q, R, resolution=True, interpolation=0):
         """
         Apply factors such as beam intensity, background, backabsorption,
         and footprint to the data.
+
+        When the cross sections are measured at the same Q points with the
+        same resolution, the resolution is applied to all of them together
+        so that the convolution weights are only computed once.
+        """
+        return self._scale_resolved(self._resolve_beam(
+            Q, R, resolution, interpolation))
+
+    def _resolve_beam(self, Q, R, resolution=True, interpolation=0):
+        # doc string is inherited from Probe (see below)
+        parts = [(xs, Ri) for xs, Ri in zip(self.xs, R) if xs is not None]
+        if not resolution or not self._shared_resolution(interpolation):
+            return [(xs._resolve_beam(Q, Ri, resolution, interpolation) if xs else None)
+                    for xs, Ri in zip(self.xs, R)]
+
+        prepared = [xs._prepare_beam(Q, Ri) for xs, Ri in parts]
+        calc_Q = prepared[0][0]
+        calc_R = np.column_stack([Ri for _, Ri in prepared])
+        Qo, Ro = parts[0][0]._apply_resolution(calc_Q, calc_R, interpolation)
+        columns = iter(Ro.T)
+        return [((Qo, next(columns)) if xs else None) for xs in self.xs]
+    _resolve_beam.__doc__ = Probe._resolve_beam.__doc__
+
+    def _scale_resolved(self, resolved):
+        return [(xs._scale_resolved(v) if xs else None)
+                for xs, v in zip(self.xs, resolved)]
+    _scale_resolved.__doc__ = Probe._scale_resolved.__doc__
+
+    def _shared_resolution(self, interpolation):
         """
-        return [(xs.apply_beam(Q, Ri, resolution, interpolation) if xs else None)
-                for xs, Ri in zip(self.xs, R)]
+        Return True if all cross sections have the same resolution and
+        the same back reflectivity setting, so that they share calc_Q.
+        """
+        xs = [x for x in self.xs if x is not None]
+        if len(xs) < 2 or any(x.resolution != xs[0].resolution
+                              or x.back_reflectivity != xs[0].back_reflectivity
+                              for x in xs):
+            return False
+        Q, dQ = _interpolate_Q(xs[0].Q, xs[0].dQ, interpolation)
+        for x in xs[1:]:
+            Qx, dQx = _interpolate_Q(x.Q, x.dQ, interpolation)
+            if not (np.array_equal(Q, Qx) and np.array_equal(dQ, dQx)):
+                return False
+        return True
 
     def fresnel(self, *args, **kw):
         return self.pp.fresnel(*args, **kw)
@@ -2140,6 +2398,12 @@ class PolarizedNeutronProbeSumDiff(PolarizedNeutronProbe):
     def df(self):
         return self.xs[5]
 
+    @property
+    def measured(self):
+        # The sum and difference are computed from the mm and pp cross sections.
+        mm, mp, pm, pp, sm, df = [xsi is not None for xsi in self.xs]
+        return [mm or sm or df, mp, pm, pp or sm or df]
+
     @property
     def xs(self):
         return self._xs  # Don't let user replace xs
@@ -2482,6 +2746,91 @@ def _interpolate_Q(Q, dQ, n):
         dQ = np.interp(subindex, index, dQ)
     return Q, dQ
 
+
+def _resolution_nodes(T, dT, L, dL, n, seed, method):
+    """
+    Deterministic sample points for the resolution of each measurement.
+
+    *T*, *L* are the measurement points with FWHM resolution *dT*, *dL*.
+    *method* is 'gauss' for tensor product Gauss-Hermite quadrature or
+    'sobol' for a scrambled Sobol sequence mapped to the normal
+    distribution.  Dimensions with no resolution use a single node.
+    *n* is the number of nodes for each point, either a scalar or a vector.
+
+    Returns the node positions *T*, *L* for all points.
+    """
+    T, L = np.asarray(T, 'd'), np.asarray(L, 'd')
+    dT, dL = np.ones_like(T)*dT, np.ones_like(L)*dL
+    if not np.isscalar(n):
+        n = _oversampling(n, T)
+        parts = [_resolution_nodes(T[n == k], dT[n == k], L[n == k], dL[n == k],
+                                   k, seed, method)
+                 for k in np.unique(n)]
+        return [np.hstack(v) for v in zip(*parts)]
+    sT, sL = FWHM2sigma(dT), FWHM2sigma(dL)
+    active = [np.any(sT > 0), np.any(sL > 0)]
+    dims = max(sum(active), 1)
+    if method == 'gauss':
+        m = max(int(round(n**(1./dims))), 1)
+        x, _ = np.polynomial.hermite_e.hermegauss(m)
+        xT, xL = [x if v else np.zeros(1) for v in active]
+        xT, xL = [v.reshape(1, -1) for v in np.meshgrid(xT, xL, indexing='ij')]
+    elif method == 'sobol':
+        from scipy.stats import qmc
+        from scipy.special import ndtri
+        with warnings.catch_warnings():
+            # Sobol balance is only guaranteed for powers of two.
+            warnings.simplefilter("ignore", UserWarning)
+            u = qmc.Sobol(d=dims, scramble=True, seed=seed).random(n*len(T))
+        x = iter(ndtri(u).reshape(len(T), n, dims).transpose(2, 0, 1))
+        xT, xL = [next(x) if v else np.zeros((len(T), n)) for v in active]
+    else:
+        raise ValueError("unknown oversampling method %r" % method)
+    T = T[:, None] + sT[:, None]*xT
+    L = L[:, None] + sL[:, None]*xL
+    return T.flatten(), L.flatten()
+
+
+def _guard_points(calc_Q, Q, dQ, n, width):
+    """
+    Extra calculation points needed so that each *Q* has at least *n*
+    points of *calc_Q* within *width* times *dQ*.
+
+    Returns the index of the measurement for each new point and the new
+    points, which are not sorted.
+    """
+    points = sorted(calc_Q)
+    index, extra = [], []
+    for k in np.argsort(Q):
+        lo, hi = Q[k] - width*dQ[k], Q[k] + width*dQ[k]
+        count = bisect.bisect_right(points, hi) - bisect.bisect_left(points, lo)
+        if count >= n or dQ[k] <= 0:
+            continue
+        # Split the range into n cells and put a point in the center of
+        # each cell that does not already contain one.
+        step = (hi - lo)/n
+        for q in lo + step*(np.arange(n) + 0.5):
+            at = bisect.bisect_left(points, q)
+            near = points[max(at-1, 0):at+1]
+            if near and min(abs(v - q) for v in near) <= step/2:
+                continue
+            points.insert(at, q)
+            index.append(k)
+            extra.append(q)
+    return np.asarray(index, dtype=int), np.asarray(extra, dtype='d')
+
+
+def _oversampling(n, x):
+    """
+    Return the oversampling *n* as an integer vector matching the points *x*.
+    """
+    n = np.asarray(n, dtype=int)
+    if n.ndim > 0 and n.shape != np.shape(x):
+        raise ValueError("oversampling vector needs %d values, not %d"
+                         % (len(x), len(n)))
+    return np.broadcast_to(n, np.shape(x))
+
+
 class PolarizedQProbe(PolarizedNeutronProbe):
     polarized = True
     def __init__(self, xs=None, name=None, Aguide=BASE_GUIDE_ANGLE, H=0):
@@ -65,6 +65,9 @@ from scipy.special import erf
 
 from .reflectivity import BASE_GUIDE_ANGLE as DEFAULT_THETA_M
 
+# Tolerance used when matching repeated blocks to slab boundaries
+Z_EPS = 1e-6
+
 class Microslabs(object):
     """
     Manage the micro slab representation of a model.
@@ -78,22 +81,39 @@ class Microslabs(object):
     parameter of dz for the step size within the layer.
 
     The space for the slabs is saved even after reset, in preparation for a
-    new set of slabs from different fitting parameters.
+    new set of slabs from different fitting parameters.  Each slab value
+    is stored in its own array, with capacity that doubles as needed, so
+    once the slabs have reached the largest size seen during the fit they
+    are rendered, aligned, converted to step interfaces and contracted in
+    place without allocating new slab storage.  The properties *w*, *sigma*,
+    *rhoM* and *thetaM* are contiguous views, and *rho* and *irho* are
+    views with one contiguous row per wavelength, so they can be passed
+    directly to the compiled kernels.  The layers themselves may still
+    allocate temporaries while rendering.
 
     """
 
     def __init__(self, nprobe, dz=1):
         self._num_slabs = 0
-        # _slabs contains the 1D objects w, sigma of len n
-        # _slabs_rho contains 2D objects rho, irho, with one for each wavelength
-        # rhoM, thetaM will contain magnetic moment and angle
-        self._slabs = np.empty(shape=(0, 2))
-        self._slabs_rho = np.empty(shape=(0, nprobe, 2))
-        self.rhoM = None  # type: np.ndarray
-        self.thetaM = None  # type: np.ndarray
-        self._slabs_mag = np.empty(shape=(0, nprobe, 2))
+        # _w, _sigma are the thickness and interface of each slab
+        # _rho, _irho are [nprobe, capacity], with one row for each wavelength
+        # _mag contains the magnetic moment and angle rows after alignment
+        self._w = np.empty(0)
+        self._sigma = np.empty(0)
+        self._rho = np.empty((nprobe, 0))
+        self._irho = np.empty((nprobe, 0))
+        self._mag = np.empty((2, 0))
+        self._scratch = np.empty((3, 0))
+        self._align_output = np.empty((0, 6))
+        # _steps holds the sample points and the profile input and output
+        # columns for step interfaces, with _ramp = [0, 1, 2, ...]
+        self._steps = np.empty(0)
+        self._ramp = np.empty(0)
+        self._aligned = False
         self.dz = dz
         self._magnetic_sections = []
+        self._repeat_blocks = []
+        self._repeats = None
         self._z_left = self._z_right = 0.
         self._z_offset = 0.
 
@@ -131,6 +151,9 @@ class Microslabs(object):
         """
         self._num_slabs = 0
         self._magnetic_sections = []
+        self._aligned = False
+        self._repeat_blocks = []
+        self._repeats = None
 
     def __len__(self):
         return self._num_slabs
@@ -141,38 +164,75 @@ class Microslabs(object):
         from *start* to the final slab.
 
         This is equivalent to L.extend(L[start:]*(count-1)) for list L.
+
+        The slabs are copied so that the profile is complete, but the block
+        is also remembered so that the reflectivity calculation can raise
+        the transfer matrix of one period to a power rather than stepping
+        through every copy.  See :attr:`repeats`.
         """
-        # For now use the dumb implementation; a better implementation
-        # would remember the repeats and pre-calculate the matrix product
-        # for the repeating region, saving much work later.  This has
-        # to work in conjunction with interfaces and with magnetic profiles.
         repeats = count - 1
         end = len(self)
         length = end - start
-        fromidx = slice(start, end)
-        toidx = slice(end, end + repeats * length)
+        z_start = np.sum(self._w[1:start])
+        period = np.sum(self._w[start:end])
+        if start > 0 and count > 1:
+            if period > Z_EPS:
+                # Repeats nested inside this block are superseded by it.
+                self._repeat_blocks = [b for b in self._repeat_blocks
+                                       if b[0] < z_start - Z_EPS]
+                self._repeat_blocks.append((z_start, period, count))
         self._reserve(repeats * length)
-        self._slabs[toidx] = np.tile(self._slabs[fromidx], [repeats, 1])
-        self._slabs_rho[toidx] = np.tile(self._slabs_rho[fromidx], [repeats, 1, 1])
+        for v in (self._w, self._sigma, self._rho, self._irho):
+            # Splitting the last axis of a slice is always a view.
+            copies = v[..., end:end + repeats * length]
+            copies = copies.reshape(v.shape[:-1] + (repeats, length))
+            copies[...] = v[..., None, start:end]
         self._num_slabs += repeats * length
 
         # Replace interface on the top
-        self._slabs[self._num_slabs - 1, 1] = interface
-
-        if self._magnetic_sections:
-            raise NotImplementedError("Repeated magnetic layers not implemented")
+        top_sigma = self._sigma[self._num_slabs - 1]
+        self._sigma[self._num_slabs - 1] = interface
+
+        # Copy the magnetic sections anchored within the block.  The blocks
+        # are copied since joining the sections may modify them in place.
+        # Magnetic interfaces default to the nuclear interface, so a section
+        # at the bottom of the block that took its interface from the slab
+        # below the block uses the top of the previous copy instead, and
+        # a section at the top of the final copy uses the new top interface.
+        first = len(self._magnetic_sections)
+        while (first > 0
+               and self._magnetic_sections[first - 1][1] >= z_start - Z_EPS):
+            first -= 1
+        sections = self._magnetic_sections[first:]
+        del self._magnetic_sections[first:]
+        below_sigma = self._sigma[start - 1] if start > 0 else nan
+        for k in range(count):
+            for B, anchor, (s_below, s_above) in sections:
+                if (k > 0 and abs(anchor - z_start) < Z_EPS
+                        and s_below == below_sigma):
+                    s_below = top_sigma
+                end_gap = z_start + period - anchor - np.sum(B[0])
+                if (k == count - 1 and abs(end_gap) < Z_EPS
+                        and s_above == top_sigma):
+                    s_above = interface
+                self._magnetic_sections.append(
+                    (B.copy() if k > 0 else B, anchor + k*period,
+                     (s_below, s_above)))
 
     def _reserve(self, nadd):
         """
         Reserve space for at least *nadd* slabs.
         """
-        ns, nl, _ = self._slabs_rho.shape
-        if ns < self._num_slabs + nadd:
-            new_ns = self._num_slabs + nadd + 50
-            self._slabs = self._slabs.copy()
-            self._slabs.resize((new_ns, 4), refcheck=False)
-            self._slabs_rho = self._slabs_rho.copy()
-            self._slabs_rho.resize((new_ns, nl, 2), refcheck=False)
+        need = self._num_slabs + nadd
+        capacity = len(self._w)
+        if capacity < need:
+            capacity = max(need, 2*capacity, 64)
+            n = self._num_slabs
+            for name in ('_w', '_sigma', '_rho', '_irho', '_mag', '_scratch'):
+                old = getattr(self, name)
+                new = np.empty(old.shape[:-1] + (capacity,))
+                new[..., :n] = old[..., :n]
+                setattr(self, name, new)
 
     def extend(self, w=0, sigma=0, rho=0, irho=0):
         """
@@ -182,10 +242,10 @@ class Microslabs(object):
         self._reserve(nadd)
         idx = slice(self._num_slabs, self._num_slabs + nadd)
         self._num_slabs += nadd
-        self._slabs[idx, 0] = w
-        self._slabs[idx, 1] = sigma
-        self._slabs_rho[idx, :, 0] = np.asarray(rho).T
-        self._slabs_rho[idx, :, 1] = np.asarray(irho).T
+        self._w[idx] = w
+        self._sigma[idx] = sigma
+        self._rho[:, idx] = rho
+        self._irho[:, idx] = irho
 
     def append(self, w=0, sigma=0, rho=0, irho=0):
         """
@@ -194,10 +254,11 @@ class Microslabs(object):
         #self.extend(w=[w], sigma=[sigma], rho=[rho], irho=[irho])
         #return
         self._reserve(1)
-        self._slabs[self._num_slabs, 0] = w
-        self._slabs[self._num_slabs, 1] = sigma
-        self._slabs_rho[self._num_slabs, :, 0] = rho
-        self._slabs_rho[self._num_slabs, :, 1] = irho
+        n = self._num_slabs
+        self._w[n] = w
+        self._sigma[n] = sigma
+        self._rho[:, n] = rho
+        self._irho[:, n] = irho
         self._num_slabs += 1
 
     def add_magnetism(self, anchor, w, rhoM=0, thetaM=DEFAULT_THETA_M, sigma=0):
@@ -222,38 +283,60 @@ class Microslabs(object):
         surface layers.  Normally these will be zero, but the contract
         profile operation may result in large values for either.
         """
-        return np.sum(self._slabs[1:self._num_slabs, 0])
+        return np.sum(self._w[1:self._num_slabs])
 
     @property
     def w(self):
         "Thickness (A)"
-        return self._slabs[:self._num_slabs, 0]
+        return self._w[:self._num_slabs]
 
     @property
     def sigma(self):
         "rms roughness (A)"
-        return self._slabs[:self._num_slabs - 1, 1]
+        return self._sigma[:self._num_slabs - 1]
 
     @property
     def surface_sigma(self):
         "roughness for the current top layer, or nan if substrate"
-        return self._slabs[self._num_slabs - 1, 1] if self._num_slabs > 0 else nan
+        return self._sigma[self._num_slabs - 1] if self._num_slabs > 0 else nan
 
     @property
     def rho(self):
         "Scattering length density (10^-6 number density)"
-        return self._slabs_rho[:self._num_slabs, :, 0].T
+        return self._rho[:, :self._num_slabs]
 
     @property
     def irho(self):
         "Absorption (10^-6 number density)"
-        return self._slabs_rho[:self._num_slabs, :, 1].T
+        return self._irho[:, :self._num_slabs]
+
+    @property
+    def rhoM(self):
+        "Magnetic scattering length density (10^-6 number density)"
+        return self._mag[0, :self._num_slabs] if self._aligned else None
+
+    @property
+    def thetaM(self):
+        "Magnetic angle (degrees)"
+        return self._mag[1, :self._num_slabs] if self._aligned else None
 
     @property
     def ismagnetic(self):
         "True if there are magnetic materials in any slab"
         return self._magnetic_sections != []
 
+    @property
+    def repeats(self):
+        """
+        Repeated blocks in the finalized profile as an integer array of
+        (start, length, count), or None if there are no repeated blocks.
+
+        All but the last of the *count* copies of the *length* slabs
+        beginning at *start* are identical, including the interface to
+        the following copy.
+        """
+        return self._repeats
+
     def limited_sigma(self, limit=0):
         """
         Limit the roughness by some fraction of layer thickness.
@@ -311,14 +394,58 @@ class Microslabs(object):
         else:
             self._contract_profile(dA)
 
+        self._resolve_repeats()
+
+    def _resolve_repeats(self):
+        """
+        Locate the repeated blocks in the finalized profile.
+
+        Blocks are recorded by depth during rendering, and may no longer
+        correspond to periodic slabs after the profile is aligned with the
+        magnetism, converted to step interfaces or contracted.  Only those
+        blocks which are still periodic are kept.
+        """
+        self._repeats = None
+        n = self._num_slabs
+        if not self._repeat_blocks or n < 3:
+            return
+
+        # Depth of the bottom of slabs 1 .. n-1
+        bottom = np.cumsum(np.hstack((0., self.w[1:n-1])))
+        columns = [self.w, self.sigma, self.rho, self.irho]
+        if self.ismagnetic:
+            columns.extend((self.rhoM, self.thetaM))
+        repeats = []
+        for z_start, period, count in self._repeat_blocks:
+            z = z_start + period*np.arange(count+1)
+            index = np.searchsorted(bottom, z - Z_EPS)
+            if index[-1] >= len(bottom) or (abs(bottom[index] - z) > Z_EPS).any():
+                continue
+            length = np.diff(index)
+            if length[0] == 0 or (length != length[0]).any():
+                continue
+            start, length = index[0] + 1, length[0]
+            span = slice(start, start + (count-1)*length)
+            periodic = all(
+                np.allclose(v[..., span].reshape(v.shape[:-1] + (count-1, length)),
+                            v[..., None, start:start+length],
+                            rtol=1e-10, atol=1e-10)
+                for v in columns)
+            if periodic:
+                repeats.append((start, length, count))
+        if repeats:
+            self._repeats = np.array(repeats, 'i8')
+
     def _set_z_range(self):
         """
         Make sure z-range includes 3-sigma around every interface.
         """
         self.w[0] = self.w[-1] = 0
-        offset = np.cumsum(self.w[:-1])
-        self._z_left = min(-10, np.min(offset - 3*self.sigma))
-        self._z_right = max(offset[-1]+10, np.max(offset + 3*self.sigma))
+        offset, spread, edge = self._scratch[:, :self._num_slabs - 1]
+        np.cumsum(self.w[:-1], out=offset)
+        np.multiply(self.sigma, 3, out=spread)
+        self._z_left = min(-10, np.subtract(offset, spread, out=edge).min())
+        self._z_right = max(offset[-1]+10, np.add(offset, spread, out=edge).max())
 
     def _align_magnetic_and_nuclear(self):
         """
@@ -335,23 +462,26 @@ class Microslabs(object):
         # Fill in gaps for magnetic profile
         wM, sigmaM, rhoM, thetaM = self._join_magnetic_sections(gap_size=1e-6)
 
-        # Align nuclear and magnetic
-        w, sigma, rho, irho, wM, sigmaM, rhoM, thetaM = [
-            np.ascontiguousarray(v, 'd')
-            for v in (w, sigma, rho, irho, wM, sigmaM, rhoM, thetaM)
-            ]
-        output = np.empty((len(w)+len(wM), 6), 'd')
+        # Align nuclear and magnetic; the nuclear slabs are already
+        # contiguous views so only the magnetic sections are converted.
+        wM, sigmaM, rhoM, thetaM = [
+            np.ascontiguousarray(v, 'd') for v in (wM, sigmaM, rhoM, thetaM)]
+        size = len(w) + len(wM)
+        if len(self._align_output) < size:
+            self._align_output = np.empty((max(size, 2*len(self._align_output)), 6))
+        output = self._align_output[:size]
         n = align_magnetic(w, sigma, rho, irho, wM, sigmaM, rhoM, thetaM, output)
 
         # Store the resulting profile
         self._reserve(n - self._num_slabs)  # make sure there is space
         self._num_slabs = n
+        self._aligned = True
         self.w[:] = output[:n, 0]
         self.sigma[:] = output[:n-1, 1]
         self.rho[0][:] = output[:n, 2]
         self.irho[0][:] = output[:n, 3]
-        self.rhoM = output[:n, 4]
-        self.thetaM = output[:n, 5]
+        self.rhoM[:] = output[:n, 4]
+        self.thetaM[:] = output[:n, 5]
 
     def _render_interfaces(self):
         """
@@ -364,61 +494,68 @@ class Microslabs(object):
         better performance on models with large sections of constant
         scattering potential.
         """
-        z = np.arange(self._z_left, self._z_right + 0.5*self.dz, self.dz)
-        n_slabs = len(z)
+        from .refllib import build_profile as _build_profile
+
+        # Same points as arange(z_left, z_right + dz/2, dz).
+        n_slabs = int(np.ceil((self._z_right + 0.5*self.dz - self._z_left)
+                              / self.dz))
+        n = self._num_slabs
         n_profiles = self.rho.shape[0]
-        offsets = np.cumsum(self.w[:-1])  # assumes w[0] == 0 in _set_z_range
-
-        # generate profiles
-        rho = np.empty((n_profiles, n_slabs), 'd')
-        irho = np.empty((n_profiles, n_slabs), 'd')
-        for k in range(n_profiles):
-            # Gd support: cycle through wavelength dependent rho/irho
-            rho[k] = build_profile(z, offsets, self.sigma, self.rho[k])
-            irho[k] = build_profile(z, offsets, self.sigma, self.irho[k])
+        n_columns = 2*n_profiles + (2 if self.ismagnetic else 0)
+
+        # Carve the sample points and the profile columns out of the
+        # step buffer, which grows like the slab storage.
+        need = n_slabs + n_columns*(n + n_slabs)
+        if len(self._steps) < need:
+            self._steps = np.empty(max(need, 2*len(self._steps)))
+        if len(self._ramp) < n_slabs:
+            self._ramp = np.arange(max(n_slabs, 2*len(self._ramp)), dtype='d')
+        z = self._steps[:n_slabs]
+        values = self._steps[n_slabs:n_slabs + n_columns*n]
+        values = values.reshape(n_columns, n)
+        profiles = self._steps[n_slabs + n_columns*n:need]
+        profiles = profiles.reshape(n_columns, n_slabs)
+        np.multiply(self._ramp[:n_slabs], self.dz, out=z)
+        z += self._z_left
+
+        # generate profiles for all wavelengths and magnetism in one pass
+        offsets = self._scratch[0, :n - 1]
+        np.cumsum(self.w[:-1], out=offsets)  # assumes w[0] == 0 in _set_z_range
+        values[:n_profiles] = self.rho
+        values[n_profiles:2*n_profiles] = self.irho
         if self.ismagnetic:
-            rhoM = build_profile(z, offsets, self.sigma, self.rhoM)
-            thetaM = build_profile(z, offsets, self.sigma, self.thetaM)
-
-        w = self.dz * np.ones(n_slabs)
-        w[0] = w[-1] = 0.
+            values[-2] = self.rhoM
+            values[-1] = self.thetaM
+        _build_profile(z, offsets, self.sigma, values, profiles)
 
         # update slabs
         self._reserve(n_slabs - self._num_slabs)
         self._num_slabs = n_slabs
-        self.w[:] = w
+        self.w[:] = self.dz
+        self.w[0] = self.w[-1] = 0.
         self.sigma[:] = 0
-        self.rho[:,:] = rho
-        self.irho[:,:] = irho
+        self.rho[:, :] = profiles[:n_profiles]
+        self.irho[:, :] = profiles[n_profiles:2*n_profiles]
         if self.ismagnetic:
-            self.rhoM = rhoM
-            self.thetaM = thetaM
+            self.rhoM[:] = profiles[-2]
+            self.thetaM[:] = profiles[-1]
         self._z_offset = self._z_left
 
     def _contract_profile(self, dA):
-        from .refllib import contract_by_area
+        from .refllib import contract_by_area, contract_by_area_columns
 
         if dA is None:
             return
 
-        # TODO: need a separate implementation for multiple wavelengths
+        # Contract in place on the slab views.  With multiple wavelengths
+        # the slabs are merged only if they satisfy dA for every column.
         if self.rho.shape[0] > 1:
-            # Note: should at least check for duplicates otherwise thick
-            # layers will get extremely slow
-            return
-
-        w, sigma, rho, irho = [
-            np.ascontiguousarray(v, 'd')
-            for v in (self.w, self.sigma, self.rho[0], self.irho[0])
-            ]
-        #print "final sld before contract", rho[-1]
-        n = contract_by_area(w, sigma, rho, irho, dA)
+            n = contract_by_area_columns(self.w, self.sigma, self.rho,
+                                         self.irho, float(dA))
+        else:
+            n = contract_by_area(self.w, self.sigma, self.rho[0],
+                                 self.irho[0], float(dA))
         self._num_slabs = n
-        self.w[:] = w[:n]
-        self.rho[0, :] = rho[:n]
-        self.irho[0, :] = irho[:n]
-        self.sigma[:] = sigma[:n-1]
-        #print "final sld after contract", rho[n-1], self.rho[0][n-1], n
 
     def _contract_magnetic(self, dA):
         from .refllib import contract_mag
@@ -426,26 +563,15 @@ class Microslabs(object):
         if dA is None:
             return
 
-        # TODO: need a separate implementation for multiple wavelengths
+        # Alignment only carries the first wavelength column, so magnetic
+        # profiles with multiple wavelengths are not contracted.
         if self.rho.shape[0] > 1:
-            # Note: should at least check for duplicates otherwise thick
-            # layers will get extremely slow
             return
 
-        w, sigma, rho, irho, rhoM, thetaM = \
-            [np.ascontiguousarray(v, 'd')
-             for v in (self.w, self.sigma, self.rho[0], self.irho[0], self.rhoM, self.thetaM)]
-        #print "final sld before contract", rho[-1]
-        n = contract_mag(w, sigma, rho, irho, rhoM, thetaM, dA)
+        # Contract in place on the contiguous slab views.
+        n = contract_mag(self.w, self.sigma, self.rho[0], self.irho[0],
+                         self.rhoM, self.thetaM, float(dA))
         self._num_slabs = n
-        self.w[:] = w[:n]
-        self.rho[0][:] = rho[:n]
-        self.irho[0][:] = irho[:n]
-        self.rhoM = rhoM[:n]
-        self.thetaM = thetaM[:n]
-        self.sigma[:] = sigma[:n-1]
-        #self.sigma[:] = 0
-        #print "final sld after contract", rho[n-1], self.rho[0][n-1], n
 
     def _DEAD_apply_smoothness(self, dA, smoothness=0.3):
         """
@@ -515,8 +641,8 @@ class Microslabs(object):
         """
         z = np.arange(self._z_left, self._z_right + 0.5*dz, dz)
         offsets = np.cumsum(self.w) + self._z_offset
-        irho = build_profile(z, offsets, self.sigma, self.irho[0])
-        rho = build_profile(z, offsets, self.sigma, self.rho[0])
+        rho, irho = build_profile(z, offsets, self.sigma,
+                                  [self.rho[0], self.irho[0]])
         return z, rho, irho
 
     def magnetic_smooth_profile(self, dz=0.1):
@@ -525,10 +651,9 @@ class Microslabs(object):
         """
         z = np.arange(self._z_left, self._z_right + 0.5*dz, dz)
         offsets = np.cumsum(self.w) + self._z_offset
-        irho = build_profile(z, offsets, self.sigma, self.irho[0])
-        rho = build_profile(z, offsets, self.sigma, self.rho[0])
-        rhoM = build_profile(z, offsets, self.sigma, self.rhoM)
-        thetaM = build_profile(z, offsets, self.sigma, self.thetaM)
+        rho, irho, rhoM, thetaM = build_profile(
+            z, offsets, self.sigma,
+            [self.rho[0], self.irho[0], self.rhoM, self.thetaM])
         return z, rho, irho, rhoM, thetaM
 
     def _join_magnetic_sections(self, gap_size):
@@ -616,18 +741,30 @@ def build_profile(z, offset, roughness, value):
     """
     Convert a step profile to a smooth profile.
 
-    *z*          calculation points
+    *z*          calculation points, in increasing order
     *offset*     offset for each interface
     *roughness*  roughness of each interface
-    *value*      target value for each slab
+    *value*      target value for each slab, or a matrix with one row
+                 of slab values for each profile
     *max_rough*  limit the roughness to a fraction of the layer thickness
+
+    The profile starts as steps at the interfaces, and the error function
+    is only evaluated within 8 sigma of each rough interface, so the cost
+    is proportional to the number of points plus the width of the
+    interfaces rather than the number of points times the number of
+    interfaces.  All rows of *value* are computed in the same pass.
     """
-    contrast = np.diff(value)
-    result = np.zeros_like(z) + value[0]
-    for offset_k, sigma_k, contrast_k in zip(offset, roughness, contrast):
-        delta = contrast_k * blend(z, sigma_k, offset_k)
-        result += delta
-    return result
+    from .refllib import build_profile as _build_profile
+
+    value = np.asarray(value, 'd')
+    values = np.ascontiguousarray(np.atleast_2d(value))
+    z = np.ascontiguousarray(z, 'd')
+    n = min(len(offset), len(roughness), values.shape[1]-1)
+    offset = np.ascontiguousarray(offset[:n], 'd')
+    roughness = np.ascontiguousarray(roughness[:n], 'd')
+    result = np.empty((values.shape[0], len(z)))
+    _build_profile(z, offset, roughness, values, result)
+    return result if value.ndim > 1 else result[0]
 
 
 SQRT1_2 = 1. / np.sqrt(2.0)
@@ -644,3 +781,73 @@ def blend(z, sigma, offset):
         return 1.0 * (z >= offset)
     else:
         return 0.5 * erf(SQRT1_2 * (z - offset) / sigma) + 0.5
+
+
+def test_slab_arena():
+    import tracemalloc
+
+    # Steady state rendering reuses the slab storage.
+    for step_interfaces, sigma, size in ((False, 0., 51), (True, 2., 274)):
+        slabs = Microslabs(1, dz=1)
+
+        def render():
+            slabs.clear()
+            for k in range(500):
+                slabs.append(w=10., sigma=sigma, rho=float(k//10 % 5), irho=0.)
+            slabs.finalize(step_interfaces=step_interfaces, dA=1)
+
+        render()
+        storage = slabs._w, slabs._sigma, slabs._rho, slabs._irho
+        tracemalloc.start()
+        try:
+            render()
+            render()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert len(slabs) == size
+        assert all(a is b for a, b in zip(
+            storage, (slabs._w, slabs._sigma, slabs._rho, slabs._irho)))
+        # A copy of any one of the slab arrays would be 4000 bytes.
+        assert peak < 4000
+        assert slabs.w.flags.c_contiguous
+        assert slabs.rho.flags.c_contiguous
+
+
+def test_build_profile():
+    # Banded interface rendering matches the full erf sum.
+    rng = np.random.RandomState(3)
+    w = rng.uniform(0, 20, 50)
+    sigma = rng.uniform(0, 5, 49)
+    sigma[::7] = 0
+    values = rng.uniform(-1, 8, (3, 50))
+    offsets = np.cumsum(w[:-1])
+    z = np.arange(-30, offsets[-1] + 30, 0.5)
+    expected = np.array([
+        v[0] + sum((v[k+1] - v[k])*blend(z, sigma[k], offsets[k])
+                   for k in range(49))
+        for v in values])
+    assert np.abs(build_profile(z, offsets, sigma, values) - expected).max() < 1e-12
+    assert np.abs(build_profile(z, offsets, sigma, values[0]) - expected[0]).max() < 1e-12
+
+
+def test_contract_columns():
+    # Multiple wavelength contraction uses the worst column.
+    rng = np.random.RandomState(5)
+    w = np.hstack((0, rng.uniform(0.5, 2, 200), 0))
+    rho = np.cumsum(rng.normal(0, 0.1, 202))
+
+    def contract(columns, dA):
+        slabs = Microslabs(len(columns), dz=1)
+        slabs.extend(w=w, sigma=np.zeros_like(w), rho=columns,
+                     irho=0.01*np.abs(columns))
+        slabs.finalize(step_interfaces=False, dA=dA)
+        return slabs
+
+    single = contract([rho], 0.5)
+    double = contract([rho, 2*rho], 1.0)
+    assert len(double) < 100
+    assert len(double) == len(single)
+    assert np.allclose(double.w, single.w)
+    assert np.allclose(double.rho, [single.rho[0], 2*single.rho[0]])
+    assert np.allclose(double.irho[1], 2*single.irho[0])
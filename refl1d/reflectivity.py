@@ -16,8 +16,10 @@ from functools import reduce
 # __doc__ = "Fundamental reflectivity calculations"
 __author__ = "Paul Kienzle"
 __all__ = ['reflectivity', 'reflectivity_amplitude',
+           'reflectivity_amplitude_batch', 'IncrementalAmplitude',
+           'reflectivity_amplitude_jacobian', 'reflectivity_resolved',
            'magnetic_reflectivity', 'magnetic_amplitude',
-           'unpolarized_magnetic', 'convolve',
+           'unpolarized_magnetic', 'convolve', 'convolve_matrix',
            ]
 
 import numpy as np
@@ -68,6 +70,7 @@ def reflectivity_amplitude(kz=None,
                            irho=0,
                            sigma=0,
                            rho_index=None,
+                           repeats=None,
                            ):
     r"""
     Calculate reflectivity amplitude $r(k_z)$ from slab model.
@@ -89,6 +92,13 @@ def reflectivity_amplitude(kz=None,
             Points at which to evaluate the reflectivity
         *rho_index* = 0 : integer[M]
             *rho* and *irho* columns to use for the various kz.
+        *repeats* = None : integer[R, 3]
+            Repeated blocks of slabs as (start, length, count), where the
+            *length* slabs beginning at *start* are repeated *count* times.
+            All but the last copy must be identical, including the
+            interface to the next copy.  The repeated periods are evaluated
+            by raising the period transfer matrix to a power, so the cost
+            grows with log(count) rather than count.
 
     :Returns:
         *r* | complex[M]
@@ -96,6 +106,16 @@ def reflectivity_amplitude(kz=None,
 
     This function does not compute any instrument resolution corrections.
     """
+    return _reflectivity_amplitude(kz, depth, rho, irho, sigma, rho_index,
+                                   repeats)
+
+
+def _reflectivity_amplitude(kz, depth, rho, irho, sigma, rho_index, repeats,
+                            double=False):
+    """
+    Implementation of :func:`reflectivity_amplitude`, with *double* True
+    to use double precision whatever the precision of the kernels.
+    """
     from . import refllib
 
     kz = _dense(kz, 'd')
@@ -112,13 +132,13 @@ def reflectivity_amplitude(kz=None,
     rho = _dense(rho, 'd')
     # promote rho and irho to 2d, for multi-wavelength
     if (rho.ndim == 1):
-        rho.resize((1, rho.shape[0]))
+        rho = rho.reshape((1, rho.shape[0]))
     if np.isscalar(irho):
         irho = irho * np.ones_like(rho)
     else:
         irho = _dense(irho, 'd')
     if (irho.ndim == 1):
-        irho.resize((1, irho.shape[0]))
+        irho = irho.reshape((1, irho.shape[0]))
 
     # print(irho.shape, irho[:,0], irho[:,-1])
     irho = abs(irho) + 1e-30
@@ -128,12 +148,298 @@ def reflectivity_amplitude(kz=None,
     r = np.empty(kz.shape, 'D')
     # print "amplitude", depth, rho, kz, rho_index
     # print depth.shape, sigma.shape, rho.shape, irho.shape, kz.shape
+    if repeats is not None:
+        repeats = np.ascontiguousarray(repeats, 'i8').reshape(-1, 3)
     refllib.reflectivity_amplitude(depth, sigma, rho, irho, kz,
-                                    rho_index, r)
+                                    rho_index, r, repeats=repeats,
+                                    double=double)
+
+    return r
+
+
+def reflectivity_amplitude_jacobian(kz=None,
+                                    depth=None,
+                                    rho=None,
+                                    irho=0,
+                                    sigma=0,
+                                    rho_index=None,
+                                    ):
+    r"""
+    Calculate reflectivity amplitude $r(k_z)$ and its derivatives with
+    respect to the slab parameters.
+
+    The derivatives are computed analytically in the same pass through the
+    layers as the amplitude, so the cost is a small multiple of a single
+    :func:`reflectivity_amplitude` call rather than one call per parameter.
+
+    :Parameters :
+        See :func:`reflectivity_amplitude`.
+
+    :Returns:
+        *r* | complex[M]
+            Complex reflectivity waveform.
+        *dr* | complex[4, N, M]
+            Derivatives $\partial r/\partial p_j$ for $p$ = *depth*, *rho*,
+            *irho* and *sigma* of each layer $j$.  The derivatives with
+            respect to *sigma* are stored in dr[3, :N-1].  When *rho* has
+            multiple columns the derivative is with respect to the column
+            selected by *rho_index* for each point.
+
+    This function does not compute any instrument resolution corrections.
+    """
+    from . import refllib
+
+    kz = _dense(kz, 'd')
+    if rho_index is None:
+        rho_index = np.zeros(kz.shape, 'i')
+    else:
+        rho_index = _dense(rho_index, 'i')
+    depth = _dense(depth, 'd')
+    if np.isscalar(sigma):
+        sigma = sigma*np.ones(len(depth)-1, 'd')
+    else:
+        sigma = _dense(sigma, 'd')
+    rho = np.atleast_2d(_dense(rho, 'd'))
+    if np.isscalar(irho):
+        irho = irho * np.ones_like(rho)
+    irho = np.atleast_2d(_dense(irho, 'd'))
+
+    r = np.empty(kz.shape, 'D')
+    dr = np.empty((4, len(depth), kz.size), 'D')
+    refllib.reflectivity_amplitude_jacobian(
+        depth, sigma, rho, abs(irho) + 1e-30, kz, rho_index, r, dr)
+    # The kernel uses |irho|, so flip the derivative for negative irho.
+    dr[2] *= np.where(irho[rho_index].T < 0, -1., 1.)
+    return r, dr
+
+
+class IncrementalAmplitude(object):
+    r"""
+    Reflectivity amplitude calculator with incremental updates.
+
+    Calling the object returns the same $r(k_z)$ as
+    :func:`reflectivity_amplitude` with the same arguments, but it keeps
+    the partial transfer matrix products above and below each layer from
+    the last full calculation.  If a later call differs from that
+    calculation only within a contiguous run of layers, such as when one
+    layer is perturbed to compute a finite difference derivative, then
+    only the matrices for those layers are recomputed and spliced between
+    the saved products, so the cost per point no longer grows with the
+    number of layers.
+
+    A full calculation is used, and becomes the new reference, when *kz*
+    or the number of layers changes, when the incident medium changes, or
+    when more than *max_fraction* of the layers change.
+
+    The saved products need 128 bytes per point per layer.
+    """
+    def __init__(self, max_fraction=0.5):
+        self.max_fraction = max_fraction
+        self.clear()
+
+    def clear(self):
+        """
+        Forget the reference calculation.
+        """
+        self._base = None
+        self._prefix = self._suffix = None
+
+    def __call__(self, kz, depth, rho, irho=0, sigma=0, rho_index=None):
+        from . import refllib
+
+        kz = _dense(kz, 'd')
+        if rho_index is None:
+            rho_index = np.zeros(kz.shape, 'i')
+        else:
+            rho_index = _dense(rho_index, 'i')
+        depth = _dense(depth, 'd')
+        if np.isscalar(sigma):
+            sigma = sigma*np.ones(len(depth)-1, 'd')
+        else:
+            sigma = _dense(sigma, 'd')
+        rho = np.atleast_2d(_dense(rho, 'd'))
+        if np.isscalar(irho):
+            irho = irho * np.ones_like(rho)
+        irho = abs(np.atleast_2d(_dense(irho, 'd'))) + 1e-30
+
+        r = np.empty(kz.shape, 'D')
+        changed = self._changed(kz, depth, sigma, rho, irho, rho_index)
+        if changed is not None:
+            if changed.size == 0:
+                r[:] = self._base[-1]
+            else:
+                refllib.reflectivity_amplitude_splice(
+                    depth, sigma, rho, irho, kz, rho_index,
+                    self._prefix, self._suffix, changed[0], changed[-1], r)
+            return r
+
+        shape = (kz.size, max(len(depth)-1, 1), 4)
+        if self._prefix is None or self._prefix.shape != shape:
+            self._prefix = np.empty(shape, 'D')
+            self._suffix = np.empty(shape, 'D')
+        refllib.reflectivity_amplitude_prefix(
+            depth, sigma, rho, irho, kz, rho_index,
+            self._prefix, self._suffix, r)
+        self._base = (kz.copy(), depth.copy(), sigma.copy(), rho.copy(),
+                      irho.copy(), rho_index.copy(), r.copy())
+        return r
+
+    def _changed(self, kz, depth, sigma, rho, irho, rho_index):
+        """
+        Return the indices of the layers which differ from the reference,
+        or None if a full calculation is needed.
+        """
+        if self._base is None:
+            return None
+        kz0, depth0, sigma0, rho0, irho0, rho_index0, _ = self._base
+        n = len(depth)
+        if (n < 3 or depth0.shape != depth.shape or rho0.shape != rho.shape
+                or not np.array_equal(kz0, kz)
+                or not np.array_equal(rho_index0, rho_index)):
+            return None
+        # Either end may be the incident medium, depending on the sign of kz.
+        if ((rho0[:, 0] != rho[:, 0]).any()
+                or (rho0[:, -1] != rho[:, -1]).any()):
+            return None
+        changed = (depth0 != depth)
+        changed |= (rho0 != rho).any(axis=0)
+        changed |= (irho0 != irho).any(axis=0)
+        # Interface j is between layers j and j+1 and is recomputed with
+        # the steps for layer j.
+        changed[:-1] |= (sigma0 != sigma)
+        index = np.flatnonzero(changed)
+        if index.size and index[-1] - index[0] + 1 > self.max_fraction*n:
+            return None
+        return index
+
+
+def reflectivity_amplitude_batch(kz=None,
+                                 depth=None,
+                                 rho=None,
+                                 irho=0,
+                                 sigma=0,
+                                 rho_index=None,
+                                 ):
+    r"""
+    Calculate reflectivity amplitudes $r(k_z)$ for a population of slab models.
+
+    This evaluates many models in a single parallel kernel call, which is
+    much cheaper than calling :func:`reflectivity_amplitude` once per model
+    when evaluating a whole optimizer generation.
+
+    :Parameters :
+        *depth* : [float[N_p]] * P | |Ang|
+            Thickness of the individual layers for each population member.
+            Members may have different numbers of layers.
+        *sigma* = 0 : float OR [float OR float[N_p-1]] * P | |Ang|
+            Interface roughness between the current layer and the next.
+        *rho*, *irho* = 0: [float[N_p] OR float[K, N_p]] * P | |1e-6/Ang^2|
+            Real and imaginary scattering length density for each member,
+            with the same layout as :func:`reflectivity_amplitude`.  All
+            members must use the same number of columns *K*.
+        *kz* : float[M] OR float[P, M] | |1/Ang|
+            Points at which to evaluate the reflectivity, either shared
+            by all members or given separately for each member.
+        *rho_index* = 0 : integer[M]
+            *rho* and *irho* columns to use for the various kz.
+
+    :Returns:
+        *r* | complex[P, M]
+            Complex reflectivity waveform for each population member.
+
+    This function does not compute any instrument resolution corrections.
+    """
+    from . import refllib
 
+    population = len(depth)
+    layers = np.array([len(d) for d in depth], 'i8')
+    n = max(layers.max(), 2)
+    if np.isscalar(sigma):
+        sigma = [sigma]*population
+    if np.isscalar(irho):
+        irho = [irho]*population
+    rho_p = [np.atleast_2d(_dense(v, 'd')) for v in rho]
+    columns = rho_p[0].shape[0]
+
+    # Pad the stacks to a common length.  The padding is never read since
+    # the kernel only uses the first layers[p] slabs of member p.
+    depth_b = np.zeros((population, n), 'd')
+    sigma_b = np.zeros((population, n-1), 'd')
+    rho_b = np.zeros((population, columns, n), 'd')
+    irho_b = np.zeros((population, columns, n), 'd')
+    for p, (n_p, depth_p, sigma_p, rho_pk, irho_pk) in enumerate(
+            zip(layers, depth, sigma, rho_p, irho)):
+        depth_b[p, :n_p] = depth_p
+        sigma_b[p, :n_p-1] = sigma_p
+        rho_b[p, :, :n_p] = rho_pk
+        irho_b[p, :, :n_p] = irho_pk
+    irho_b = abs(irho_b) + 1e-30
+
+    kz = _dense(kz, 'd')
+    if kz.ndim == 1:
+        kz = np.tile(kz, (population, 1))
+    if rho_index is None:
+        rho_index = np.zeros(kz.shape[1], 'i')
+    else:
+        rho_index = _dense(rho_index, 'i')
+
+    r = np.empty(kz.shape, 'D')
+    refllib.reflectivity_amplitude_batch(layers, depth_b, sigma_b,
+                                         rho_b, irho_b, kz, rho_index, r)
     return r
 
 
+def reflectivity_resolved(Q, resolution, size, depth, rho, irho=0, sigma=0,
+                          rho_index=None, back_absorption=1):
+    r"""
+    Calculate the resolution smeared reflectivity $G \ast |r(Q)|^2$.
+
+    This fuses :func:`reflectivity_amplitude`, the magnitude, the back
+    absorption and the gaussian resolution into a single pass over the
+    calculation points, so that no intermediate arrays the size of *Q*
+    are formed.
+
+    :Parameters :
+        *Q* : float[M] | |1/Ang|
+            Calculation points, with $k_z = -Q/2$ as used by
+            :class:`Experiment <refl1d.experiment.Experiment>`.
+        *resolution* : (int[M+1], int[nnz], float[nnz])
+            The resolution operator from *Q* to the *size* measurement
+            points in compressed column form (indptr, indices, data), with
+            the columns in the order of *Q*.
+        *depth*, *rho*, *irho*, *sigma*, *rho_index*
+            Slab model, as for :func:`reflectivity_amplitude`.
+        *back_absorption* = 1 : float
+            Scale factor for the points with $Q < 0$.
+
+    :Returns:
+        *R* | float[size]
+            Resolution smeared reflectivity.
+    """
+    from . import refllib
+
+    Q = _dense(Q, 'd')
+    if rho_index is None:
+        rho_index = np.zeros(Q.shape, 'i')
+    else:
+        rho_index = _dense(rho_index, 'i')
+    depth = _dense(depth, 'd')
+    if np.isscalar(sigma):
+        sigma = sigma*np.ones(len(depth)-1, 'd')
+    else:
+        sigma = _dense(sigma, 'd')
+    rho = np.atleast_2d(_dense(rho, 'd'))
+    if np.isscalar(irho):
+        irho = irho*np.ones_like(rho)
+    irho = abs(np.atleast_2d(_dense(irho, 'd'))) + 1e-30
+    indptr, indices, data = resolution
+    R = np.empty(size, 'd')
+    refllib.reflectivity_resolved(depth, sigma, rho, irho, Q, rho_index,
+                                  float(back_absorption), indptr, indices,
+                                  data, R)
+    return R
+
+
 def magnetic_reflectivity(*args, **kw):
     """
     Magnetic reflectivity for slab models.
@@ -187,6 +493,8 @@ def unpolarized_magnetic(*args, **kw):
 
 
 B2SLD = 2.31604654  # Scattering factor for B field 1e-6/
+# Transverse field (1e-6/Ang^2) below which the spin flip is ignored.
+COLLINEAR_TOLERANCE = 1e-10
 
 
 def magnetic_amplitude(kz,
@@ -199,11 +507,27 @@ def magnetic_amplitude(kz,
                        Aguide=-90,
                        H=0,
                        rho_index=None,
+                       repeats=None,
+                       xs=None,
                        ):
     """
     Returns the complex magnetic reflectivity waveform.
 
     See :class:`magnetic_reflectivity <refl1d.reflectivity.magnetic_reflectivity>` for details.
+    Repeated blocks are given by *repeats* as for :func:`reflectivity_amplitude`.
+
+    If *xs* is given, then only the cross sections with xs[k] true are
+    computed, and the remaining amplitudes are returned as zero.  This
+    avoids the minus polarization pass through the sample when the minus
+    cross sections were not measured.
+
+    If the magnetization in every layer is parallel or antiparallel to the
+    guide field then there is no spin flip, and the non spin flip amplitudes
+    are computed from scalar reflectivity with *rho* +/- *Bz*, which is
+    much cheaper than the full spin-dependent calculation.  The scalar
+    calculation ignores absorption in the incident medium, so it is only
+    used when the incident medium does not absorb: *irho[0]* for kz > 0
+    and *irho[-1]* for kz < 0.
     """
     from . import refllib
 
@@ -229,15 +553,60 @@ def magnetic_amplitude(kz,
     # np.set_printoptions(linewidth=1000)
     # print(np.vstack((depth, np.hstack((sigma, np.nan)), rho, irho, rhoM, thetaM)).T)
 
+    Bz = _collinear_field(H, rhoM, thetaM, Aguide)
+    absorbing = ((kz > 0).any() and (irho[..., 0] != 0).any()
+                 or (kz < 0).any() and (irho[..., -1] != 0).any())
+    if Bz is not None and not absorbing:
+        # Without spin flip the cross sections are independent, with the
+        # spin up and spin down neutrons seeing rho + Bz and rho - Bz.
+        # The magnetic kernel uses the opposite phase convention.  Like
+        # the other magnetic kernels, this is always double precision.
+        zero = np.zeros(kz.shape, 'D')
+        R = [zero, zero.copy(), zero.copy(), zero.copy()]
+        for k, sign in ((0, 1), (3, -1)):
+            if xs is None or xs[k]:
+                R[k] = np.conj(_reflectivity_amplitude(
+                    kz, depth, rho + sign*Bz, irho, sigma, rho_index,
+                    repeats, double=True))
+        return tuple(R)
+
     sld_b, u1, u3 = calculate_u1_u3(H, rhoM, thetaM, Aguide)
 
     # Note 2021-08-01: return Rpp, Rpm, Rmp, Rmm are no longer contiguous.
     R = np.empty((kz.size, 4), 'D')
+    if repeats is not None:
+        repeats = np.ascontiguousarray(repeats, 'i8').reshape(-1, 3)
+    if xs is not None:
+        xs = np.asarray(xs, bool)
     refllib.magnetic_amplitude(
-        depth, sigma, rho, irho, sld_b, u1, u3, kz, R)
+        depth, sigma, rho, irho, sld_b, u1, u3, kz, R, repeats=repeats, xs=xs)
+    if xs is not None:
+        R[:, ~xs] = 0
     return R[:, 0], R[:, 1], R[:, 2], R[:, 3]
 
 
+def _collinear_field(H, rhoM, thetaM, Aguide):
+    """
+    Return the field component along the quantization axis in each layer,
+    or None if the field is not parallel to the axis in every layer.
+
+    The field in the fronting and backing media must point along the axis,
+    otherwise the incident polarization is reversed within the 4x4 transfer
+    matrix calculation and the profile is not treated as collinear.
+    """
+    thetaM, Aguide = np.radians(thetaM), np.radians(Aguide)
+    Bx = rhoM*np.cos(thetaM)
+    By = rhoM*np.sin(thetaM)
+    if (abs(Bx) > COLLINEAR_TOLERANCE).any():
+        return None
+    if (abs(By*np.cos(Aguide)) > COLLINEAR_TOLERANCE).any():
+        return None
+    Bz = B2SLD*H - By*np.sin(Aguide)
+    if Bz[0] < 0 or Bz[-1] < 0:
+        return None
+    return Bz
+
+
 def calculate_u1_u3(H, rhoM, thetaM, Aguide):
     from . import refllib
 
@@ -319,10 +688,28 @@ def convolve(xi, yi, x, dx, resolution='normal'):
     *resolution* is 'normal' (default) or 'uniform'. Note that the uniform
     distribution uses the $1-\sigma$ equivalent distribution width which is
     $1/\sqrt{3}$ times the width of the rectangle.
+
+    If *yi* is complex, such as a reflectivity amplitude, the real and
+    imaginary parts are convolved together using the same weights.
+
+    If *yi* is a 2-D array with shape *(N, k)*, such as the reflectivity
+    of the different spin cross sections, each of the *k* columns is
+    convolved, and the result has shape *(len(x), k)*.  For the normal
+    resolution the window and weights for each point are only computed
+    once for all columns.
     """
     from . import refllib
-    xi, yi, x, dx = _dense(xi), _dense(yi), _dense(x), _dense(dx)
-    y = np.empty_like(x)
+    yi = _dense(yi, 'D' if np.iscomplexobj(yi) else 'd')
+    xi, x, dx = _dense(xi), _dense(x), _dense(dx)
+    if yi.ndim == 2:
+        y = np.empty((len(x), yi.shape[1]), yi.dtype)
+        if resolution == 'uniform':
+            for j in range(yi.shape[1]):
+                y[:, j] = convolve(xi, yi[:, j], x, dx, resolution=resolution)
+        else:
+            refllib.convolve_gaussian_columns(xi, yi, x, dx, y)
+        return y
+    y = np.empty(x.shape, yi.dtype)
     if resolution == 'uniform':
         refllib.convolve_uniform(xi, yi, x, dx, y)
     else:
@@ -330,6 +717,23 @@ def convolve(xi, yi, x, dx, resolution='normal'):
     return y
 
 
+def convolve_matrix(xi, x, dx):
+    r"""
+    Return the gaussian resolution operator as a sparse matrix.
+
+    The result is a *scipy.sparse.csr_matrix* $A$ such that $A y_i$ is
+    the same as :func:`convolve`\ (*xi*, *yi*, *x*, *dx*) for any *yi*.
+    Building the matrix costs about as much as one convolution, but
+    applying it needs no further transcendental function evaluations, so
+    it pays off when convolving many curves on the same points.
+    """
+    from scipy.sparse import csr_matrix
+    from . import refllib
+    xi, x, dx = _dense(xi), _dense(x), _dense(dx)
+    indptr, indices, data = refllib.convolve_gaussian_matrix(xi, x, dx)
+    return csr_matrix((data, indices, indptr), shape=(len(x), len(xi)))
+
+
 def convolve_sampled(xi, yi, xp, yp, x, dx):
     """
     Apply x-dependent arbitrary resolution function to the theory.
@@ -351,6 +755,217 @@ def convolve_sampled(xi, yi, xp, yp, x, dx):
     return y
 
 
+def test_amplitude_batch():
+    kz = np.linspace(-0.1, 0.1, 201)
+    depth = [[0, 100, 50, 0], [0, 30, 0]]
+    rho = [[2.07, 4, 1, 0], [2.07, 6, 0]]
+    irho = [[0, 0.1, 0, 0], [0, 0.01, 0]]
+    sigma = [[3, 5, 2], [1, 4]]
+    r = reflectivity_amplitude_batch(kz, depth, rho, irho, sigma)
+    for k in range(len(depth)):
+        rk = reflectivity_amplitude(kz, depth[k], rho[k], irho[k], sigma[k])
+        assert np.linalg.norm(r[k] - rk) == 0.
+
+
+def test_amplitude_repeat():
+    kz = np.linspace(-0.2, 0.2, 201)
+    period = np.array([[30, 3, 4, 0.1], [20, 5, -0.5, 0], [10, 2, 6, 0.02]])
+    stack = np.tile(period, (50, 1))
+    stack[-1, 1] = 6  # top interface of the repeat
+    stack = np.vstack(([0, 4, 2.07, 0], stack, [40, 7, 3, 0], [0, 0, 0, 0]))
+    depth, sigma, rho, irho = stack.T
+    sigma = sigma[:-1]
+    r = reflectivity_amplitude(kz, depth, rho, irho, sigma)
+    r_repeat = reflectivity_amplitude(kz, depth, rho, irho, sigma,
+                                      repeats=[[1, 3, 50]])
+    assert np.linalg.norm(r - r_repeat) < 1e-12
+
+
+def test_magnetic_amplitude_repeat():
+    kz = np.linspace(-0.1, 0.1, 201)
+    period = np.array([[30, 3, 4, 0.1, 1.5, 30],
+                       [20, 5, -0.5, 0, 0, 270],
+                       [10, 2, 6, 0.02, 0.8, 120]])
+    stack = np.tile(period, (20, 1))
+    stack[-1, 1] = 6  # top interface of the repeat
+    stack = np.vstack(([0, 4, 2.07, 0, 0, 270], stack,
+                       [40, 7, 3, 0, 0.5, 90], [0, 0, 0, 0, 0, 270]))
+    depth, sigma, rho, irho, rhoM, thetaM = stack.T
+    sigma = sigma[:-1]
+    R = magnetic_amplitude(kz, depth, rho, irho, rhoM, thetaM, sigma, H=0.5)
+    R_repeat = magnetic_amplitude(kz, depth, rho, irho, rhoM, thetaM, sigma,
+                                  H=0.5, repeats=[[1, 3, 20]])
+    for xs, xs_repeat in zip(R, R_repeat):
+        assert np.linalg.norm(xs - xs_repeat) < 1e-12
+
+
+def test_threaded_amplitude():
+    from .lib_numba import reflectivity as _reflectivity, magnetic as _magnetic
+    from .lib_numba import parallel as _parallel
+
+    # Call the threaded kernels directly since refllib only selects them
+    # when numba has more than one thread.
+    kz = np.linspace(-0.1, 0.1, 201)
+    period = np.array([[30, 3, 4, 0.1, 1.5, 30],
+                       [20, 5, -0.5, 0, 0, 270]])
+    stack = np.vstack(([0, 4, 2.07, 0, 0, 270], np.tile(period, (10, 1)),
+                       [0, 0, 0, 0, 0, 270]))
+    depth, sigma, rho, irho, rhoM, thetaM = stack.T
+    sigma = sigma[:-1]
+    rho, irho = rho[None, :], irho[None, :]
+    rho_index = np.zeros(len(kz), 'i')
+    repeats = np.array([[1, 2, 10]], 'i8')
+    xs = np.ones(4, bool)
+    rhoB, u1, u3 = calculate_u1_u3(0.5, rhoM, thetaM, -90)
+    points = len(kz)
+    calls = [
+        (_reflectivity.reflectivity_amplitude, (points,),
+         (depth, sigma, rho, irho, kz, rho_index)),
+        (_reflectivity.reflectivity_amplitude_repeat, (points,),
+         (depth, sigma, rho, irho, kz, rho_index, repeats)),
+        (_magnetic.magnetic_amplitude, (points, 4),
+         (depth, sigma, rho[0], irho[0], rhoB, u1, u3, kz, xs)),
+        (_magnetic.magnetic_amplitude_repeat, (points, 4),
+         (depth, sigma, rho[0], irho[0], rhoB, u1, u3, kz, repeats, xs,
+          np.empty((2, 5, 4, 4), 'D'))),
+    ]
+    for kernel, shape, args in calls:
+        threaded_kernel = getattr(_parallel, kernel.__name__ + '_parallel')
+        serial, threaded = np.empty(shape, 'D'), np.empty(shape, 'D')
+        kernel(*args, serial)
+        threaded_kernel(*args, threaded)
+        assert np.linalg.norm(serial - threaded) == 0.
+
+    # Batched populations, with one member per row.
+    layers = np.array([len(depth), len(depth)-2], 'i8')
+    batch = (layers, np.vstack((depth, depth)), np.vstack((sigma, sigma)),
+             np.stack((rho, 2*rho)), np.stack((irho, irho)),
+             np.vstack((kz, kz)), rho_index)
+    serial, threaded = np.empty((2, len(kz)), 'D'), np.empty((2, len(kz)), 'D')
+    _reflectivity.reflectivity_amplitude_batch(*batch, serial)
+    _parallel.reflectivity_amplitude_batch_parallel(*batch, threaded)
+    assert np.linalg.norm(serial - threaded) == 0.
+
+
+def test_collinear_magnetism():
+    from . import refllib
+
+    # Collinear magnetic profiles match the spin flip kernel.
+    rng = np.random.default_rng(3)
+    n = 12
+    depth, rho, irho = [rng.uniform(a, b, n)
+                        for a, b in ((10, 50), (-1, 8), (0, 0.1))]
+    sigma, rhoM = rng.uniform(1, 5, n-1), rng.uniform(0, 2, n)
+    rhoM[[0, -1]] = 0
+    thetaM = np.where(rng.random(n) > 0.5, 90.0, 270.0)
+    rhoB, u1, u3 = calculate_u1_u3(0.3, rhoM, thetaM, 270)
+    for kz in (np.linspace(-0.1, -0.001, 100), np.linspace(0.001, 0.1, 100),
+               np.linspace(-0.1, 0.1, 201)):
+        expected = np.empty((len(kz), 4), 'D')
+        refllib.magnetic_amplitude(depth, sigma, rho, irho, rhoB, u1, u3,
+                                   kz, expected)
+        # With absorbing fronting and backing media the spin flip kernel
+        # is used; without them the scalar kernel gives no spin flip.
+        for absorbing in (True, False):
+            incident = irho.copy()
+            if not absorbing:
+                incident[[0, -1]] = 0
+                refllib.magnetic_amplitude(depth, sigma, rho, incident, rhoB,
+                                           u1, u3, kz, expected)
+            R = magnetic_amplitude(kz, depth, rho, incident, rhoM, thetaM,
+                                   sigma, Aguide=270, H=0.3)
+            assert absorbing or not (R[1].any() or R[2].any())
+            assert np.abs(np.array(R) - expected.T).max() < 1e-7
+
+    # The scalar kernel stays double precision with single precision set.
+    refllib.set_precision("single")
+    try:
+        R_single = magnetic_amplitude(kz, depth, rho, incident, rhoM, thetaM,
+                                      sigma, Aguide=270, H=0.3)
+    finally:
+        refllib.set_precision("double")
+    assert np.array_equal(np.array(R_single), np.array(R))
+
+
+def test_incremental_amplitude():
+    kz = np.linspace(-0.2, 0.2, 201)
+    depth = np.array([0, 30, 20, 10, 40, 25, 0], 'd')
+    rho = np.array([2.07, 3, -0.5, 6, 4, 1, 0], 'd')
+    irho = np.array([0, 0.1, 0, 0.02, 0, 0, 0], 'd')
+    sigma = np.array([4, 3, 5, 2, 1, 3], 'd')
+    calculator = IncrementalAmplitude()
+    r = calculator(kz, depth, rho, irho, sigma)
+    assert np.linalg.norm(r - reflectivity_amplitude(kz, depth, rho.copy(), irho, sigma)) == 0.
+    for k in range(1, len(depth)-1):
+        d, p, s = depth.copy(), rho.copy(), sigma.copy()
+        d[k] += 1
+        p[k] += 0.1
+        s[k] += 0.5
+        r = calculator(kz, d, p, irho, s)
+        expected = reflectivity_amplitude(kz, d, p, irho, s)
+        assert np.linalg.norm(r - expected) < 1e-14
+    # change the substrate, which requires a full calculation
+    p = rho.copy()
+    p[0] = 3
+    r = calculator(kz, depth, p, irho, sigma)
+    assert np.linalg.norm(r - reflectivity_amplitude(kz, depth, p, irho, sigma)) == 0.
+
+
+def test_amplitude_jacobian():
+    kz = np.linspace(-0.1, 0.1, 101)
+    depth = np.array([0, 30, 20, 10, 0], 'd')
+    rho = np.array([2.07, 3, -0.5, 6, 1], 'd')
+    irho = np.array([0.01, 0.1, -0.05, 0.02, 0.001], 'd')
+    sigma = np.array([4, 3, 5, 2], 'd')
+    r, dr = reflectivity_amplitude_jacobian(kz, depth, rho, irho, sigma)
+    assert np.linalg.norm(r - reflectivity_amplitude(kz, depth, rho.copy(), irho.copy(), sigma)) == 0.
+    h = 1e-6
+    for k, p in enumerate((depth, rho, irho, sigma)):
+        for j in range(len(p)):
+            p[j] += h
+            rh = reflectivity_amplitude(kz, depth, rho.copy(), irho.copy(), sigma)
+            p[j] -= 2*h
+            rl = reflectivity_amplitude(kz, depth, rho.copy(), irho.copy(), sigma)
+            p[j] += h
+            assert np.linalg.norm((rh - rl)/(2*h) - dr[k, j]) < 1e-6
+
+
+def test_convolve_matrix():
+    xi = np.linspace(0.01, 0.3, 500)
+    yi = np.exp(-30*xi)*(1 + 0.5*np.cos(400*xi))
+    x = np.linspace(0.02, 0.28, 40)
+    dx = 0.02*x
+    dx[3] = 0
+    A = convolve_matrix(xi, x, dx)
+    y = convolve(xi, yi, x, dx)
+    assert np.linalg.norm(A.dot(yi) - y) < 1e-14*np.linalg.norm(y)
+
+
+def test_convolve_complex():
+    xi = np.linspace(0.01, 0.3, 500)
+    yi = np.exp((-30 + 400j)*xi)
+    x = np.linspace(0.02, 0.28, 40)
+    dx = 0.02*x
+    for resolution in ('normal', 'uniform'):
+        y = convolve(xi, yi, x, dx, resolution=resolution)
+        expected = (convolve(xi, yi.real, x, dx, resolution=resolution)
+                    + 1j*convolve(xi, yi.imag, x, dx, resolution=resolution))
+        assert np.linalg.norm(y - expected) == 0.
+
+
+def test_convolve_columns():
+    xi = np.linspace(0.01, 0.3, 500)
+    yi = np.exp(-30*xi)[:, None]*(1 + 0.5*np.cos([[300], [400], [500]]*xi).T)
+    x = np.linspace(0.02, 0.28, 40)
+    dx = 0.02*x
+    dx[3] = 0
+    for resolution in ('normal', 'uniform'):
+        y = convolve(xi, yi, x, dx, resolution=resolution)
+        for j in range(yi.shape[1]):
+            yj = convolve(xi, yi[:, j], x, dx, resolution=resolution)
+            assert np.linalg.norm(y[:, j] - yj) < 1e-14*np.linalg.norm(yj)
+
+
 def test_uniform():
     xi = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     yi = [1, 3, 1, 2, 7, 3, 1, 2, 1, 3]
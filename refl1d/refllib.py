@@ -2,29 +2,270 @@
 # Authors: Paul Kienzle and Brian Maranville
 r"""
 Reflectometry numba library
+
+The reflectivity kernels can spread the calculation over multiple threads
+for large problems, such as oversampled time-of-flight data.  The number of
+threads is read from the *REFL1D_THREADS* environment variable when the
+library is loaded (default 1, with 0 meaning all cores), and can be changed
+later using :func:`set_threads`.  Problems with fewer than *threshold* kz
+points always use the serial kernels since the thread startup cost would
+dominate the calculation.
+
+Early in a global optimization the theory does not need full double
+precision.  Use :func:`set_precision` to select single precision kernels
+for the reflectivity amplitude, or set the *REFL1D_PRECISION* environment
+variable to "single".  Inputs and results are still double precision
+arrays, but the transfer matrix calculation is done in float32/complex64.
+The reflectivity is typically good to about six digits, dropping to three
+in deep fringe minima.  Switch back to "double" before the final fit and
+the uncertainty analysis.
+
+All kernels release the GIL, so independent models can be computed at the
+same time from different python threads.  See
+:func:`refl1d.experiment.set_model_threads`.
 """
 __all__ = [
     "reflectivity_amplitude",
+    "reflectivity_amplitude_batch",
+    "reflectivity_amplitude_prefix",
+    "reflectivity_amplitude_splice",
+    "reflectivity_amplitude_jacobian",
+    "reflectivity_resolved",
     "magnetic_amplitude",
     "calculate_u1_u3",
     "convolve_gaussian",
+    "convolve_gaussian_matrix",
+    "convolve_gaussian_columns",
     "convolve_uniform",
     "convolve_sampled",
     "align_magnetic",
+    "build_profile",
     "contract_by_area",
+    "contract_by_area_columns",
     "contract_mag",
     "rebin_counts",
     "rebin_counts_2D",
+    "set_threads",
+    "get_threads",
+    "set_precision",
+    "get_precision",
 ]
 
-from .lib_numba.reflectivity import reflectivity_amplitude
-from .lib_numba.magnetic import magnetic_amplitude
+import os
+
+import numba
+import numpy as np
+
+from .lib_numba import reflectivity as _reflectivity
+from .lib_numba import magnetic as _magnetic
 from .lib_numba.magnetic import calculate_u1_u3
+from .lib_numba.reflectivity_resolved import reflectivity_resolved
 from .lib_numba.convolve import convolve_gaussian
+from .lib_numba.convolve import convolve_gaussian_matrix
+from .lib_numba.convolve import convolve_gaussian_columns
 from .lib_numba.convolve import convolve_uniform
 from .lib_numba.convolve_sampled import convolve_sampled
 from .lib_numba.contract_profile import align_magnetic
+from .lib_numba.build_profile import build_profile
 from .lib_numba.contract_profile import contract_by_area
+from .lib_numba.contract_profile import contract_by_area_columns
 from .lib_numba.contract_profile import contract_mag
 from .lib_numba.rebin import rebin_counts
 from .lib_numba.rebin import rebin_counts_2D
+
+_THREADS = 1
+_THRESHOLD = 2000
+# Threaded kernels, loaded by set_threads when more than one thread is used.
+_parallel = None
+_ALL_XS = np.ones(4, np.bool_)
+_SINGLE = False
+
+
+def set_threads(threads=None, threshold=None):
+    """
+    Set the number of threads used by the reflectivity kernels.
+
+    *threads* is the number of threads, with 0 for all available cores and
+    1 for serial evaluation.  The number is limited to the size of the numba
+    thread pool.  *threshold* is the minimum number of kz points required
+    before the threaded kernels are used.  Values that are None are left
+    unchanged.
+
+    The threaded kernels are loaded the first time more than one thread is
+    requested.  This starts the numba threading layer, so call it from the
+    main thread.
+    """
+    global _THREADS, _THRESHOLD, _parallel
+    if threads is not None:
+        threads = int(threads)
+        limit = numba.config.NUMBA_NUM_THREADS
+        _THREADS = limit if threads <= 0 else min(threads, limit)
+        if _THREADS > 1 and _parallel is None:
+            from .lib_numba import parallel as _parallel
+    if threshold is not None:
+        _THRESHOLD = int(threshold)
+
+
+def get_threads():
+    """
+    Return the (threads, threshold) used by the reflectivity kernels.
+    """
+    return _THREADS, _THRESHOLD
+
+
+def set_precision(precision="double"):
+    """
+    Set the precision of the reflectivity kernels to "double" or "single".
+
+    Single precision is only used by the non-magnetic reflectivity amplitude
+    kernels without repeated blocks, including the batched population
+    kernel.  The remaining kernels always use double precision, including
+    magnetic models without spin flip, which are computed with the scalar
+    kernel.
+    """
+    global _SINGLE
+    if precision not in ("single", "double"):
+        raise ValueError("precision must be 'single' or 'double'")
+    _SINGLE = (precision == "single")
+
+
+def get_precision():
+    """
+    Return the precision of the reflectivity kernels, "single" or "double".
+    """
+    return "single" if _SINGLE else "double"
+
+
+def _single(*args):
+    return [np.ascontiguousarray(v, np.float32) for v in args]
+
+
+def _use_threads(points):
+    if _THREADS > 1 and points >= _THRESHOLD:
+        # Thread count is thread-local in numba, so set it on every call.
+        numba.set_num_threads(_THREADS)
+        return True
+    return False
+
+
+def reflectivity_amplitude(depth, sigma, rho, irho, kz, rho_index, r,
+                           repeats=None, double=False):
+    """
+    Complex reflectivity amplitude r[M] for slab model at the points kz[M].
+
+    If *double* is True, double precision is used even if single precision
+    is selected with :func:`set_precision`.
+
+    See :func:`refl1d.reflectivity.reflectivity_amplitude` for details.
+    """
+    threaded = _use_threads(len(kz))
+    if _SINGLE and not double and (repeats is None or len(repeats) == 0):
+        r32 = np.empty(r.shape, np.complex64)
+        kernel = (_parallel.reflectivity_amplitude_single_parallel
+                  if threaded else _reflectivity.reflectivity_amplitude_single)
+        kernel(*_single(depth, sigma, rho, irho, kz), rho_index, r32)
+        r[:] = r32
+    elif repeats is not None and len(repeats) > 0:
+        if threaded:
+            _parallel.reflectivity_amplitude_repeat_parallel(
+                depth, sigma, rho, irho, kz, rho_index, repeats, r)
+        else:
+            _reflectivity.reflectivity_amplitude_repeat(
+                depth, sigma, rho, irho, kz, rho_index, repeats, r)
+    elif threaded:
+        _parallel.reflectivity_amplitude_parallel(
+            depth, sigma, rho, irho, kz, rho_index, r)
+    else:
+        _reflectivity.reflectivity_amplitude(
+            depth, sigma, rho, irho, kz, rho_index, r)
+
+
+def reflectivity_amplitude_batch(layers, depth, sigma, rho, irho, kz,
+                                 rho_index, r):
+    """
+    Complex reflectivity amplitude r[P, M] for a population of slab models.
+
+    See :func:`refl1d.reflectivity.reflectivity_amplitude_batch` for details.
+    """
+    threaded = _use_threads(r.size)
+    if _SINGLE:
+        r32 = np.empty(r.shape, np.complex64)
+        kernel = (_parallel.reflectivity_amplitude_batch_single_parallel
+                  if threaded else _reflectivity.reflectivity_amplitude_batch_single)
+        kernel(layers, *_single(depth, sigma, rho, irho, kz), rho_index, r32)
+        r[:] = r32
+    elif threaded:
+        _parallel.reflectivity_amplitude_batch_parallel(
+            layers, depth, sigma, rho, irho, kz, rho_index, r)
+    else:
+        _reflectivity.reflectivity_amplitude_batch(
+            layers, depth, sigma, rho, irho, kz, rho_index, r)
+
+
+def reflectivity_amplitude_prefix(depth, sigma, rho, irho, kz, rho_index,
+                                  prefix, suffix, r):
+    """
+    Complex reflectivity amplitude r[M], saving the partial transfer matrix
+    products prefix[M, N-1, 4] and suffix[M, N-1, 4] for each point.
+
+    See :class:`refl1d.reflectivity.IncrementalAmplitude` for details.
+    """
+    _reflectivity.reflectivity_amplitude_prefix(
+        depth, sigma, rho, irho, kz, rho_index, prefix, suffix, r)
+
+
+def reflectivity_amplitude_splice(depth, sigma, rho, irho, kz, rho_index,
+                                  prefix, suffix, lo, hi, r):
+    """
+    Complex reflectivity amplitude r[M] after changing layers lo to hi,
+    using the partial products from :func:`reflectivity_amplitude_prefix`.
+
+    See :class:`refl1d.reflectivity.IncrementalAmplitude` for details.
+    """
+    _reflectivity.reflectivity_amplitude_splice(
+        depth, sigma, rho, irho, kz, rho_index, prefix, suffix, lo, hi, r)
+
+
+def reflectivity_amplitude_jacobian(depth, sigma, rho, irho, kz, rho_index,
+                                    r, dr):
+    """
+    Complex reflectivity amplitude r[M] and its derivatives dr[4, N, M]
+    with respect to depth, rho, irho and sigma of each layer.
+
+    See :func:`refl1d.reflectivity.reflectivity_amplitude_jacobian` for details.
+    """
+    _reflectivity.reflectivity_amplitude_jacobian(
+        depth, sigma, rho, irho, kz, rho_index, r, dr)
+
+
+def magnetic_amplitude(d, sigma, rho, irho, rhoM, u1, u3, KZ, R,
+                       repeats=None, xs=None):
+    """
+    Complex magnetic reflectivity amplitude R[M, 4] at the points KZ[M].
+
+    If *xs* is given, then only the cross sections xs[k] that are true are
+    guaranteed to be filled in.
+
+    See :func:`refl1d.reflectivity.magnetic_amplitude` for details.
+    """
+    xs = _ALL_XS if xs is None else np.ascontiguousarray(xs, np.bool_)
+    threaded = _use_threads(len(KZ))
+    if repeats is not None and len(repeats) > 0:
+        # Scratch space for the 4x4 period matrices, one per thread.
+        work = np.empty((_THREADS if threaded else 1, 5, 4, 4), np.complex128)
+        if threaded:
+            _parallel.magnetic_amplitude_repeat_parallel(
+                d, sigma, rho, irho, rhoM, u1, u3, KZ, repeats, xs, work, R)
+        else:
+            _magnetic.magnetic_amplitude_repeat(
+                d, sigma, rho, irho, rhoM, u1, u3, KZ, repeats, xs, work, R)
+    elif threaded:
+        _parallel.magnetic_amplitude_parallel(
+            d, sigma, rho, irho, rhoM, u1, u3, KZ, xs, R)
+    else:
+        _magnetic.magnetic_amplitude(
+            d, sigma, rho, irho, rhoM, u1, u3, KZ, xs, R)
+
+
+set_threads(os.environ.get("REFL1D_THREADS", 1))
+set_precision(os.environ.get("REFL1D_PRECISION", "double"))
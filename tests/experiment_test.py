@@ -7,8 +7,14 @@ import os
 import numpy as np
 
 from refl1d.names import (
-    QProbe, Slab, SLD, Parameter, Experiment, NeutronProbe,
-    PolarizedNeutronProbe, Magnetism)
+    QProbe, Slab, SLD, Parameter, Experiment, NeutronProbe, air,
+    PolarizedNeutronProbe, Magnetism, MixedExperiment,
+    ConcurrentFitProblem, set_model_threads)
+from refl1d.experiment import _CompiledStack
+from refl1d.model import Repeat
+from refl1d.oversampling import auto_oversample
+from refl1d.reflectivity import convolve
+from refl1d.resolution import QL2T
 
 
 class ExperimentJsonTest(unittest.TestCase):
@@ -221,5 +227,615 @@ class ExperimentNonMagSimulateTest(unittest.TestCase):
         self.assertAlmostEqual(ratio_f, 0.11)
 
 
+class ExperimentEvaluationTest(unittest.TestCase):
+    """ Test alternative evaluation paths against Experiment.nllf """
+    def setUp(self):
+        probe = NeutronProbe(T=np.linspace(0.1, 5, 200), dT=0.02,
+                             L=4.75, dL=0.0475)
+        sample = (
+            Slab(material=SLD(name='Si', rho=2.07, irho=0.0))
+            | Slab(material=SLD(name='Ni', rho=9.4, irho=0.01),
+                   thickness=100, interface=5)
+            | Slab(material=SLD(name='air', rho=0, irho=0.0))
+        )
+        sample['Ni'].thickness.range(50.0, 150.0)
+        sample['Ni'].interface.range(1.0, 10.0)
+        self.expt = Experiment(probe=probe, sample=sample)
+        self.expt.simulate_data(noise=5)
+        self.pars = [sample['Ni'].thickness, sample['Ni'].interface]
+
+    def _nllf(self, pvec):
+        for p, v in zip(self.pars, pvec):
+            p.value = v
+        self.expt.update()
+        return self.expt.nllf()
+
+    def test_nllf_batch(self):
+        """ Population evaluation matches one-at-a-time evaluation """
+        population = [[80.0, 3.0], [120.0, 6.0], [100.0, 5.0]]
+        probe, sample = self.expt.probe, self.expt.sample
+        for options in ({}, {'refine': 1e-3}, {'fused': True}):
+            # The refined grid depends on the models evaluated before, so
+            # start each calculation from a new experiment.
+            self.expt = Experiment(probe=probe, sample=sample, **options)
+            batch = self.expt.nllf_batch(population, pars=self.pars)
+            self.assertEqual(self.pars[0].value, 100.0)
+            self.expt = Experiment(probe=probe, sample=sample, **options)
+            expected = [self._nllf(pvec) for pvec in population]
+            np.testing.assert_allclose(batch, expected, rtol=1e-12)
+
+    def test_jacobian(self):
+        """ Analytic Jacobian matches finite differences of the residuals """
+        sample = self.expt.sample
+        pars = self.pars + [sample['Ni'].material.rho,
+                            sample['Ni'].material.irho,
+                            sample['Si'].interface,
+                            self.expt.probe.intensity]
+        J = self.expt.jacobian(pars)
+        self.assertEqual(pars[0].value, 100.0)
+        expected = np.empty_like(J)
+        for k, p in enumerate(pars):
+            v, h = p.value, 1e-5*max(abs(p.value), 1)
+            p.value = v + h
+            self.expt.update()
+            hi = self.expt.residuals().copy()
+            p.value = v - h
+            self.expt.update()
+            lo = self.expt.residuals().copy()
+            p.value = v
+            expected[:, k] = (hi - lo)/(2*h)
+        self.expt.update()
+        np.testing.assert_allclose(J, expected, rtol=1e-3,
+                                   atol=1e-4*abs(expected).max())
+
+        # With dA contraction a step can move the slab boundaries without
+        # changing the number of slabs, so forward differences are used.
+        self.expt.dA, self.expt.step_interfaces = 2, True
+        interface = sample['Ni'].interface
+        interface.value = 4.664
+        self.expt.update()
+        resid = self.expt.residuals().copy()
+        J = self.expt.jacobian([interface])
+        h = 1e-6*interface.value
+        interface.value += h
+        self.expt.update()
+        expected = (self.expt.residuals() - resid)/h
+        np.testing.assert_allclose(J[:, 0], expected, rtol=1e-10)
+
+    def test_resolution_cache(self):
+        """ Cached resolution matrix follows changes in probe geometry """
+        probe = self.expt.probe
+        calc_q, calc_r = self.expt._reflamp()
+        calc_R = abs(calc_r)**2
+        for offset, broadening in ((0, 0), (0.01, 0), (0.01, 0.005)):
+            probe.theta_offset.value = offset
+            probe.sample_broadening.value = broadening
+            R = probe.apply_beam(probe.calc_Q, calc_R)[1]
+            expected = convolve(probe.calc_Q, calc_R, probe.Q, probe.dQ)
+            np.testing.assert_allclose(R, expected, rtol=1e-12)
+
+    def test_mixed_amplitude(self):
+        """ Coherent mixture amplitude is the weighted sum of the parts """
+        sample = self.expt.sample
+        other = Slab(SLD(name='Si', rho=2.07)) | Slab(SLD(name='air', rho=0))
+        mixed = MixedExperiment(samples=[sample, other], ratio=[3, 1],
+                                probe=self.expt.probe, coherent=True)
+        Q, r = mixed.amplitude()
+        self.assertTrue(np.iscomplexobj(r))
+        expected = sum(w*part.amplitude()[1]
+                       for w, part in zip((0.75, 0.25), mixed.parts))
+        np.testing.assert_allclose(r, expected, rtol=1e-12)
+
+    def test_polarized_shared_resolution(self):
+        """ Cross sections sharing Q and dQ share one convolution """
+        probe = self.expt.probe
+        xs = [NeutronProbe(T=probe.T, dT=probe.dT, L=probe.L, dL=probe.dL,
+                           intensity=0.9+0.1*k, background=1e-6*k)
+              for k in range(4)]
+        polarized = PolarizedNeutronProbe(xs)
+        calc_Q = np.hstack((-1.1*polarized.calc_Q[::-1], polarized.calc_Q))
+        calc_R = [np.exp(-abs(calc_Q)*(20+k))*(1+0.5*np.cos(300*calc_Q+1))
+                  for k in range(4)]
+        for back_reflectivity in (False, True):
+            # Back reflectivity on one cross section reverses its calc_Q.
+            xs[1].back_reflectivity = back_reflectivity
+            self.assertEqual(polarized._shared_resolution(0),
+                             not back_reflectivity)
+            for interpolation in (0, 2):
+                result = polarized.apply_beam(calc_Q, calc_R,
+                                              interpolation=interpolation)
+                for x, Ri, (Q, R) in zip(xs, calc_R, result):
+                    Qx, Rx = x.apply_beam(calc_Q, Ri,
+                                          interpolation=interpolation)
+                    np.testing.assert_array_equal(Q, Qx)
+                    np.testing.assert_allclose(R, Rx, rtol=1e-12)
+
+    def test_oversample_nodes(self):
+        """ Deterministic oversampling reproduces the smeared reflectivity """
+        T = np.linspace(0.2, 2.0, 40)
+        sample = (Slab(SLD(name='Si', rho=2.07), interface=5)
+                  | Slab(SLD(name='Ni', rho=9.4), 2000, 5)
+                  | Slab(SLD(name='air', rho=0)))
+        probe = NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.1)
+        expt = Experiment(probe=probe, sample=sample)
+        fine = np.linspace(probe.Q[0] - 0.01, probe.Q[-1] + 0.01, 50000)
+        probe._set_calc(QL2T(fine, 4.75), 4.75*np.ones_like(fine))
+        expt.update()
+        target = expt.reflectivity()[1]
+
+        def error(method, n):
+            probe.oversample(n, method=method)
+            expt.update()
+            return np.sqrt(np.mean((expt.reflectivity()[1]/target - 1)**2))
+
+        for method in ('random', 'gauss', 'sobol'):
+            self.assertLess(error(method, 49), 0.005)
+            self.assertEqual(len(probe.calc_Q), 49*len(T))
+        self.assertRaises(ValueError, probe.oversample, 49, method='other')
+
+        # Points are reproducible and are carried through the union of
+        # the polarized cross sections.
+        probe.oversample(9, method='sobol')
+        calc_Q = probe.calc_Q
+        probe.oversample(9, method='sobol')
+        np.testing.assert_array_equal(probe.calc_Q, calc_Q)
+        polarized = PolarizedNeutronProbe([probe, None, None, probe])
+        polarized.oversample(9, method='gauss')
+        self.assertEqual(len(polarized.calc_Q), 9*len(T))
+
+    def test_auto_oversample(self):
+        """ Per-Q oversampling only adds points where they are needed """
+        T = np.linspace(0.2, 2.0, 40)
+        sample = (Slab(SLD(name='Si', rho=2.07), interface=5)
+                  | Slab(SLD(name='Ni', rho=9.4), 2000, 5)
+                  | Slab(SLD(name='air', rho=0)))
+        probe = NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.1)
+        expt = Experiment(probe=probe, sample=sample)
+        expt.simulate_data(noise=2)
+
+        n = np.arange(len(T)) % 3 + 1
+        for method in ('random', 'gauss', 'sobol'):
+            probe.oversample(n, method=method)
+            self.assertEqual(len(probe.calc_Q), np.sum(n))
+        self.assertRaises(ValueError, probe.oversample, n[:-1])
+        polarized = PolarizedNeutronProbe([probe, None, None, probe])
+        polarized.oversample([n, None, None, 2*n])
+        self.assertEqual(len(polarized.calc_Q), np.sum(2*n))
+
+        n, = auto_oversample(expt, tolerance=0.5, max_oversampling=51)
+        self.assertEqual(len(probe.calc_Q), np.sum(n))
+        self.assertLess(np.sum(n), 51*len(T))
+        self.assertEqual(np.min(n), 1)
+
+    def test_resolution_guard(self):
+        """ Resolution guard adds the fewest points to cover each dQ """
+        # Two overlapping measurements with different resolution.
+        T = np.hstack((np.linspace(0.2, 1.0, 30), np.linspace(0.8, 3.0, 40)))
+        dT = np.hstack((0.005*np.ones(30), 0.04*np.ones(40)))
+        probe = NeutronProbe(T=T, dT=dT, L=4.75, dL=0.02)
+        probe.resolution_guard(n=5, width=3)
+        calc_Q = probe.calc_Q
+        lo = np.searchsorted(calc_Q, probe.Q - 3*probe.dQ, 'left')
+        hi = np.searchsorted(calc_Q, probe.Q + 3*probe.dQ, 'right')
+        self.assertGreaterEqual(np.min(hi - lo), 5)
+        self.assertLess(len(calc_Q), 5*len(T))
+        self.assertTrue(np.all(np.diff(calc_Q) > 0))
+        self.assertTrue(np.all(np.isin(probe.Q, calc_Q)))
+
+        # Already guarded points are left alone.
+        probe.resolution_guard(n=5, width=3)
+        np.testing.assert_array_equal(probe.calc_Q, calc_Q)
+
+        qprobe = QProbe(probe.Q, probe.dQ)
+        qprobe.resolution_guard(n=5, width=3)
+        self.assertEqual(len(qprobe.calc_Q), len(calc_Q))
+
+    def test_refine(self):
+        """ Adaptive theory grid matches a dense grid with fewer points """
+        T = np.linspace(0.1, 3.0, 100)
+        sample = (Slab(SLD(name='Si', rho=2.07), interface=5)
+                  | Slab(SLD(name='Ni', rho=9.4), 800, 5)
+                  | Slab(SLD(name='air', rho=0)))
+        probe = NeutronProbe(T=T, dT=0.05, L=4.75, dL=0.05)
+        expt = Experiment(probe=probe, sample=sample)
+        expt.simulate_data(noise=2)
+        fine = np.linspace(0.001, probe.Q[-1] + 0.02, 100000)
+        probe._set_calc(QL2T(fine, 4.75), 4.75*np.ones_like(fine))
+        expt.update()
+        target = expt.reflectivity()[1]
+        probe._set_calc(probe.T, probe.L)
+
+        expt = Experiment(probe=probe, sample=sample, refine=0.1)
+        R = expt.reflectivity()[1]
+        self.assertLess(np.max(abs(R - target)/probe.dR), 0.1)
+        calc_Q = expt._reflamp()[0]
+        self.assertGreater(len(calc_Q), len(T))
+        self.assertLess(len(calc_Q), 20*len(T))
+
+        # Small changes reuse the grid, large changes rebuild it.
+        sample[1].thickness.value = 801
+        expt.update()
+        np.testing.assert_array_equal(expt._reflamp()[0], calc_Q)
+        sample[1].thickness.value = 1600
+        expt.update()
+        self.assertGreater(len(expt._reflamp()[0]), len(calc_Q))
+
+        # Points with zero uncertainty use the reflectivity as the scale.
+        sample[1].thickness.value = 800
+        probe.dR = np.zeros_like(probe.dR)
+        expt = Experiment(probe=probe, sample=sample, refine=0.1)
+        with np.errstate(divide='raise', invalid='raise'):
+            calc_Q, calc_r = expt._reflamp()
+        self.assertTrue(np.all(np.isfinite(calc_r)))
+        self.assertGreater(len(calc_Q), len(T))
+        self.assertLess(len(calc_Q), 20*len(T))
+
+    def test_stage_cache(self):
+        """ Only the stages which depend on a changed parameter rerun """
+        expt, probe = self.expt, self.expt.probe
+        probe.back_reflectivity = True
+        expt.update()
+
+        def fresh():
+            return Experiment(probe=probe, sample=expt.sample).reflectivity()
+
+        def check(par, value):
+            before = expt._reflamp()[1]
+            par.value = value
+            expt.update()
+            Q, R = expt.reflectivity()
+            Qf, Rf = fresh()
+            np.testing.assert_array_equal(Q, Qf)
+            np.testing.assert_allclose(R, Rf, rtol=1e-12)
+            return expt._reflamp()[1] is before
+
+        expt.reflectivity()
+        resolved = expt._stages['reflectivity', True, 0][1]
+        self.assertTrue(check(probe.intensity, 0.9))
+        self.assertIs(expt._stages['reflectivity', True, 0][1], resolved)
+        self.assertTrue(check(probe.background, 1e-6))
+        self.assertTrue(check(probe.back_absorption, 0.5))
+        self.assertTrue(check(probe.sample_broadening, 0.01))
+        self.assertFalse(check(probe.theta_offset, 0.01))
+        self.assertFalse(check(self.pars[0], 90.0))
+        self.assertTrue(check(self.pars[0], 90.0))
+
+    def test_stage_cache_structure(self):
+        """ Replaced parameters, materials and settings are not stale """
+        expt, probe = self.expt, self.expt.probe
+        sample = expt.sample
+
+        def check():
+            expt.update()
+            Q, R = expt.reflectivity()
+            Qf, Rf = Experiment(probe=probe, sample=sample, dz=expt.dz,
+                                step_interfaces=expt.step_interfaces,
+                                dA=expt.dA).reflectivity()
+            np.testing.assert_array_equal(Q, Qf)
+            np.testing.assert_allclose(R, Rf, rtol=1e-12)
+            return R
+
+        R = check()
+        sample['Ni'].material.rho = Parameter(5, name='Ni rho')
+        self.assertFalse(np.allclose(check(), R))
+        R = check()
+        sample['Ni'].material = SLD(name='Ni', rho=7, irho=0.02)
+        self.assertFalse(np.allclose(check(), R))
+
+        # Attributes which are not parameters.
+        sample['Ni'].interface.value = 20
+        R = check()
+        probe.resolution = 'uniform'
+        self.assertFalse(np.allclose(check(), R))
+        R = check()
+        expt.step_interfaces = True
+        expt.dz = 5
+        self.assertFalse(np.allclose(check(), R))
+        R = check()
+        expt.dz = 1
+        self.assertFalse(np.allclose(check(), R))
+        R = check()
+        expt.dA = 2
+        self.assertFalse(np.allclose(check(), R))
+
+    def test_compile(self):
+        """ Compiled gather matches layer by layer rendering """
+        from refl1d.names import Material
+        ni = Material('Ni', fitby='relative_density')
+        sample = Slab(Material('Si'), interface=5)
+        for k in range(10):
+            sample = sample | Slab(ni, 40+k, 3) | Slab(SLD(rho=k), 20, 2)
+        sample = sample | Slab(SLD(name='air'))
+        T = np.linspace(0.1, 5, 50)
+        probe = NeutronProbe(T=T, dT=0.02, L=np.linspace(4, 5, 50), dL=0.05)
+        expt = Experiment(probe=probe, sample=sample)
+        pars = [ni.relative_density, sample[1].thickness, sample[2].interface,
+                sample[2].material.rho, sample[0].material.density]
+        expt.compile(pars)
+        for pvec in ([0.9, 45, 3, 1.5, 2.0], [1.1, 30, 1, -0.5, 2.5]):
+            for p, v in zip(pars, pvec):
+                p.value = v
+            expt.update()
+            Q, R = expt.reflectivity()
+            self.assertIsNotNone(expt._compiled)
+            np.testing.assert_allclose(
+                R, Experiment(probe=probe, sample=sample).reflectivity()[1],
+                rtol=1e-12)
+
+        expt.uncompile()
+        # A gather that does not reproduce the rendered profile is rejected.
+        render = _CompiledStack.render
+        def corrupted(compiled, slabs):
+            render(compiled, slabs)
+            slabs.w[1] *= 2
+        try:
+            _CompiledStack.render = corrupted
+            self.assertRaises(ValueError, expt.compile, pars)
+        finally:
+            _CompiledStack.render = render
+        self.assertIsNone(expt._compiled)
+        expt.step_interfaces = True
+        self.assertRaises(ValueError, expt.compile, pars)
+        expt.step_interfaces = None
+        ni.fitby('cell_volume')
+        self.assertRaises(ValueError, expt.compile, [ni.cell_volume])
+        self.assertIsNone(expt._compiled)
+
+    def test_wavelength_sld(self):
+        """ TOF probes use the SLD at the wavelength of each point """
+        from periodictable import nsf
+        from refl1d.names import Material
+        from refl1d.reflectivity import reflectivity_amplitude
+        gd = Material('Gd')
+        sample = Slab(Material('Si'), interface=3) | Slab(gd, 200, 3) | Slab(air)
+        L = np.linspace(2, 8, 60)
+        probe = NeutronProbe(T=np.full_like(L, 1.5), dT=0.01, L=L, dL=0.02*L)
+        probe.sld_tolerance = 1e-4
+        expt = Experiment(probe=probe, sample=sample)
+        calc_q, calc_r = expt._reflamp()
+        self.assertGreater(expt._slabs.rho.shape[0], 1)
+        rho, irho, _ = nsf.neutron_sld(gd.formula, wavelength=probe.calc_L,
+                                       density=gd.density.value)
+        si = [np.ravel(v)[0] for v in Material('Si').sld(probe)]
+        expected = [
+            reflectivity_amplitude(kz=[-q/2], depth=[0, 200, 0], sigma=[3, 3],
+                                   rho=[si[0], rho_k, 0],
+                                   irho=[si[1], irho_k, 0])[0]
+            for q, rho_k, irho_k in zip(calc_q, rho, irho)]
+        np.testing.assert_allclose(abs(calc_r)**2, abs(np.array(expected))**2,
+                                   rtol=1e-3)
+
+        # Outside the reflectivity calculation the SLD is for the first
+        # wavelength, as used by the profile views and staj conversion.
+        rho_0, irho_0 = gd.sld(probe)
+        self.assertEqual(np.ndim(rho_0), 0)
+        self.assertAlmostEqual(rho_0, rho[np.argmin(probe.calc_L)])
+        self.assertAlmostEqual(irho_0, irho[np.argmin(probe.calc_L)])
+
+        # A coarser tolerance uses fewer columns; None uses one.
+        probe.sld_tolerance = 0.05
+        expt.update_composition()
+        fine = len(np.unique(probe.unique_L))
+        self.assertLess(expt._slabs.rho.shape[0], fine)
+        self.assertLess(expt._rho_index().max(), expt._slabs.rho.shape[0])
+        probe.sld_tolerance = None
+        expt.update_composition()
+        expt.reflectivity()
+        self.assertEqual(expt._slabs.rho.shape[0], 1)
+
+    def test_wavelength_sld_layers(self):
+        """ Samples with non-slab layers use a single SLD column """
+        from refl1d.names import Material, FreeInterface
+        si, gd = Material('Si'), Material('Gd')
+        interface = FreeInterface(below=si, above=gd, dz=[1, 1], dp=[1, 1])
+        sample = Slab(si) | interface | Slab(gd, 50, 5) | Slab(air)
+        L = np.linspace(2, 10, 60)
+        probe = NeutronProbe(T=np.full_like(L, 1.5), dT=0.01, L=L, dL=0.02*L)
+        probe.sld_tolerance = 1e-4
+        expt = Experiment(probe=probe, sample=sample, step_interfaces=True)
+        self.assertFalse(sample.wavelength_resolved)
+        R = expt.reflectivity()[1]
+        self.assertEqual(expt._slabs.rho.shape[0], 1)
+        self.assertIsNone(expt._rho_index())
+        self.assertTrue(np.all(np.isfinite(R)))
+
+    def test_distribution(self):
+        """ Batched distribution evaluation matches the serial sum """
+        from scipy.stats import norm
+        from refl1d.dist import DistributionExperiment, Weights
+        sample = self.expt.sample
+        bump = Parameter(100, name='bump')
+        for P, step, coherent in ((sample['Ni'].thickness, False, False),
+                                  (sample['Ni'].interface, True, True),
+                                  (bump, False, False)):
+            if P is bump:
+                # Linear in P at both ends of the distribution but not
+                # in the middle.
+                sample['Ni'].thickness = P + 0.5*(
+                    abs(P - 80) - 2*abs(P - 100) + abs(P - 120))
+            expt = Experiment(probe=self.expt.probe, sample=sample, dA=1,
+                              step_interfaces=step)
+            weights = Weights(edges=np.linspace(P.value*0.5, P.value*1.5, 12),
+                              cdf=norm.cdf, loc=P.value, scale=P.value*0.2)
+            dist = DistributionExperiment(expt, P=P, distribution=weights,
+                                          coherent=coherent)
+            Q, R = dist.reflectivity()
+            self.assertEqual(P.value, weights.loc.value)
+            calc_R = 0
+            for x, w in weights:
+                P.value = x
+                expt.update()
+                Qx, Rx = expt._reflamp()
+                calc_R = calc_R + w*(Rx if coherent else abs(Rx)**2)
+            P.value = weights.loc.value
+            expt.update()
+            calc_R = abs(calc_R)**2 if coherent else calc_R
+            expected = expt.probe.apply_beam(Qx, calc_R)[1]
+            np.testing.assert_allclose(R, expected, rtol=1e-10)
+
+    def test_measured_cross_sections(self):
+        """ Unmeasured cross sections are skipped without changing the rest """
+        probe = self.expt.probe
+        substrate = SLD(name='Fe', rho=8.0)
+        sample = (Slab(substrate, interface=5,
+                       magnetism=Magnetism(rhoM=2, thetaM=60))
+                  | Slab(SLD(name='Ni', rho=9.4), 60, 4,
+                         magnetism=Magnetism(rhoM=1.4, thetaM=30))
+                  | Slab(SLD(name='air', rho=0)))
+
+        def polarized(measured):
+            xs = [(NeutronProbe(T=probe.T, dT=probe.dT, L=probe.L, dL=probe.dL)
+                   if k in measured else None) for k in range(4)]
+            return PolarizedNeutronProbe(xs, H=0.5)
+        full = Experiment(probe=polarized(range(4)), sample=sample)
+        expected = full.reflectivity()
+        for measured in ((0,), (3,), (0, 3)):
+            expt = Experiment(probe=polarized(measured), sample=sample)
+            R = expt.reflectivity()
+            for k in range(4):
+                if k in measured:
+                    np.testing.assert_allclose(R[k][1], expected[k][1],
+                                               rtol=1e-12)
+                else:
+                    self.assertIsNone(R[k])
+            # The amplitude includes all the cross sections.
+            np.testing.assert_allclose(expt._reflamp(measured=False)[1],
+                                       full._reflamp()[1], rtol=1e-12)
+            A = expt.amplitude()
+            for k in measured:
+                np.testing.assert_allclose(A[k][1], full.amplitude()[k][1],
+                                           rtol=1e-12)
+
+    def test_single_precision(self):
+        """ Single precision kernels agree with double precision """
+        from refl1d import refllib
+        expected = self.expt.reflectivity()[1]
+        population = [[80.0, 3.0], [120.0, 6.0]]
+        batch = self.expt.nllf_batch(population, pars=self.pars)
+        refllib.set_precision("single")
+        try:
+            self.assertEqual(refllib.get_precision(), "single")
+            expt = Experiment(probe=self.expt.probe, sample=self.expt.sample)
+            R = expt.reflectivity()[1]
+            batch_single = self.expt.nllf_batch(population, pars=self.pars)
+        finally:
+            refllib.set_precision("double")
+        np.testing.assert_allclose(R, expected, rtol=1e-4)
+        np.testing.assert_allclose(batch_single, batch, rtol=1e-3)
+        self.assertRaises(ValueError, refllib.set_precision, "half")
+
+    def test_fused(self):
+        """ Fused reflectivity matches the separate amplitude and resolution """
+        probe = NeutronProbe(T=np.linspace(-3, 3, 150), dT=0.02,
+                             L=4.75, dL=0.0475, back_absorption=0.8)
+        probe.oversample(10)
+        sample = self.expt.sample
+        expected = Experiment(probe=probe, sample=sample).reflectivity()
+        expt = Experiment(probe=probe, sample=sample, fused=True)
+        Q, R = expt.reflectivity()
+        self.assertIn('fused', expt._stages)
+        np.testing.assert_allclose(Q, expected[0])
+        np.testing.assert_allclose(R, expected[1], rtol=1e-12)
+
+    def test_model_threads(self):
+        """ Models evaluated on the thread pool match serial evaluation """
+        sample = self.expt.sample
+        other = Slab(SLD(name='Si', rho=2.07)) | Slab(SLD(name='air', rho=0))
+        def build():
+            mixed = MixedExperiment(samples=[sample, other], ratio=[3, 1],
+                                    probe=self.expt.probe)
+            single = Experiment(probe=self.expt.probe, sample=other)
+            return ConcurrentFitProblem([mixed, single])
+        expected = build()
+        try:
+            set_model_threads(2)
+            problem = build()
+            self.assertEqual(problem.nllf(), expected.nllf())
+            np.testing.assert_array_equal(problem.residuals(),
+                                          expected.residuals())
+        finally:
+            set_model_threads(1)
+
+    def test_model_threads_exit(self):
+        """ Interpreter exits after models are evaluated on the thread pool """
+        import subprocess
+        import sys
+        import refl1d
+        script = "\n".join((
+            "import numpy as np",
+            "from refl1d.names import *",
+            "from refl1d.experiment import evaluate",
+            "sample = Slab(SLD(rho=2.07)) | Slab(SLD(rho=9.4), 100, 5) | Slab(air)",
+            "probe = NeutronProbe(T=np.linspace(0.1, 5, 200), dT=0.02, L=4.75, dL=0.05)",
+            "set_model_threads(2)",
+            "evaluate([Experiment(probe=probe, sample=sample) for _ in range(2)])",
+        ))
+        root = os.path.dirname(os.path.dirname(os.path.abspath(refl1d.__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        # With and without the threaded kernels.
+        for threads in ("1", "2"):
+            env.update(REFL1D_THREADS=threads, NUMBA_NUM_THREADS=threads)
+            result = subprocess.run([sys.executable, "-c", script], env=env,
+                                    timeout=300)
+            self.assertEqual(result.returncode, 0)
+
+    def test_incremental(self):
+        """ Spliced single-layer updates match the full calculation """
+        expected = [self._nllf(pvec) for pvec in
+                    ([100.0, 5.0], [101.0, 5.0], [100.0, 5.5], [90.0, 4.0])]
+        self.expt.incremental = True
+        actual = [self._nllf(pvec) for pvec in
+                  ([100.0, 5.0], [101.0, 5.0], [100.0, 5.5], [90.0, 4.0])]
+        np.testing.assert_allclose(actual, expected, rtol=1e-12)
+
+    def test_repeat(self):
+        """ Repeated stacks match the explicitly tiled stack """
+        Ti = SLD(name='Ti', rho=-1.9, irho=0.01)
+        Ni = SLD(name='Ni', rho=9.4)
+        bilayer = Slab(Ni, thickness=40, interface=4) | Slab(Ti, 30, 3)
+        tiled = bilayer
+        for _ in range(19):
+            tiled = tiled | Slab(Ni, 40, 4) | Slab(Ti, 30, 3)
+        tiled[-1].interface.value = 6
+        substrate = Slab(SLD(name='Si', rho=2.07), interface=5)
+        air = Slab(SLD(name='air', rho=0))
+        repeated = substrate | Repeat(bilayer, 20, interface=6) | air
+        explicit = substrate | tiled | air
+        probe = self.expt.probe
+        expt = Experiment(probe=probe, sample=repeated)
+        self.assertEqual(expt._slabs.repeats, None)
+        R = expt.reflectivity()[1]
+        self.assertEqual(expt._slabs.repeats.tolist(), [[1, 2, 20]])
+        expected = Experiment(probe=probe, sample=explicit).reflectivity()[1]
+        np.testing.assert_allclose(R, expected, rtol=1e-10)
+
+    def test_magnetic_repeat(self):
+        """ Repeated magnetic stacks match the explicitly tiled stack """
+        Ti = SLD(name='Ti', rho=-1.9, irho=0.01)
+        Ni = SLD(name='Ni', rho=9.4)
+
+        def bilayer():
+            return (Slab(Ni, 40, 4, magnetism=Magnetism(rhoM=1.4, thetaM=60))
+                    | Slab(Ti, 30, 3))
+        tiled = bilayer()
+        for _ in range(9):
+            tiled = tiled | bilayer()
+        tiled[-1].interface.value = 6
+        substrate = Slab(SLD(name='Si', rho=2.07), interface=5)
+        air = Slab(SLD(name='air', rho=0))
+        repeated = substrate | Repeat(bilayer(), 10, interface=6) | air
+        explicit = substrate | tiled | air
+        probe = self.expt.probe
+        xs = [NeutronProbe(T=probe.T, dT=probe.dT, L=probe.L, dL=probe.dL)
+              for _ in range(4)]
+        probe = PolarizedNeutronProbe(xs, H=0.5)
+        expt = Experiment(probe=probe, sample=repeated)
+        R = [xs[1] for xs in expt.reflectivity()]
+        self.assertEqual(expt._slabs.repeats.tolist(), [[1, 2, 10]])
+        expected = [xs[1] for xs in
+                    Experiment(probe=probe, sample=explicit).reflectivity()]
+        np.testing.assert_allclose(R, expected, rtol=1e-10, atol=1e-14)
+
+
 if __name__ == '__main__':
     unittest.main()